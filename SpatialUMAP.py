@@ -3,16 +3,14 @@ Author: Alex Baras, MD, PhD (https://github.com/alexbaras)
 NCATS Maintainer: Dante J Smith, PhD (https://github.com/djsmith17)
 '''
 import time
-import multiprocessing as mp
-from functools import partial
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 import matplotlib.pyplot as plt
 from scipy import optimize
 from scipy import ndimage as ndi
-from scipy.spatial import ConvexHull
-from sklearn.metrics.pairwise import euclidean_distances
+from scipy import signal
+from scipy.spatial import ConvexHull, QhullError
 from skimage import draw as skdraw, transform as sktran
 np.seterr(divide='ignore', invalid='ignore')
 
@@ -28,13 +26,18 @@ class SpatialUMAP:
     * __init__
     * construct_arcs
     * process_cell_areas
+    * calculate_cell_areas
+    * calculate_disk_polygon_overlaps
     * process_cell_counts
     * clear_counts
     * clear_areas
     * start_pool
     * close_pool
+    * get_region_cell_data
+    * process_preloaded_cell_counts
     * process_region_counts
     * process_region_areas
+    * process_region_hull_areas
     * get_counts
     * get_areas
     * set_train_test
@@ -98,16 +101,126 @@ class SpatialUMAP:
         # return i and areas
         return i, areas
 
+    @staticmethod
+    def calculate_cell_areas(cell_positions, img_mask, arcs, block_pixels=4194304):
+        '''
+        calculate_cell_areas() measures the area of the tissue mask within
+        each arc around every cell at once by correlating the mask with the
+        arcs (via FFT) and reading off the result at the cell locations. It
+        gives the same areas as calling process_cell_areas() on each cell.
+
+        Args:
+            cell_positions (np.array): cell positions in mask pixels (cells x 2)
+            img_mask (np.array): boolean tissue mask
+            arcs (np.array): boolean mask of concentric arcs from construct_arcs()
+            block_pixels (int): approximate number of mask pixels to correlate at a time, bounding the memory used
+
+        Returns:
+            np.array: area of each arc in square pixels (cells x arcs)
+        '''
+
+        # half-width of the arcs
+        radius = (arcs.shape[0] - 1) // 2
+
+        # windows in process_cell_areas() never include the last row and column of the mask
+        img_mask = img_mask.copy()
+        img_mask[-1, :] = False
+        img_mask[:, -1] = False
+
+        # pad the mask so that the correlation is defined for windows centered up to radius pixels outside it
+        padded_mask = np.pad(img_mask.astype(float), 2 * radius, mode='constant', constant_values=0)
+
+        # location of each cell in the correlation output, ignoring cells whose windows lie entirely outside the mask
+        locs = cell_positions.astype(int) + radius
+        in_bounds = np.all((locs >= 0) & (locs < np.array(img_mask.shape) + 2 * radius), axis=1)
+
+        # correlate blocks of rows containing cells with all arcs at once
+        areas = np.zeros((cell_positions.shape[0], arcs.shape[2]), dtype=int)
+        kernels = arcs[::-1, ::-1, :].astype(float)
+        block_rows = max(2 * radius + 1, block_pixels // padded_mask.shape[1])
+        for row_start in range(0, padded_mask.shape[0] - 2 * radius, block_rows):
+            in_block = in_bounds & (locs[:, 0] >= row_start) & (locs[:, 0] < row_start + block_rows)
+            if in_block.any():
+                block = signal.fftconvolve(padded_mask[row_start:(row_start + block_rows + 2 * radius), :, np.newaxis], kernels, mode='valid', axes=(0, 1))
+                areas[in_block] = np.rint(block[locs[in_block, 0] - row_start, locs[in_block, 1]]).astype(int)
+
+        return areas
+
+    @staticmethod
+    def calculate_disk_polygon_overlaps(centers, radii, polygon, chunk_size=100000):
+        '''
+        calculate_disk_polygon_overlaps() computes in closed form the area of
+        overlap between a polygon and disks of each radius centered on every
+        point, by summing the signed overlaps of each disk with the triangles
+        formed by its center and each polygon edge.
+
+        Args:
+            centers (np.array): disk centers (points x 2)
+            radii (np.array): disk radii
+            polygon (np.array): polygon vertices in order (vertices x 2)
+            chunk_size (int): number of centers to process at a time, bounding the memory used
+
+        Returns:
+            np.array: overlap areas (points x radii)
+        '''
+
+        overlaps = np.zeros((centers.shape[0], len(radii)))
+        for chunk_start in range(0, centers.shape[0], chunk_size):
+
+            # polygon edge endpoints relative to each center (points x edges x 2)
+            edge_starts = polygon[np.newaxis, :, :] - centers[chunk_start:(chunk_start + chunk_size), np.newaxis, :]
+            edge_ends = np.roll(edge_starts, -1, axis=1)
+            edge_vectors = edge_ends - edge_starts
+
+            # quadratic coefficients for where each edge crosses a circle, other than the radius term
+            a = np.sum(np.square(edge_vectors), axis=-1)
+            b = 2 * np.sum(edge_starts * edge_vectors, axis=-1)
+            c0 = np.sum(np.square(edge_starts), axis=-1)
+
+            for radius_index, radius in enumerate(radii):
+
+                # fraction along each edge where it enters and leaves the circle (both 0 if the edge's line misses it)
+                disc = np.square(b) - 4 * a * (c0 - radius ** 2)
+                sqrt_disc = np.sqrt(np.maximum(disc, 0))
+                t_enter = np.where(disc > 0, np.clip((-b - sqrt_disc) / (2 * a), 0, 1), 0)
+                t_leave = np.where(disc > 0, np.clip((-b + sqrt_disc) / (2 * a), 0, 1), 0)
+                p_enter = edge_starts + t_enter[..., np.newaxis] * edge_vectors
+                p_leave = edge_starts + t_leave[..., np.newaxis] * edge_vectors
+
+                # sectors for the parts of each edge outside the circle and a triangle for the part inside
+                cross = lambda u, v: u[..., 0] * v[..., 1] - u[..., 1] * v[..., 0]
+                sector_1 = np.arctan2(cross(edge_starts, p_enter), np.sum(edge_starts * p_enter, axis=-1))
+                sector_2 = np.arctan2(cross(p_leave, edge_ends), np.sum(p_leave * edge_ends, axis=-1))
+                triangle = cross(p_enter, p_leave)
+                overlaps[chunk_start:(chunk_start + chunk_size), radius_index] = np.abs(np.sum(0.5 * radius ** 2 * (sector_1 + sector_2) + 0.5 * triangle, axis=1))
+
+        return overlaps
+
     @staticmethod
     def process_cell_counts(i, cell_positions, cell_labels, dist_bin_px):
-        # squared distance
-        counts = np.sum(np.square(cell_positions[i][np.newaxis, :] - cell_positions), axis=1)
-        # inequalities around arcs
-        counts = counts[np.newaxis, :] <= np.square(np.concatenate([[0], dist_bin_px]))[:, np.newaxis]
-        # matmul to counts
-        counts = np.diff(np.matmul(counts.astype(int), cell_labels.astype(int)), axis=0)
-        # return index and counts
-        return counts
+        '''
+        process_cell_counts() counts the cells of each label within each
+        arc, (dist_bin_px[k-1], dist_bin_px[k]], around the cell(s) i using
+        a spatial index, so memory scales with the number of neighbor pairs
+
+        Args:
+            i (int or np.array): index or indices of the center cell(s)
+            cell_positions (np.array): positions of all cells in the region
+            cell_labels (np.array): one-hot labels of all cells in the region (cells x labels)
+            dist_bin_px (np.array): distance bins in pixels
+
+        Returns:
+            np.array: counts (arcs x labels) for a single index, or (cells x arcs x labels) for an array of indices
+        '''
+        # integer label of each cell (-1 for cells without exactly one label)
+        cell_labels = np.asarray(cell_labels)
+        label_codes = np.where(cell_labels.sum(axis=1) == 1, np.argmax(cell_labels, axis=1), -1)
+        # annulus counts for the center(s) against all cells in the region
+        centers = np.asarray(cell_positions)[np.atleast_1d(i)]
+        counts = utils.calculate_annulus_neighbor_counts(centers, cell_positions, label_codes, cell_labels.shape[1], np.concatenate([[0], dist_bin_px]), swap_inequalities=True)
+        # reorder to arcs x labels
+        counts = counts.transpose((0, 2, 1)).astype(int)
+        return counts[0] if np.ndim(i) == 0 else counts
 
     def per_image_cell_counts_euc(self, image, cell_positions, cell_labels, targ_labels, dist_bin_px):
         '''
@@ -122,22 +235,17 @@ class SpatialUMAP:
 
         start_time = time.time()
         print(f'Starting analysis for image {image}')
-        # calculate pairwise distances between all cells in the image
-        dist_st_time = time.time()
-        distances = euclidean_distances(cell_positions)
-        dist_end_time = (time.time() - dist_st_time) / 60
-        print(f'Finished distance calculation for image {image} ({len(cell_positions)} cells) in {dist_end_time:.2f} minutes')
-
-        image_counts = None
-        for i in range(len(distances)):
-            counts = self.euclidian_counts(i, distances, cell_labels, targ_labels, dist_bin_px)
-            if image_counts is not None:
-                image_counts = np.vstack((image_counts, counts))
-            else:
-                image_counts = counts
+
+        # integer code of each cell's label within targ_labels (-1 if not a target)
+        targ_labels = np.asarray(targ_labels)
+        label_codes = pd.Index(targ_labels).get_indexer(np.asarray(cell_labels))
+
+        # count the neighbors of each label within each arc using a spatial index, in chunks bounded in memory
+        image_counts = utils.calculate_annulus_neighbor_counts(np.asarray(cell_positions), np.asarray(cell_positions), label_codes, len(targ_labels), np.concatenate([[0], dist_bin_px]), swap_inequalities=True)
+        image_counts = image_counts.transpose((0, 2, 1)).astype(int)
 
         comp_time = (time.time() - start_time) / 60
-        print(f'Finished analysis for image {image} in {comp_time:.2f} minutes')
+        print(f'Finished analysis for image {image} ({len(cell_positions)} cells) in {comp_time:.2f} minutes')
         return image_counts
 
     @staticmethod
@@ -154,16 +262,14 @@ class SpatialUMAP:
             dist_bin_px (np.array): distance bins in pixels
         '''
 
-        idx_counts = None
+        # arc of each cell relative to cell idx, (dist_bin_px[k-1], dist_bin_px[k]], and its label code
         dist_bin_px = np.concatenate([[0], dist_bin_px])
-        for i in range(len(dist_bin_px)-1):
-            present_cells = cell_labels[(distances[idx] > dist_bin_px[i]) & (distances[idx] <= dist_bin_px[i+1])]
-            these_counts = [sum(present_cells == label) for label in targ_labels]
+        arc_indices = np.searchsorted(dist_bin_px, np.asarray(distances[idx]), side='left') - 1
+        label_codes = pd.Index(np.asarray(targ_labels)).get_indexer(np.asarray(cell_labels))
+        in_arcs = (arc_indices >= 0) & (arc_indices < len(dist_bin_px) - 1) & (label_codes >= 0)
 
-            if idx_counts is not None:
-                idx_counts = np.vstack((idx_counts, these_counts))
-            else:
-                idx_counts = np.array(these_counts)
+        # tally the cells into (arc, label) bins
+        idx_counts = np.bincount(arc_indices[in_arcs] * len(targ_labels) + label_codes[in_arcs], minlength=(len(dist_bin_px) - 1) * len(targ_labels)).reshape((len(dist_bin_px) - 1, len(targ_labels)))
 
         return idx_counts[np.newaxis, :]
 
@@ -195,8 +301,6 @@ class SpatialUMAP:
         phenotype_column_name = 'Lineage'
         image_column_name     = 'Slide ID'
         image_names = df[image_column_name].unique()
-        num_ranges = len(radii) - 1
-        range_strings = [f'({radii[iradius]}, {radii[iradius + 1]}]' for iradius in range(num_ranges)]
 
         # Initialize keyword arguments
         kwargs_list = []
@@ -216,25 +320,15 @@ class SpatialUMAP:
                 )
             )
 
-        # Create a pool of worker processes
-        with mp.Pool(processes=cpu_pool_size) as pool:
-            results = pool.starmap(utils.fast_neighbors_counts_for_block2, kwargs_list)
-
-        df_density_matrix = pd.concat(self.get_dataframes(results))
-        full_array = None
-        for ii, phenotype in enumerate(phenotypes):
-            cols2Use = [f'{phenotype} in {x}' for x in range_strings]
-            array_set = df_density_matrix.loc[:, cols2Use].to_numpy()
-            if full_array is None:
-                full_array = array_set
-            else:
-                full_array = np.dstack((full_array, array_set))
-
-        full_array_nan = np.isnan(full_array)
-        full_array[full_array_nan] = 0
+        # Use the shared pool of worker processes
+        pool = utils.get_persistent_pool(cpu_pool_size)
+        try:
+            results = pool.starmap(utils.fast_neighbors_counts_array_for_block, kwargs_list)
+        finally:
+            utils.release_persistent_pool(pool)
 
-        # Concatenate the results into a single dataframe
-        return full_array
+        # Concatenate the (num_cells, num_phenotypes, num_annuli) results for every image and put the annuli before the phenotypes
+        return np.concatenate(results, axis=0).transpose((0, 2, 1))
 
     def __init__(self, dist_bin_um, um_per_px, area_downsample):
         # microns per pixel
@@ -288,41 +382,53 @@ class SpatialUMAP:
     def clear_areas(self):
         self.areas = np.empty((self.cell_positions.shape[0], len(self.dist_bin_um)))
 
-    def start_pool(self, processes):
-        start_method = mp.get_start_method()
-        if start_method == 'fork':
-            start_method = 'forkserver'  # to prevent crashing resulting in "Stopping..."
-        self.pool = mp.get_context(start_method).Pool(processes)
+    def start_pool(self, processes, preloaded_data=None):
+        # a plain pool is the process-lifetime one shared with the rest of the app; a pool with preloaded data is this object's own (using forkserver instead of fork to prevent crashing resulting in "Stopping...")
+        self.pool = utils.get_persistent_pool(processes, preloaded_data=preloaded_data)
 
     def close_pool(self):
-        self.pool.close()
-        self.pool.join()
-        del self.pool
+        # only actually shut down the pool if it's this object's own pool with preloaded data (so that the workers' copies are freed) or a retired plain pool
+        utils.release_persistent_pool(self.pool)
+        self.pool = None
+
+    def get_region_cell_data(self):
+        '''
+        get_region_cell_data() returns the cell positions and labels
+        of every region, for preloading into the pool workers
+        '''
+        region_cell_data = {}
+        for region_id in self.region_ids:
+            idx = np.where(region_id == self.cells['TMA_core_id'])[0]
+            region_cell_data[region_id] = dict(cell_positions=self.cell_positions[idx],
+                                               cell_labels=self.cell_labels.values[idx])
+        return dict(region_cell_data=region_cell_data, dist_bin_px=self.dist_bin_px)
+
+    @staticmethod
+    def process_preloaded_cell_counts(args):
+        '''
+        process_preloaded_cell_counts() runs process_cell_counts() on a
+        chunk of cells of the region data preloaded into the worker by
+        get_counts()
+        '''
+        region_id, i = args
+        preloaded_data = utils.get_worker_preloaded_data()
+        return SpatialUMAP.process_cell_counts(i, dist_bin_px=preloaded_data['dist_bin_px'], **preloaded_data['region_cell_data'][region_id])
 
     def process_region_counts(self, region_id, pool_size):
         '''
         Process_region_counts
+
+        Uses the pool started (with the region data preloaded) in get_counts()
         '''
         # get indices of cells from this region
         idx = np.where(region_id == self.cells['TMA_core_id'])[0]
-        # get counts if there are cells in region
+        # get counts if there are cells in region, sending each worker a chunk of center cells
         if len(idx) > 0:
-            # partial for picklable fn for pool for process with data from this region
-            args = dict(cell_positions=self.cell_positions[idx],
-                        cell_labels=self.cell_labels.values[idx],
-                        dist_bin_px=self.dist_bin_px)
-            pool_map_fn = partial(SpatialUMAP.process_cell_counts, **args)
             chunk_size = 10000
-            idxchunk = [idx[i:i + chunk_size] for i in range(0, len(idx), chunk_size)]
-            # process
-            with mp.Pool(pool_size) as pool:
-                for i, chunk in enumerate(idxchunk):
-                    chunk_range = range(0, len(chunk), 1)
-                    chunk_range2 = [x + chunk_size*i for x in chunk_range]
-                    results = list(pool.map(pool_map_fn, chunk_range2))
-                    counts = list(map(lambda x: np.stack(x, axis=0), results))
-                    # set results, adjust indexing (just in case)
-                    self.counts[chunk] = counts
+            chunk_args = [(region_id, np.arange(i, min(i + chunk_size, len(idx)))) for i in range(0, len(idx), chunk_size)]
+            results = list(self.pool.map(SpatialUMAP.process_preloaded_cell_counts, chunk_args))
+            # set results
+            self.counts[idx] = np.concatenate(results, axis=0)
 
     def process_region_areas(self, pool_size, area_threshold, plots_directory=None):
 
@@ -339,17 +445,10 @@ class SpatialUMAP:
                 # down sample for area calculations
                 img_tissue_mask_dn = sktran.rescale(img_tissue_mask, self.area_downsample).astype(bool)
 
-                # partial for picklable fn for pool for process with data from this region
-                args = dict(region_id=region_id,
-                            cell_positions=self.cell_positions[idx][:, [1, 0]] * self.area_downsample,
-                            dist_bin_px=self.arcs_radii,
-                            img_mask=img_tissue_mask_dn,
-                            arcs=self.arcs_masks)
-                pool_map_fn = partial(SpatialUMAP.process_cell_areas, **args)
-                # process
-                i, areas = list(map(lambda x: np.stack(x, axis=0), list(zip(*self.pool.map(pool_map_fn, range(len(idx)))))))
-
-                areas = areas[i]
+                # area of the tissue within each arc around every cell of this region at once
+                areas = SpatialUMAP.calculate_cell_areas(cell_positions=self.cell_positions[idx][:, [1, 0]] * self.area_downsample,
+                                                         img_mask=img_tissue_mask_dn,
+                                                         arcs=self.arcs_masks)
 
                 # set results
                 self.areas[idx] = areas
@@ -370,6 +469,41 @@ class SpatialUMAP:
                     del f
                     plt.ion()
 
+    def process_region_hull_areas(self):
+        '''
+        process_region_hull_areas() approximates each region by the convex
+        hull of its cells and computes the fraction of each arc around every
+        cell lying inside the hull analytically, with no ellipse fitting or
+        mask rasterization. Areas are reported as that fraction of the arc's
+        area in process_region_areas() so the two methods are interchangeable.
+        '''
+
+        # full area of each arc and the outer radius of each arc's disk (as drawn in construct_arcs())
+        full_areas = self.arcs_masks.sum(axis=(0, 1))
+        radii = np.concatenate([[0], self.arcs_radii + 1])
+
+        for region_id in self.region_ids:
+            # get indices of cells from this region
+            idx = np.where(region_id == self.cells['TMA_core_id'])[0]
+            # get areas if cells are in region
+            if len(idx) > 0:
+                cell_positions = self.cell_positions[idx] * self.area_downsample
+
+                # regions without a proper hull are treated as having no boundary
+                try:
+                    hull = ConvexHull(cell_positions)
+                except (QhullError, ValueError):
+                    self.areas[idx] = full_areas[np.newaxis, :]
+                    continue
+
+                # overlap of each disk with the hull, differenced into arcs and converted to fractions of each arc
+                overlaps = SpatialUMAP.calculate_disk_polygon_overlaps(cell_positions, radii[1:], cell_positions[hull.vertices])
+                arc_overlaps = np.diff(np.concatenate([np.zeros((len(idx), 1)), overlaps], axis=1), axis=1)
+                arc_fractions = arc_overlaps / (np.pi * np.diff(np.square(radii)))[np.newaxis, :]
+
+                # set results
+                self.areas[idx] = np.clip(arc_fractions, 0, 1) * full_areas[np.newaxis, :]
+
     def get_counts(self, pool_size=2, save_file=None):
         '''
         get_counts begins the process of identifying the 
@@ -377,10 +511,12 @@ class SpatialUMAP:
         dataset
         '''
         self.clear_counts()
-        # self.start_pool(pool_size)
-        for region_id in tqdm(self.region_ids):
-            self.process_region_counts(region_id, pool_size)
-        # self.close_pool()
+        self.start_pool(pool_size, preloaded_data=self.get_region_cell_data())
+        try:
+            for region_id in tqdm(self.region_ids):
+                self.process_region_counts(region_id, pool_size)
+        finally:
+            self.close_pool()
 
         if save_file is not None:
             column_names = ['%s-%s' % (cell_type, distance) for distance in self.dist_bin_um for cell_type in self.cell_labels.columns.values]
@@ -426,18 +562,22 @@ class SpatialUMAP:
         '''
         self.counts = self.calculate_density_matrix_for_all_images(cpu_pool_size)
 
-    def get_areas(self, calc_areas, area_threshold, pool_size=2, save_file=None, plots_directory=None):
+    def get_areas(self, calc_areas, area_threshold, pool_size=2, save_file=None, plots_directory=None, area_method='ellipse'):
         '''
         get_areas begins the process of identifying the
         cell areas surrounding each given cell in a dataset
+
+        area_method selects the region boundary used when calc_areas
+        is True: 'ellipse' (a fitted ellipse mask) or 'hull' (the convex
+        hull of the region's cells, computed analytically)
         '''
         self.clear_areas()
         self.cells['area_filter'] = False
 
-        if calc_areas:
-            self.start_pool(pool_size)
+        if calc_areas and (area_method == 'hull'):
+            self.process_region_hull_areas()
+        elif calc_areas:
             self.process_region_areas(pool_size, area_threshold=area_threshold, plots_directory=plots_directory)
-            self.close_pool()
         else:
             areas = self.arcs_masks.sum(axis=(0, 1))[np.newaxis, ...]
             self.areas = np.tile(areas, (self.cells.shape[0], 1))
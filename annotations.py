@@ -439,12 +439,50 @@ def transform_annotation_data_to_integers(df_annotation, df_data_by_roi_for_sele
 
     # Set to true the indices corresponding to the span of each annotation object in the 2D annotation integer array
     # Note this allows us to plot the annotation data using, e.g., plt.imshow(annot_int_arr.T) (preferred) or plt.matshow(annot_int_arr.T)
-    for curr_row in df_annotation.itertuples():
-        annot_int_arr[curr_row.XMin_int:(curr_row.XMax_int+1), curr_row.YMin_int:(curr_row.YMax_int+1)] = True
+    # This is done all at once by scattering +1/-1 at the corners of every object's span into a 2D difference array, whose 2D cumulative sum is the number of objects covering each index
+    x_starts = np.clip(df_annotation['XMin_int'].to_numpy(), 0, num_x_indices)
+    x_stops = np.clip(df_annotation['XMax_int'].to_numpy() + 1, 0, num_x_indices)
+    y_starts = np.clip(df_annotation['YMin_int'].to_numpy(), 0, num_y_indices)
+    y_stops = np.clip(df_annotation['YMax_int'].to_numpy() + 1, 0, num_y_indices)
+    is_nonempty_span = (x_stops > x_starts) & (y_stops > y_starts)
+    x_starts, x_stops, y_starts, y_stops = x_starts[is_nonempty_span], x_stops[is_nonempty_span], y_starts[is_nonempty_span], y_stops[is_nonempty_span]
+    coverage = np.zeros((num_x_indices + 1, num_y_indices + 1), dtype=np.int32)
+    np.add.at(coverage, (x_starts, y_starts), 1)
+    np.add.at(coverage, (x_stops, y_starts), -1)
+    np.add.at(coverage, (x_starts, y_stops), -1)
+    np.add.at(coverage, (x_stops, y_stops), 1)
+    np.cumsum(coverage, axis=0, out=coverage)
+    np.cumsum(coverage, axis=1, out=coverage)
+    annot_int_arr[:, :] = coverage[:-1, :-1] > 0
+    del coverage
 
     # Return the important variables
     return annot_int_arr, min_spacing_for_annotation, x_neg_shift_after_scaling, y_neg_shift_after_scaling
 
+def get_summed_area_table(annot_int_arr):
+    """Calculate the summed-area table (integral image) of a 2D annotation integer array (or of any 2D array of counts) so that the sum over any rectangle of the array can be obtained in constant time.
+
+    Args:
+        annot_int_arr (ndarray): 2D Boolean array where indices are integer coordinates, as returned by transform_annotation_data_to_integers(), or 2D array of nonnegative integer counts
+
+    Returns:
+        ndarray: Array of shape (annot_int_arr.shape[0] + 1, annot_int_arr.shape[1] + 1) whose [i, j] element is annot_int_arr[:i, :j].sum()
+    """
+
+    # Import relevant library
+    import numpy as np
+
+    # Use the smallest integer type that can hold the total sum
+    dtype = np.int32 if annot_int_arr.size < np.iinfo(np.int32).max else np.int64
+
+    # Cumulatively sum along both axes into a zero-padded array
+    summed_area_table = np.zeros((annot_int_arr.shape[0] + 1, annot_int_arr.shape[1] + 1), dtype=dtype)
+    np.cumsum(annot_int_arr, axis=0, dtype=dtype, out=summed_area_table[1:, 1:])
+    np.cumsum(summed_area_table[1:, 1:], axis=1, out=summed_area_table[1:, 1:])
+
+    # Return the summed-area table
+    return summed_area_table
+
 def add_raw_weighting_values_to_roi_data(df_data_by_roi_for_selected_slide, df_annotation, thickness, annot_int_arr, min_spacing_for_annotation, x_neg_shift_after_scaling, y_neg_shift_after_scaling, annotation_region_type):
     """Add, in a new dataframe, four columns to the by-ROI dataframe containing raw values that could aid in weighting the ROIs based on the selected annotation region type.
 
@@ -463,76 +501,70 @@ def add_raw_weighting_values_to_roi_data(df_data_by_roi_for_selected_slide, df_a
     import numpy as np
     import pandas as pd
 
-    # Initialize a dataframe with the same index as that in df_data_by_roi_for_selected_slide; this is what we'll update in this function and simply return at the end
+    # Column names of the dataframe with the same index as that in df_data_by_roi_for_selected_slide that we'll simply return at the end
     valid_area_microns_sq_colname = 'valid_area_microns_sq_{}'.format(annotation_region_type)
     roi_integer_area_colname = 'roi_integer_area_{}'.format(annotation_region_type)
     num_ann_objects_within_roi_colname = 'num_ann_objects_within_roi_{}'.format(annotation_region_type)
     footprint_integer_area_colname = 'footprint_integer_area_{}'.format(annotation_region_type)
-    df_weights_data = pd.concat([
-        pd.Series(index=df_data_by_roi_for_selected_slide.index, dtype=np.float64, name=valid_area_microns_sq_colname),
-        pd.Series(index=df_data_by_roi_for_selected_slide.index, dtype=np.int64, name=roi_integer_area_colname),
-        pd.Series(index=df_data_by_roi_for_selected_slide.index, dtype=np.int64, name=num_ann_objects_within_roi_colname),
-        pd.Series(index=df_data_by_roi_for_selected_slide.index, dtype=np.int64, name=footprint_integer_area_colname)
-        ], axis='columns')
-
-    # For every ROI in the dataset...
-    for roi_name in df_data_by_roi_for_selected_slide['unique_roi']:
-
-        # Store the current ROI data
-        curr_data_by_roi = df_data_by_roi_for_selected_slide[df_data_by_roi_for_selected_slide['unique_roi'] == roi_name]  # get the one-row dataframe corresponding to the data in slices.df_data_by_roi for the current ROI
-        curr_roi_index = curr_data_by_roi.index[0]
-
-        # These are the same as the ranges calculated from the original dataset (slices.data) coordinates (doing the mins and maxs), shown below
-        # According to the plots, which show consistent limits, these are in microns, which is further consistent with the fact that in dataset_formats.py I ensure the units of the datasets are always microns
-        # The annotations dataframes in annotations.py are also in microns
-        x_mid = curr_data_by_roi['x_roi'].iloc[0]
-        y_mid = curr_data_by_roi['y_roi'].iloc[0]
-        x_range_stored = curr_data_by_roi.iloc[0]['x_range']
-        y_range_stored = curr_data_by_roi.iloc[0]['y_range']
-        x_range_calc = np.array([x_mid.min(), x_mid.max()])
-        y_range_calc = np.array([y_mid.min(), y_mid.max()])
-        if (not (x_range_stored == x_range_calc).all()) or (not (y_range_stored == y_range_calc).all()):
-            print('ERROR: Ranges are not the same between the calculated method and the stored method')
-
-        # Run some other checks on the data in slices.df_data_by_roi
-        if (not ((x_range_stored == np.array([curr_data_by_roi.iloc[0]['x_min_prior_to_decimation'], curr_data_by_roi.iloc[0]['x_max_prior_to_decimation']])).all())) or (not ((y_range_stored == np.array([curr_data_by_roi.iloc[0]['y_min_prior_to_decimation'], curr_data_by_roi.iloc[0]['y_max_prior_to_decimation']])).all())):
-            print('ERROR')
-        if (curr_data_by_roi.iloc[0]['width'] != (x_range_stored[1] - x_range_stored[0])) or (curr_data_by_roi.iloc[0]['height'] != (y_range_stored[1] - y_range_stored[0])):
-            print('ERROR')
-
-        # slices.thickness is in microns and is the radius
-        # Thus, the VALID region within each ROI has these bounds
-        radius = thickness
-        x_range_valid = [x_range_stored[0] + radius, x_range_stored[1] - radius]
-        y_range_valid = [y_range_stored[0] + radius, y_range_stored[1] - radius]
-
-        # Ensure the valid regions of the ROI are physically existing regions (i.e., have non-zero area)
-        if not ((x_range_valid[1] > x_range_valid[0]) and (y_range_valid[1] > y_range_valid[0])):
-            # i.e., if there is no valid area
-            # i.e., if (x_max <= x_min) or (y_max <= x_min)
-            # print('WARNING: ROI {} has NO area'.format(tag))
-            valid_area_microns = 0
-            roi_integer_area = 0
-            num_ann_objects_within_roi = 0
-            footprint_integer_area = 0
-        else:
-            # i.e., if there is a real valid area
-            # print('ROI {} has finite area'.format(tag))
-            valid_area_microns = (x_range_valid[1] - x_range_valid[0]) * (y_range_valid[1] - y_range_valid[0])
-            x_range_valid_int = transform_to_integer(x_range_valid, inverse_scale=min_spacing_for_annotation, neg_shift_after_scaling=x_neg_shift_after_scaling)
-            y_range_valid_int = transform_to_integer(y_range_valid, inverse_scale=min_spacing_for_annotation, neg_shift_after_scaling=y_neg_shift_after_scaling)
-            roi_integer_area = (x_range_valid_int[1] - x_range_valid_int[0] + 1) * (y_range_valid_int[1] - y_range_valid_int[0] + 1)  # integer area of the entire ROI
-            num_ann_objects_within_roi = ((df_annotation['xmid'] >= x_range_valid[0]) & (df_annotation['xmid'] < x_range_valid[1]) & (df_annotation['ymid'] >= y_range_valid[0]) & (df_annotation['ymid'] < y_range_valid[1])).sum()
-            footprint_integer_area = annot_int_arr[x_range_valid_int[0]:(x_range_valid_int[1] + 1), y_range_valid_int[0]:(y_range_valid_int[1] + 1)].sum()  # determine the integer footprint area of the annotation objects in the current ROI. If the scaling takes us back to pixels, then the units of these areas (this and roi_integer_area) are pixels
-
-        # Add the calculated data to the ROI-by-ROI dataframe
-        df_weights_data.loc[curr_roi_index, valid_area_microns_sq_colname] = valid_area_microns
-        df_weights_data.loc[curr_roi_index, roi_integer_area_colname] = roi_integer_area
-        df_weights_data.loc[curr_roi_index, num_ann_objects_within_roi_colname] = num_ann_objects_within_roi
-        df_weights_data.loc[curr_roi_index, footprint_integer_area_colname] = footprint_integer_area
-
-    # Return the modified dataframe
-    return df_weights_data
+
+    # These are the same as the ranges calculated from the original dataset (slices.data) coordinates (doing the mins and maxs), shown below
+    # According to the plots, which show consistent limits, these are in microns, which is further consistent with the fact that in dataset_formats.py I ensure the units of the datasets are always microns
+    # The annotations dataframes in annotations.py are also in microns
+    x_range_stored = np.array(df_data_by_roi_for_selected_slide['x_range'].to_list(), dtype=float).reshape((-1, 2))
+    y_range_stored = np.array(df_data_by_roi_for_selected_slide['y_range'].to_list(), dtype=float).reshape((-1, 2))
+    x_range_calc = np.array([[x_mid.min(), x_mid.max()] for x_mid in df_data_by_roi_for_selected_slide['x_roi']], dtype=float).reshape((-1, 2))
+    y_range_calc = np.array([[y_mid.min(), y_mid.max()] for y_mid in df_data_by_roi_for_selected_slide['y_roi']], dtype=float).reshape((-1, 2))
+    roi_names = df_data_by_roi_for_selected_slide['unique_roi'].to_numpy()
+    is_inconsistent = ~((x_range_stored == x_range_calc).all(axis=1) & (y_range_stored == y_range_calc).all(axis=1))
+    if is_inconsistent.any():
+        raise ValueError('Ranges are not the same between the calculated method and the stored method for ROIs {}'.format(roi_names[is_inconsistent].tolist()))
+
+    # Run some other checks on the data in slices.df_data_by_roi
+    is_inconsistent = ~((x_range_stored == df_data_by_roi_for_selected_slide[['x_min_prior_to_decimation', 'x_max_prior_to_decimation']].to_numpy(dtype=float)).all(axis=1) & (y_range_stored == df_data_by_roi_for_selected_slide[['y_min_prior_to_decimation', 'y_max_prior_to_decimation']].to_numpy(dtype=float)).all(axis=1))
+    if is_inconsistent.any():
+        raise ValueError('Stored ranges differ from the ranges prior to decimation for ROIs {}'.format(roi_names[is_inconsistent].tolist()))
+    is_inconsistent = (df_data_by_roi_for_selected_slide['width'].to_numpy() != (x_range_stored[:, 1] - x_range_stored[:, 0])) | (df_data_by_roi_for_selected_slide['height'].to_numpy() != (y_range_stored[:, 1] - y_range_stored[:, 0]))
+    if is_inconsistent.any():
+        raise ValueError('Stored widths or heights differ from the stored ranges for ROIs {}'.format(roi_names[is_inconsistent].tolist()))
+
+    # slices.thickness is in microns and is the radius
+    # Thus, the VALID region within each ROI has these bounds
+    radius = thickness
+    x_range_valid = x_range_stored + np.array([radius, -radius])
+    y_range_valid = y_range_stored + np.array([radius, -radius])
+
+    # Ensure the valid regions of the ROI are physically existing regions (i.e., have non-zero area); the weighting values of the ROIs with no valid area are all zero
+    has_valid_area = (x_range_valid[:, 1] > x_range_valid[:, 0]) & (y_range_valid[:, 1] > y_range_valid[:, 0])
+    valid_area_microns = np.where(has_valid_area, (x_range_valid[:, 1] - x_range_valid[:, 0]) * (y_range_valid[:, 1] - y_range_valid[:, 0]), 0.0)
+
+    # Integer area of the entire valid region of each ROI
+    x_range_valid_int = transform_to_integer(x_range_valid, inverse_scale=min_spacing_for_annotation, neg_shift_after_scaling=x_neg_shift_after_scaling)
+    y_range_valid_int = transform_to_integer(y_range_valid, inverse_scale=min_spacing_for_annotation, neg_shift_after_scaling=y_neg_shift_after_scaling)
+    roi_integer_area = np.where(has_valid_area, (x_range_valid_int[:, 1] - x_range_valid_int[:, 0] + 1) * (y_range_valid_int[:, 1] - y_range_valid_int[:, 0] + 1), 0).astype(np.int64)
+
+    # Count the annotation objects whose midpoints are within the valid region of each ROI in a single pass: bin the midpoints on the grid formed by all the ROIs' valid-region edges, count the objects per grid cell, and look up each ROI's rectangle of grid cells in the summed-area table of the counts
+    # An object with x_edges[i - 1] <= xmid < x_edges[i] is in grid column i, so it's in [x_edges[j], x_edges[k]) exactly when its column is in [j + 1, k]; NaN midpoints fall beyond the last column and are never counted
+    x_edges, x_edge_indices = np.unique(x_range_valid, return_inverse=True)
+    y_edges, y_edge_indices = np.unique(y_range_valid, return_inverse=True)
+    x_edge_indices, y_edge_indices = x_edge_indices.reshape((-1, 2)) + 1, y_edge_indices.reshape((-1, 2)) + 1
+    x_bins = np.searchsorted(x_edges, df_annotation['xmid'].to_numpy(), side='right')
+    y_bins = np.searchsorted(y_edges, df_annotation['ymid'].to_numpy(), side='right')
+    object_counts = np.bincount(x_bins * (len(y_edges) + 1) + y_bins, minlength=(len(x_edges) + 1) * (len(y_edges) + 1)).reshape((len(x_edges) + 1, len(y_edges) + 1))
+    object_counts_table = get_summed_area_table(object_counts)
+    num_ann_objects_within_roi = object_counts_table[x_edge_indices[:, 1], y_edge_indices[:, 1]].astype(np.int64) - object_counts_table[x_edge_indices[:, 0], y_edge_indices[:, 1]] - object_counts_table[x_edge_indices[:, 1], y_edge_indices[:, 0]] + object_counts_table[x_edge_indices[:, 0], y_edge_indices[:, 0]]
+    num_ann_objects_within_roi = np.where(has_valid_area, num_ann_objects_within_roi, 0)
+
+    # Determine the integer footprint area of the annotation objects in each ROI as a constant-time rectangle lookup in the summed-area table of the annotation integer array. If the scaling takes us back to pixels, then the units of these areas (this and roi_integer_area) are pixels
+    summed_area_table = get_summed_area_table(annot_int_arr)
+    x_starts = np.clip(x_range_valid_int[:, 0], 0, annot_int_arr.shape[0])
+    x_stops = np.clip(x_range_valid_int[:, 1] + 1, x_starts, annot_int_arr.shape[0])
+    y_starts = np.clip(y_range_valid_int[:, 0], 0, annot_int_arr.shape[1])
+    y_stops = np.clip(y_range_valid_int[:, 1] + 1, y_starts, annot_int_arr.shape[1])
+    footprint_integer_area = summed_area_table[x_stops, y_stops].astype(np.int64) - summed_area_table[x_starts, y_stops] - summed_area_table[x_stops, y_starts] + summed_area_table[x_starts, y_starts]
+    footprint_integer_area = np.where(has_valid_area, footprint_integer_area, 0)
+
+    # Return the ROI-by-ROI dataframe of the calculated data, in which all columns have always been floats
+    return pd.DataFrame({valid_area_microns_sq_colname: valid_area_microns, roi_integer_area_colname: roi_integer_area, num_ann_objects_within_roi_colname: num_ann_objects_within_roi, footprint_integer_area_colname: footprint_integer_area}, index=df_data_by_roi_for_selected_slide.index, dtype=np.float64)
 
 def drop_duplicate_columns_in_weighting_data(df_data_by_roi, column_prefixes=['valid_area_microns_sq_', 'roi_integer_area_', 'num_ann_objects_within_roi_', 'footprint_integer_area_']):
     """Drop the duplicate columns containing raw weighting values likely recently added to the df_data_by_roi dataframe.
@@ -840,13 +872,45 @@ def average_pvals_over_annotation_new(df_data_by_roi, df_density_pvals_arrays, e
 
     # Iterate over all possible parameters
     for unique_slide in unique_slides:
+
+        # Obtain the original joined dataframe for the current slide
+        df_joined_slide = df_joined[df_joined['unique_slide'] == unique_slide]
+
+        # Determine the ROIs in the slide having valid density P value data
+        has_valid_pvals = np.zeros(len(df_joined_slide), dtype=bool)
+        for iroi, (roi_index, log_dens_pvals_arr) in enumerate(df_joined_slide['log_dens_pvals_arr'].items()):
+
+            # If there are valid density P value data for the current ROI...
+            if type(log_dens_pvals_arr) != float:  # if it's a float then I believe np.isnan(log_dens_pvals_arr). Otherwise, they are np.ndarrays of shape (3, 3, 2, 1) always
+
+                # ...well the implementation in Squidpy may return an array with all nans I believe, so the type()... check above isn't a general check for there being valid density P value data
+                if np.isnan(log_dens_pvals_arr).sum() == np.prod(log_dens_pvals_arr.shape):
+                    warning_str = 'WARNING: There is no valid density P value data for ROI {}. There may be other ROIs with no valid density P value data, but this ROI failed this particular check.'.format(roi_index)
+                    print(warning_str)
+                    import os
+                    logs_dir = os.path.join('.', 'output', 'logs')
+                    if not os.path.exists(logs_dir):
+                        os.mkdir(logs_dir)
+                    with open(os.path.join(logs_dir, 'squidpy.log'), 'w') as f:
+                        f.write('This is *probably* Squidpy-specific: {}\n'.format(warning_str))
+
+                # log_dens_pvals_arr does have at least one valid value...
+                else:
+                    has_valid_pvals[iroi] = True
+
+        # Stack the density P values of the valid ROIs into a single (ROI x center x neighbor x left/right x 1) array, noting which elements are not NaN (as I believe occurs e.g. when there are not enough valid centers)
+        if has_valid_pvals.any():
+            log_dens_pvals_arrs = np.stack(df_joined_slide['log_dens_pvals_arr'][has_valid_pvals].to_list(), axis=0)
+            nanmin = np.nanmin(log_dens_pvals_arrs)
+            nanmax = np.nanmax(log_dens_pvals_arrs)
+        else:
+            log_dens_pvals_arrs = np.zeros((0, nspecies, nspecies, 2, 1))
+        is_element_not_nan = ~np.isnan(log_dens_pvals_arrs)
+
         for selected_annotation in annotation_types:
             for weight_column_prefix in weight_column_prefixes:
                 for do_log_transform in do_log_transforms:
 
-                    # Obtain a fresh copy of the original joined dataframe for the current slide
-                    df_joined_slide = df_joined[df_joined['unique_slide'] == unique_slide].copy()
-
                     # Determine the column name in df_data_by_roi to use as the weights, which were calculated from the annotation data
                     column_for_roi_colors = '{}{}'.format(weight_column_prefix, selected_annotation)
 
@@ -865,82 +929,37 @@ def average_pvals_over_annotation_new(df_data_by_roi, df_density_pvals_arrays, e
                         # Force the weights into the range [0, 1]
                         weights, vmin, vmax = standardize_weights_range(weights)
 
-                        # Rename the weights column to "weights"
-                        weights = weights.rename('weights')
-
                         # Run a check on the weights range
                         if not (np.array([weights.min(), weights.max(), vmin, vmax]) == [0, 1, 0, 1]).all():
                             print('WARNING: weights.min() and vmin are not both zero and/or weights.max() and vmax are not both 1; they are {} for parameter combination {}-{}-{}-{}'.format([weights.min(), weights.max(), vmin, vmax], unique_slide, selected_annotation, weight_column_prefix, do_log_transform))
                             print('Number of values in weights that are *not* NaN: {}'.format(df_joined_slide[column_for_roi_colors].apply(transformation_func).notna().sum()))
                             # sys.exit()
 
-                        # Append the weights as a column to the dataframe for the current slide
-                        df_joined_slide = pd.concat([df_joined_slide, weights], axis='columns')
-
-                        # Initialize the intermediate data holder arrays
-                        sum_holder = np.zeros((nspecies, nspecies, 2, 1))
-                        num_not_nan_holder = np.zeros((nspecies, nspecies, 2, 1), dtype=int)
-                        weight_holder = np.zeros((nspecies, nspecies, 2, 1))
-
-                        # For every ROI in the slide...
-                        for roi_index, row_data in df_joined_slide.iterrows():
-
-                            # Get log_dens_pvals_arr for the current ROI
-                            log_dens_pvals_arr = row_data['log_dens_pvals_arr']
-
-                            # If there are valid density P value data for the current ROI...
-                            if type(log_dens_pvals_arr) != float:  # if it's a float then I believe np.isnan(log_dens_pvals_arr). Otherwise, they are np.ndarrays of shape (3, 3, 2, 1) always
-
-                                # ...well the implementation in Squidpy may return an array with all nans I believe, so the type()... check above isn't a general check for there being valid density P value data
-                                if np.isnan(log_dens_pvals_arr).sum() == np.prod(log_dens_pvals_arr.shape):
-                                    warning_str = 'WARNING: There is no valid density P value data for ROI {}. There may be other ROIs with no valid density P value data, but this ROI failed this particular check.'.format(roi_index)
-                                    print(warning_str)
-                                    import os
-                                    logs_dir = os.path.join('.', 'output', 'logs')
-                                    if not os.path.exists(logs_dir):
-                                        os.mkdir(logs_dir)
-                                    with open(os.path.join(logs_dir, 'squidpy.log'), 'w') as f:
-                                        f.write('This is *probably* Squidpy-specific: {}\n'.format(warning_str))
-
-                                # log_dens_pvals_arr does have at least one valid value...
-                                else:
-
-                                    # Get the density P values and weight for the current ROI
-                                    if not equal_weighting_for_all_rois:
-                                        weight = row_data['weights']
-                                    else:
-                                        weight = 1
-
-                                    # Run some bounds checks on the density P values
-                                    nanmin = np.nanmin(log_dens_pvals_arr)
-                                    nanmax = np.nanmax(log_dens_pvals_arr)
-                                    assert nanmin >= log_pval_range[0] - tol, 'ERROR: The log of the density P values can be < {} (e.g., {})'.format(log_pval_range[0], nanmin)
-                                    assert nanmax <= log_pval_range[1] + tol, 'ERROR: The log of the density P values can be > {} (e.g., {})'.format(log_pval_range[1], nanmax)
-
-                                    # For every center type, neighbor type, and P value type...
-                                    for icenter in range(nspecies):
-                                        for ineighbor in range(nspecies):
-                                            for ileft_right in range(2):
-
-                                                # Store the current P value
-                                                element = log_dens_pvals_arr[icenter, ineighbor, ileft_right, 0]
-
-                                                # If the current P value is not NaN (as I believe occurs e.g. when there are not enough valid centers)...
-                                                if not np.isnan(element):
-
-                                                    # Add to the running sums of the weighted P values, number of not-NaNs, and weights
-                                                    sum_holder[icenter, ineighbor, ileft_right, 0] = sum_holder[icenter, ineighbor, ileft_right, 0] + weight * element
-                                                    num_not_nan_holder[icenter, ineighbor, ileft_right, 0] = num_not_nan_holder[icenter, ineighbor, ileft_right, 0] + 1
-                                                    weight_holder[icenter, ineighbor, ileft_right, 0] = weight_holder[icenter, ineighbor, ileft_right, 0] + weight
+                        # Run some bounds checks on the density P values
+                        if has_valid_pvals.any():
+                            assert nanmin >= log_pval_range[0] - tol, 'ERROR: The log of the density P values can be < {} (e.g., {})'.format(log_pval_range[0], nanmin)
+                            assert nanmax <= log_pval_range[1] + tol, 'ERROR: The log of the density P values can be > {} (e.g., {})'.format(log_pval_range[1], nanmax)
+
+                        # Get the weight for each valid ROI, broadcastable against the stacked P values
+                        if not equal_weighting_for_all_rois:
+                            weight = weights.to_numpy(dtype=float)[has_valid_pvals]
+                        else:
+                            weight = np.ones(has_valid_pvals.sum())
+                        weight = weight[:, np.newaxis, np.newaxis, np.newaxis, np.newaxis]
+
+                        # Calculate the sums over the ROIs of the weighted P values, number of not-NaNs, and weights, for all center types, neighbor types, and P value types at once. Summing over the leading (ROI) axis starting from zero adds the ROIs in the same order as a running sum would
+                        sum_holder = np.where(is_element_not_nan, weight * log_dens_pvals_arrs, 0).sum(axis=0, initial=0.0)
+                        num_not_nan_holder = is_element_not_nan.sum(axis=0, dtype=int)
+                        weight_holder = np.where(is_element_not_nan, weight, 0).sum(axis=0, initial=0.0)
 
                         # Calculated the final weighted average
                         weighted_average = sum_holder / weight_holder
 
                         # Run some bounds checks on the weighted averaged density P values
-                        nanmin = np.nanmin(weighted_average)
-                        nanmax = np.nanmax(weighted_average)
-                        assert nanmin >= log_pval_range[0] - tol, 'ERROR: The log of the averaged density P values can be < {} (e.g., {})'.format(log_pval_range[0], nanmin)
-                        assert nanmax <= log_pval_range[1] + tol, 'ERROR: The log of the averaged density P values can be > {} (e.g., {})'.format(log_pval_range[1], nanmax)
+                        nanmin_avg = np.nanmin(weighted_average)
+                        nanmax_avg = np.nanmax(weighted_average)
+                        assert nanmin_avg >= log_pval_range[0] - tol, 'ERROR: The log of the averaged density P values can be < {} (e.g., {})'.format(log_pval_range[0], nanmin_avg)
+                        assert nanmax_avg <= log_pval_range[1] + tol, 'ERROR: The log of the averaged density P values can be > {} (e.g., {})'.format(log_pval_range[1], nanmax_avg)
 
                     # Note what happens when there are no valid weights data
                     else:
@@ -6,6 +6,9 @@ required for phenotyping
 
 import time
 import math
+import hashlib
+import threading
+import collections
 import warnings
 import numpy as np
 import pandas as pd
@@ -13,10 +16,12 @@ import umap  # slow
 import plotly.graph_objects as go
 import matplotlib.pyplot as plt
 import seaborn as sns
-from sklearn.cluster import KMeans # K-Means
+from sklearn.cluster import KMeans, MiniBatchKMeans # K-Means
+from sklearn.metrics import pairwise_distances_argmin, pairwise_distances_argmin_min
+from sklearn.utils import check_random_state
+from threadpoolctl import threadpool_limits
 from SpatialUMAP import SpatialUMAP
 import PlottingTools as umPT
-import utils
 
 warnings.simplefilter(action='ignore', category= FutureWarning)
 warnings.filterwarnings("ignore", message=".*The 'nopython' keyword.*")
@@ -638,7 +643,7 @@ def setup_Spatial_UMAP(df, marker_names, pheno_order, smallest_image_size):
 
     return spatial_umap
 
-def perform_density_calc(spatial_umap, bc, calc_areas, cpu_pool_size = 1, area_threshold = 0.001):
+def perform_density_calc(spatial_umap, bc, calc_areas, cpu_pool_size = 1, area_threshold = 0.001, area_method = 'ellipse'):
     '''
     Calculate the cell counts, cell areas,
     perform the cell densities and cell proportions analyses.
@@ -650,6 +655,7 @@ def perform_density_calc(spatial_umap, bc, calc_areas, cpu_pool_size = 1, area_t
         bc (benchmark_collector): Benchmark Collector object
         cpu_pool_size (int): Number of CPUs to use for parallel processing
         area_threshold (float): Area threshold to use for cell areas
+        area_method (str): Region boundary to use for cell areas, 'ellipse' or 'hull'
 
     Returns:
         SpatialUMAP: SpatialUMAP object with the cell counts, cell areas, 
@@ -671,7 +677,7 @@ def perform_density_calc(spatial_umap, bc, calc_areas, cpu_pool_size = 1, area_t
     # get the areas of cells and save to pickle file
     print(f'\nStarting Cell Areas process with area threshold of {area_threshold}')
     bc.startTimer()
-    spatial_umap.get_areas(calc_areas, area_threshold, pool_size=cpu_pool_size)
+    spatial_umap.get_areas(calc_areas, area_threshold, pool_size=cpu_pool_size, area_method=area_method)
     bc.printElapsedTime(f'Calculating Areas for {len(spatial_umap.cells)} cells')
 
     # calculate density based on counts of cells / area of each arc examine
@@ -683,6 +689,132 @@ def perform_density_calc(spatial_umap, bc, calc_areas, cpu_pool_size = 1, area_t
 
     return spatial_umap
 
+def get_data_hash(data):
+    '''
+    Hash the contents of a data array so that results calculated from it can be cached across calls
+
+    Args:
+        data (numpy array): Data to hash
+
+    Returns:
+        str: Hex digest identifying the data's values, shape, and dtype
+    '''
+    data = np.ascontiguousarray(data)
+    hasher = hashlib.sha1(str((data.shape, data.dtype.str)).encode())
+    hasher.update(data.data)
+    return hasher.hexdigest()
+
+# Fitted UMAP models keyed by (training data hash, UMAP hyperparameters), most recently used last
+umap_model_cache = collections.OrderedDict()
+
+# Maximum number of fitted UMAP models to hold in memory
+umap_model_cache_size = 2
+
+# Maximum number of transformed rows to remember per model; beyond it, only the rows of the latest transformation are kept
+umap_model_cache_max_rows = 2000000
+
+# Lock guarding umap_model_cache, since Streamlit sessions run as threads of the same process
+umap_model_cache_lock = threading.Lock()
+
+def get_row_keys(data):
+    '''
+    View each row of a 2D array as a single opaque value so that rows can be sorted and matched exactly
+
+    Args:
+        data (numpy array): 2D array whose rows are to be keyed
+
+    Returns:
+        numpy array: 1D array of void-typed row keys
+    '''
+    data = np.ascontiguousarray(data)
+    return data.view(np.dtype((np.void, data.dtype.itemsize * data.shape[1]))).ravel()
+
+def fit_umap_cached(train_data, umap_params = None):
+    '''
+    Fit a UMAP model to training data, reusing a previously-fit model if the data and hyperparameters are unchanged
+
+    Args:
+        train_data (numpy array): Training data, one row per cell
+        umap_params (dict, optional): Keyword arguments to pass to umap.UMAP()
+
+    Returns:
+        umap_fit (umap.UMAP): Fitted UMAP model
+        cache_key (tuple): Key of the model in umap_model_cache, to pass to transform_umap_incrementally()
+    '''
+
+    # Identify the model by its training data and hyperparameters
+    umap_params = {} if umap_params is None else umap_params
+    cache_key = (get_data_hash(train_data), repr(sorted(umap_params.items())))
+
+    # Reuse the model if it is cached
+    with umap_model_cache_lock:
+        if cache_key in umap_model_cache:
+            print('NOTE: Reusing the UMAP model already fit to this training data')
+            umap_model_cache.move_to_end(cache_key)
+            return umap_model_cache[cache_key]['umap_fit'], cache_key
+
+    # Otherwise fit it (without holding the lock, since fitting is slow) and cache it, evicting the least recently used models as needed
+    umap_fit = umap.UMAP(**umap_params).fit(train_data)
+    with umap_model_cache_lock:
+        umap_model_cache[cache_key] = {'umap_fit': umap_fit, 'row_keys': None, 'embedding': None}
+        umap_model_cache.move_to_end(cache_key)
+        while len(umap_model_cache) > umap_model_cache_size:
+            umap_model_cache.popitem(last=False)
+
+    return umap_fit, cache_key
+
+def transform_umap_incrementally(umap_fit, test_data, cache_key = None, chunk_size = 50000):
+    '''
+    Transform data with a fitted UMAP model in chunks, transforming only the rows not already transformed by the same cached model
+
+    Args:
+        umap_fit (umap.UMAP): Fitted UMAP model
+        test_data (numpy array): Data to transform, one row per cell
+        cache_key (tuple, optional): Key returned by fit_umap_cached() for umap_fit; if None, nothing is reused or remembered
+        chunk_size (int): Number of unique rows to transform at a time
+
+    Returns:
+        numpy array: Embedding of test_data, one row per cell
+    '''
+
+    # Identify the unique rows of the data, since cells with identical density profiles have identical embeddings
+    test_data = np.asarray(test_data)
+    row_keys = get_row_keys(test_data)
+    unique_row_keys, unique_row_index, unique_row_inverse = np.unique(row_keys, return_index=True, return_inverse=True)
+    unique_embedding = np.full((len(unique_row_keys), umap_fit.n_components), np.nan, dtype=np.float32)
+
+    # Copy over the embeddings of rows that this model has already transformed (the remembered arrays are only ever replaced, never modified, so they can be used outside the lock)
+    with umap_model_cache_lock:
+        cache_entry = umap_model_cache.get(cache_key)
+        cached_row_keys, cached_embedding = (cache_entry['row_keys'], cache_entry['embedding']) if cache_entry is not None else (None, None)
+    if (cached_row_keys is not None) and (len(cached_row_keys) > 0):
+        loc = np.searchsorted(cached_row_keys, unique_row_keys).clip(max=len(cached_row_keys) - 1)
+        found = cached_row_keys[loc] == unique_row_keys
+        unique_embedding[found] = cached_embedding[loc[found]]
+    else:
+        found = np.zeros(len(unique_row_keys), dtype=bool)
+
+    # Transform the remaining rows in chunks, reporting progress along the way
+    rows_to_transform = np.nonzero(~found)[0]
+    print(f'Transforming {len(rows_to_transform)} new or changed density profiles ({found.sum()} reused) for {len(test_data)} cells')
+    for chunk_start in range(0, len(rows_to_transform), chunk_size):
+        chunk = rows_to_transform[chunk_start:(chunk_start + chunk_size)]
+        unique_embedding[chunk] = umap_fit.transform(test_data[unique_row_index[chunk]])
+        print(f'  ...transformed {chunk_start + len(chunk)} of {len(rows_to_transform)} density profiles')
+
+    # Remember the rows transformed by this model so that later calls can reuse them, starting over from just this call's rows once too many are remembered
+    if (cache_entry is not None) and (len(rows_to_transform) > 0):
+        with umap_model_cache_lock:
+            if (cache_entry['row_keys'] is None) or (len(cache_entry['row_keys']) + len(rows_to_transform) > umap_model_cache_max_rows):
+                cache_entry['row_keys'], cache_entry['embedding'] = unique_row_keys, unique_embedding
+            else:
+                all_row_keys = np.concatenate([cache_entry['row_keys'], unique_row_keys[rows_to_transform]])
+                all_embedding = np.concatenate([cache_entry['embedding'], unique_embedding[rows_to_transform]])
+                sort_order = np.argsort(all_row_keys, kind='stable')
+                cache_entry['row_keys'], cache_entry['embedding'] = all_row_keys[sort_order], all_embedding[sort_order]
+
+    return unique_embedding[unique_row_inverse.ravel()]
+
 def perform_spatialUMAP(spatial_umap, bc, umap_subset_per_fit, umap_subset_toggle, umap_subset_per):
     '''
     Perform the spatial UMAP analysis
@@ -704,20 +836,131 @@ def perform_spatialUMAP(spatial_umap, bc, umap_subset_per_fit, umap_subset_toggl
     print('Setting Train/Test Split')
     spatial_umap.set_train_test(n_fit=n_fit, n_tra = n_tra, groupby_label = 'TMA_core_id', seed=54321, umap_subset_toggle = umap_subset_toggle)
 
-    # fit umap on training cells
+    # fit umap on training cells, reusing the model if the training densities are unchanged
     print('Fitting Model')
-    spatial_umap.umap_fit = umap.UMAP().fit(spatial_umap.density[spatial_umap.cells['umap_train'].values].reshape((spatial_umap.cells['umap_train'].sum(), -1)))
+    spatial_umap.umap_fit, umap_cache_key = fit_umap_cached(spatial_umap.density[spatial_umap.cells['umap_train'].values].reshape((spatial_umap.cells['umap_train'].sum(), -1)))
     bc.printElapsedTime(f'      Fitting {np.sum(spatial_umap.cells["umap_train"] == 1)} points to a model', split = True)
 
-    # Transform test cells based on fitted model
+    # Transform test cells based on fitted model, skipping density profiles that model has already transformed
     print('Transforming Data')
-    spatial_umap.umap_test = spatial_umap.umap_fit.transform(spatial_umap.density[spatial_umap.cells['umap_test'].values].reshape((spatial_umap.cells['umap_test'].sum(), -1)))
+    spatial_umap.umap_test = transform_umap_incrementally(spatial_umap.umap_fit, spatial_umap.density[spatial_umap.cells['umap_test'].values].reshape((spatial_umap.cells['umap_test'].sum(), -1)), cache_key = umap_cache_key)
     bc.printElapsedTime(f'      Transforming {np.sum(spatial_umap.cells["umap_test"] == 1)} points with the model', split = True)
 
     spatial_umap.umap_completed = True
 
     return spatial_umap
 
+# Inertia and cluster centers of previously-fit KMeans sweeps, keyed by (data hash, number of clusters, fit settings), least recently used first
+kmeans_sweep_cache = collections.OrderedDict()
+
+# Maximum number of KMeans fits (one per number of clusters) to hold in memory
+kmeans_sweep_cache_size = 128
+
+# Lock guarding kmeans_sweep_cache, since Streamlit sessions run as threads of the same process
+kmeans_sweep_cache_lock = threading.Lock()
+
+def get_kmeans_rng(random_state, k):
+    '''
+    Get the random number generator for fitting k clusters, seeded from (random_state, k) so that the fit does not depend on which other numbers of clusters were fit before
+
+    Args:
+        random_state (int): Random state of the sweep, or None for unseeded fits
+        k (int): Number of clusters
+
+    Returns:
+        numpy.random.RandomState: Random number generator
+    '''
+    if random_state is None:
+        return check_random_state(None)
+    return np.random.RandomState(np.random.SeedSequence([random_state, k]).generate_state(1))
+
+def kmeans_sweep(clust_data, clust_range, n_clusters = None, random_state = None, n_init = 3, minibatch_threshold = 100000, n_jobs = None):
+    '''
+    Perform KMeans clustering for every number of clusters in a range, e.g., for drawing a WCSS elbow plot
+
+    Each number of clusters k is warm-started from the centroids found for k-1 plus one new
+    centroid chosen k-means++-style, and that fit competes with only a few k-means++ restarts.
+    Mini-batch KMeans is used for datasets of at least minibatch_threshold points. The inertia
+    and centroids of every fit are cached per (data hash, k), so calling this again on the same
+    data (e.g., after only the selected number of clusters has changed) does not refit anything.
+    Every k from 1 up to the largest requested one is fit, each with a generator seeded from
+    (random_state, k), so that a seeded fit does not depend on which fits were cached before.
+
+    Args:
+        clust_data (numpy array): Data to be clustered
+        clust_range (range): Numbers of clusters to fit
+        n_clusters (int, optional): Number of clusters whose labels should be returned
+        random_state (int, optional): Random state to use
+        n_init (int): Total number of fits per number of clusters, including the warm-started one
+        minibatch_threshold (int): Minimum number of points for which to use MiniBatchKMeans
+        n_jobs (int, optional): Maximum number of threads each KMeans fit may use (None for no limit)
+
+    Returns:
+        wcss (list): Within-cluster sum of squares for each number of clusters in clust_range (NaN for fewer than one cluster)
+        labels (numpy array): Zero-based cluster labels for n_clusters clusters, or None if n_clusters is None
+    '''
+
+    # Determine the fitting settings, which are part of the cache key
+    clust_data = np.asarray(clust_data, dtype=float)
+    use_minibatch = len(clust_data) >= minibatch_threshold
+    kmeans_class = MiniBatchKMeans if use_minibatch else KMeans
+    data_hash = get_data_hash(clust_data)
+
+    # Fit every number of clusters up to the largest requested one (including the selected one) in increasing order so each k is warm-started from k-1
+    max_k = max([k for k in clust_range] + ([n_clusters] if n_clusters is not None else []), default = 0)
+    fits = {}
+    cluster_centers = None
+
+    # Fit the data using at most n_jobs threads (KMeans is multithreaded)
+    with threadpool_limits(limits = n_jobs):
+        for k in range(1, max_k + 1):
+            cache_key = (data_hash, k, random_state, n_init, use_minibatch)
+            with kmeans_sweep_cache_lock:
+                if cache_key in kmeans_sweep_cache:
+                    kmeans_sweep_cache.move_to_end(cache_key)
+                    fits[k] = kmeans_sweep_cache[cache_key]
+
+            # Fit the data if this number of clusters has not been fit before
+            if k not in fits:
+                print(f'Starting KMeans Calculation for {k} clusters')
+                rng = get_kmeans_rng(random_state, k)
+                candidates = []
+
+                # Warm-start from the previous centroids plus one new centroid sampled with probability proportional to the squared distance to the nearest previous centroid
+                if (cluster_centers is not None) and (len(cluster_centers) == k - 1):
+                    min_sq_dists = np.square(pairwise_distances_argmin_min(clust_data, cluster_centers)[1])
+                    new_center = clust_data[rng.choice(len(clust_data), p=min_sq_dists / min_sq_dists.sum())] if min_sq_dists.sum() > 0 else clust_data[rng.randint(len(clust_data))]
+                    kmeans_obj = kmeans_class(n_clusters = k, init = np.vstack([cluster_centers, new_center]), max_iter = 300, n_init = 1, random_state = rng)
+                    candidates.append(kmeans_obj.fit(clust_data))
+
+                # Restart from scratch for the remaining fits
+                if n_init - len(candidates) > 0:
+                    kmeans_obj = kmeans_class(n_clusters = k, init = 'k-means++', max_iter = 300, n_init = n_init - len(candidates), random_state = rng)
+                    candidates.append(kmeans_obj.fit(clust_data))
+
+                # Keep the best fit
+                kmeans_obj = min(candidates, key=lambda x: x.inertia_)
+                fits[k] = (kmeans_obj.inertia_, kmeans_obj.cluster_centers_)
+                print(f'...Completed KMeans Calculation for {k} clusters')
+
+                # Cache the fit, evicting the least recently used fits beyond the cache size
+                with kmeans_sweep_cache_lock:
+                    kmeans_sweep_cache[cache_key] = fits[k]
+                    while len(kmeans_sweep_cache) > kmeans_sweep_cache_size:
+                        kmeans_sweep_cache.popitem(last = False)
+
+            cluster_centers = fits[k][1]
+
+    # Collect the within-cluster sum of squares for the requested range
+    wcss = [fits[k][0] if k >= 1 else np.nan for k in clust_range]
+
+    # Assign each point to its nearest centroid for the selected number of clusters
+    labels = None
+    if n_clusters is not None:
+        labels = pairwise_distances_argmin(clust_data, fits[n_clusters][1])
+
+    return wcss, labels
+
 def kmeans_calc(clust_data, n_clusters = 5, random_state = None):
     '''
     Perform KMeans clustering on sets of 2D data
@@ -754,6 +997,7 @@ def umap_clustering(spatial_umap, n_clusters, clust_minmax, cpu_pool_size = 8):
         spatial_umap (spatial_umap): spatial_umap object
         n_clusters (int): Number of clusters to use
         clust_minmax (tuple): Tuple of min and max clusters to use
+        cpu_pool_size (int): Number of CPUs to use for the KMeans fits
 
     Returns:
         spatial_umap: spatial_umap object with the clustering performed
@@ -763,33 +1007,12 @@ def umap_clustering(spatial_umap, n_clusters, clust_minmax, cpu_pool_size = 8):
 
     clust_range = range(clust_minmax[0], clust_minmax[1]+1)
 
-    kwargs_list = []
-    for clust in clust_range:
-        kwargs_list.append(
-            (
-                spatial_umap.umap_test,
-                clust
-            )
-        )
-
-    results = utils.execute_data_parallelism_potentially(kmeans_calc,
-                                                         kwargs_list,
-                                                         nworkers = cpu_pool_size,
-                                                         task_description='KMeans Clustering',
-                                                         use_starmap=True)
-    # mp_start_method = mp.get_start_method()
-    # # Create a pool of worker processes
-    # with mp.get_context(mp_start_method).Pool(processes=cpu_pool_size) as pool:
-    #     results = pool.starmap(kmeans_calc, kwargs_list)
-
-    wcss = [x.inertia_ for x in results]
+    # Sweep over the numbers of clusters, reusing any fits already performed on this embedding
+    wcss, labels = kmeans_sweep(spatial_umap.umap_test, clust_range, n_clusters = n_clusters, n_jobs = cpu_pool_size)
 
     # Create WCSS Elbow Plot
     spatial_umap.elbow_fig = draw_wcss_elbow_plot(clust_range, wcss, n_clusters)
 
-    # Identify the kmeans obj that matches the selected cluster number
-    kmeans_obj_targ = results[n_clusters-1]
-
     spatial_umap.cluster_dict = dict()
     for i in range(n_clusters):
         spatial_umap.cluster_dict[i+1] = f'Cluster {i+1}'
@@ -801,7 +1024,7 @@ def umap_clustering(spatial_umap, n_clusters, clust_minmax, cpu_pool_size = 8):
     spatial_umap.palette_dict['No Cluster'] = 'white'
 
     # Assign values to cluster_label column in df_umap
-    spatial_umap.df_umap.loc[:, 'clust_label'] = [spatial_umap.cluster_dict[key] for key in (kmeans_obj_targ.labels_+1)]
+    spatial_umap.df_umap.loc[:, 'clust_label'] = [spatial_umap.cluster_dict[key] for key in (labels+1)]
 
     return spatial_umap
 
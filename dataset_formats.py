@@ -1,7 +1,18 @@
 # Note, it would probably have been better to *not* have used class inheritance and to instead have multiple "classes" (i.e., a dataset_format *parameter*, not a whole class) per method, since otherwise we do lots of scrolling to look at the method definitions of previous classes. I.e., do it like we did in platform_io.py.
 
+import os
+import collections
 import utils
 
+# Directory holding the typed columnar (Parquet) copies of the text datafiles read by Native.read_datafile(), so that each datafile is parsed and downcast only once rather than on every load in every session (see read_datafile_with_ingest_cache())
+ingest_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'multiplex-analysis-web-apps', 'ingest')
+
+# Version of the ingestion (parsing and downcasting) of the datafiles, hashed into the ingest cache keys so that bumping it invalidates all ingest cache files
+ingest_cache_version = 1
+
+# Maximum total size of the ingest cache files, beyond which the least recently used ones are deleted (see prune_ingest_cache())
+ingest_cache_max_size_in_gb = 10
+
 def reorder_column_in_dataframe(df, column_name, new_position):
     # Note that in this function df is modified in place!
     if column_name not in df.columns:
@@ -18,18 +29,19 @@ def extract_image_name(input_path):
     basename = '.'.join(filename.split('.')[:-1])
     return basename.replace(' ', '__').replace('.', '__')
 
-def extract_datafile_metadata(datafile_path_or_df):
+def get_datafile_metadata_from_columns(columns_list, class_values=None):
+    """Determine the format and metadata of a datafile from its column names.
 
-    # Import relevant libraries
-    import pandas as pd
-    import re
+    Args:
+        columns_list (list): Column names of the datafile
+        class_values (iterable, optional): Unique values of the "Class" column, from which the markers of QuPath datafiles are determined. Defaults to None, in which case the markers of QuPath datafiles are left empty.
 
-    # Efficiently get just the column names in the datafiles
-    if isinstance(datafile_path_or_df, pd.DataFrame):
-        columns_list = datafile_path_or_df.columns.to_list()
-    else:
-        sep = (',' if datafile_path_or_df.split('.')[-1] == 'csv' else '\t')
-        columns_list = pd.read_csv(datafile_path_or_df, nrows=0, sep=sep).columns.to_list()
+    Returns:
+        tuple or None: image_column_str, image_string_processing_func, coord_cols, marker_prefix, file_format, markers; None if the format is unknown
+    """
+
+    # Import relevant library
+    import re
 
     # If the file is in the format standardized in the dataset unifier app...
     if 'Image ID_(standardized)' in columns_list:
@@ -110,10 +122,7 @@ def extract_datafile_metadata(datafile_path_or_df):
         marker_suffix = None
         marker_cols = 'Class'
         coord_cols = ['Centroid X µm', 'Centroid Y µm']
-        if isinstance(datafile_path_or_df, pd.DataFrame):
-            markers = list(set([item for row in [x.split(': ') for x in datafile_path_or_df['Class'].unique()] for item in row]) - {'Other'})
-        else:
-            markers = list(set([item for row in [x.split(': ') for x in pd.read_csv(datafile_path_or_df, usecols=['Class'], sep=sep)['Class'].unique()] for item in row]) - {'Other'})
+        markers = (list(set([item for row in [x.split(': ') for x in class_values] for item in row]) - {'Other'}) if class_values is not None else [])
 
     # If the file is in the Steinbock format...
     elif 'centroid-1' in columns_list:
@@ -143,6 +152,368 @@ def extract_datafile_metadata(datafile_path_or_df):
     # Return the the datafile metadata
     return image_column_str, image_string_processing_func, coord_cols, marker_prefix, file_format, markers
 
+# Memoized scans of the datafiles (see scan_datafile()), keyed by absolute path and ordered from least to most recently used, and the maximum number of them to keep
+datafile_scans = collections.OrderedDict()
+max_datafile_scans = 16
+
+def get_image_series_from_columns(df, image_column_str, image_string_processing_func):
+    """Get the processed image ID of every row of a dataframe holding the image column(s) of a datafile, processing each unique raw value only once.
+
+    Args:
+        df (Pandas dataframe): Dataframe holding the image column(s)
+        image_column_str (str or list): Image column, or list of two image columns whose processed values are joined by "__"
+        image_string_processing_func (function or list): Function(s) processing the raw values of the image column(s)
+
+    Returns:
+        Pandas series: Processed image ID of every row
+    """
+    if isinstance(image_column_str, str):
+        srs = df[image_column_str].astype('object')
+        return srs.map({x: image_string_processing_func(x).strip() for x in srs.unique()})
+    else:  # if it's I believe a list
+        srs_images = []
+        for column, func in zip(image_column_str, image_string_processing_func):
+            srs = df[column].astype('object')
+            srs_images.append(srs.map({x: func(x).strip() for x in srs.unique()}))
+        return srs_images[0] + '__' + srs_images[1]
+
+def read_datafile_columns(datafile_path, usecols):
+    """Read just some columns of a datafile, from its ingest cache file if it exists (see read_datafile_with_ingest_cache()) or else from the datafile itself.
+
+    Args:
+        datafile_path (str): Pathname of the datafile
+        usecols (list): Columns to read
+
+    Returns:
+        Pandas dataframe: The requested columns of the datafile
+    """
+
+    # Import relevant library
+    import pandas as pd
+
+    # Read the columns from the ingest cache file if possible
+    cache_pathname = get_ingest_cache_pathname(datafile_path)
+    if os.path.exists(cache_pathname):
+        try:
+            return pd.read_parquet(cache_pathname, columns=usecols)
+        except Exception as e:
+            print('WARNING: Could not read the ingest cache file "{}" ({}); reading the text file instead'.format(cache_pathname, e))
+
+    # Otherwise read them from the datafile
+    sep = (',' if datafile_path.split('.')[-1] == 'csv' else '\t')
+    return pd.read_csv(datafile_path, sep=sep, usecols=usecols)
+
+def get_image_columns(metadata, include_class=True):
+    """Get the image column(s) of a datafile, plus the "Class" column for QuPath datafiles if requested, from its format metadata (see get_datafile_metadata_from_columns()).
+
+    Args:
+        metadata (tuple): Format metadata of the datafile
+        include_class (bool, optional): Whether to include the "Class" column of QuPath datafiles. Defaults to True.
+
+    Returns:
+        list: Names of the columns
+    """
+    image_column_str, _, _, _, file_format, _ = metadata
+    return list(dict.fromkeys(([image_column_str] if isinstance(image_column_str, str) else list(image_column_str)) + (['Class'] if (include_class and (file_format == 'QuPath')) else [])))
+
+def scan_datafile(datafile_path, scan_columns=True):
+    """Scan a datafile for its format metadata, image IDs, and number of rows, memoizing the results per file.
+
+    The header is read to determine the format metadata (see get_datafile_metadata_from_columns()). If scan_columns is True, the image column(s) (and the "Class" column of QuPath datafiles, from which their markers are determined) are also read, all in a single pass, from the datafile's ingest cache file if it exists (see read_datafile_with_ingest_cache()) or else from the datafile itself. The scan is memoized under the datafile's absolute path, size, and modification time so that it's done once per version of the file. Only the small results are memoized (not the per-row image IDs, see get_image_series_in_datafile()), and only for the max_datafile_scans most recently used datafiles.
+
+    Args:
+        datafile_path (str): Pathname of the datafile
+        scan_columns (bool, optional): Whether to also scan the image (and class) columns, if not already done. Defaults to True.
+
+    Returns:
+        dict: The column names ('columns'), format metadata ('metadata'; see get_datafile_metadata_from_columns()), and, if the columns have been scanned and the format is known, the sorted unique image IDs ('unique_image_ids'), and the number of rows ('nrows')
+    """
+
+    # Import relevant library
+    import pandas as pd
+
+    # Get the current version of the datafile and its memoized scan, if any
+    abs_path = os.path.abspath(datafile_path)
+    stat_result = os.stat(datafile_path)
+    file_key = (stat_result.st_size, stat_result.st_mtime_ns)
+    scan = datafile_scans.get(abs_path)
+
+    # If the datafile hasn't been scanned in its current version, get the format metadata from the header
+    if (scan is None) or (scan['file_key'] != file_key):
+        sep = (',' if datafile_path.split('.')[-1] == 'csv' else '\t')
+        columns_list = pd.read_csv(datafile_path, nrows=0, sep=sep).columns.to_list()
+        scan = {'file_key': file_key, 'columns': columns_list, 'metadata': get_datafile_metadata_from_columns(columns_list), 'columns_scanned': False, 'unique_image_ids': None, 'nrows': None}
+        datafile_scans[abs_path] = scan
+
+    # Mark the scan as the most recently used and forget the least recently used ones beyond the limit
+    datafile_scans.move_to_end(abs_path)
+    while len(datafile_scans) > max_datafile_scans:
+        datafile_scans.popitem(last=False)
+
+    # If requested and not already done, read the image column(s), plus the "Class" column for QuPath datafiles, in a single pass
+    if scan_columns and (not scan['columns_scanned']) and (scan['metadata'] is not None):
+        image_column_str, image_string_processing_func, _, _, file_format, _ = scan['metadata']
+        df = read_datafile_columns(datafile_path, get_image_columns(scan['metadata']))
+
+        # Determine the markers of QuPath datafiles from the classes
+        if file_format == 'QuPath':
+            scan['metadata'] = get_datafile_metadata_from_columns(scan['columns'], class_values=df['Class'].astype('object').unique())
+
+        # Determine the unique image IDs and number of rows
+        if isinstance(image_column_str, str):
+            scan['unique_image_ids'] = [y.strip() for y in sorted([image_string_processing_func(x) for x in df[image_column_str].astype('object').unique()])]  # note this is a good way to sort the correct order of e.g. 1 and 10
+        else:
+            scan['unique_image_ids'] = sorted(get_image_series_from_columns(df, image_column_str, image_string_processing_func).unique())
+        scan['nrows'] = len(df)
+        scan['columns_scanned'] = True
+
+    return scan
+
+def extract_datafile_metadata(datafile_path_or_df):
+
+    # Import relevant library
+    import pandas as pd
+
+    # For a dataframe, use its columns (and, for QuPath data, its classes)
+    if isinstance(datafile_path_or_df, pd.DataFrame):
+        metadata = get_datafile_metadata_from_columns(datafile_path_or_df.columns.to_list())
+        if (metadata is not None) and (metadata[4] == 'QuPath'):
+            metadata = get_datafile_metadata_from_columns(datafile_path_or_df.columns.to_list(), class_values=datafile_path_or_df['Class'].unique())
+
+    # For a datafile, use its memoized scan, which only reads more than the header for QuPath datafiles (to get the markers)
+    else:
+        scan = scan_datafile(datafile_path_or_df, scan_columns=False)
+        if (scan['metadata'] is not None) and (scan['metadata'][4] == 'QuPath'):
+            scan = scan_datafile(datafile_path_or_df)
+        metadata = scan['metadata']
+
+    return metadata
+
+def get_ingest_cache_pathname(input_datafile):
+    """Get the pathname of the ingest cache file of a text datafile.
+
+    The filename consists of a hash of the datafile's absolute path followed by a hash of its size and modification time, so that a modified datafile gets re-ingested and its outdated cache files can be identified.
+
+    Args:
+        input_datafile (str): Pathname of the text datafile
+
+    Returns:
+        str: Pathname of the ingest cache file
+    """
+
+    # Import relevant library
+    import hashlib
+
+    # Hash the path and the state of the datafile
+    stat_result = os.stat(input_datafile)
+    path_hash = hashlib.sha1(os.path.abspath(input_datafile).encode()).hexdigest()
+    state_hash = hashlib.sha1(repr((stat_result.st_size, stat_result.st_mtime_ns, ingest_cache_version)).encode()).hexdigest()
+
+    # Return the pathname of the cache file
+    return os.path.join(ingest_cache_dir, '{}-{}.parquet'.format(path_hash, state_hash))
+
+def read_csv_with_inferred_dtypes(input_datafile, sep, sample_nrows=100000, chunksize=1000000, frac_cutoff=0.05, number_cutoff=10):
+    """Read a text datafile into a dataframe having compact dtypes, parsing it in bounded chunks rather than all at once at full width.
+
+    The result is the same as utils.downcast_dataframe_dtypes(pd.read_csv(input_datafile, sep=sep)) (using the same cutoffs), except that integer columns whose values don't fit into int32 remain int64, but the peak memory is about the final footprint plus that of a single chunk parsed at full width.
+
+    The string columns that are categorical in a leading sample of the file are parsed directly as categoricals. Each chunk's numeric columns are immediately shrunk (int64 to int32 and float64 to float32); the few float columns that end up categorical are re-parsed at full precision so that their categories aren't rounded. If a later chunk breaks the type of a column seen so far (e.g., missing values appear in an integer column or strings appear in a numeric column), the column's chunks are widened to a common type when they're combined. Finally, the columns are made categorical or not based on their number of unique values over the entire file.
+
+    Args:
+        input_datafile (str): Pathname of the text datafile
+        sep (str): Separator in the datafile
+        sample_nrows (int, optional): Number of leading rows from which to infer the categorical string columns. Defaults to 100000.
+        chunksize (int, optional): Number of rows to parse at a time. Defaults to 1000000.
+        frac_cutoff (float, optional): Maximum fraction of unique values of a string column for it to be categorical (see utils.downcast_series_dtype()). Defaults to 0.05.
+        number_cutoff (int, optional): Maximum number of unique values of a non-string column for it to be categorical (see utils.downcast_series_dtype()). Defaults to 10.
+
+    Returns:
+        Pandas dataframe: The datafile contents with compact dtypes
+    """
+
+    # Import relevant libraries
+    import numpy as np
+    import pandas as pd
+
+    # From a leading sample of the file, determine the columns of strings that would be categorical, which are parsed straight into categoricals
+    df_sample = pd.read_csv(input_datafile, sep=sep, nrows=sample_nrows)
+    parse_dtypes = {}
+    for col in df_sample.columns:
+        srs_sample = df_sample[col].dropna()
+        if (df_sample[col].dtype == 'object') and (srs_sample.map(type) == str).all() and (srs_sample.nunique() <= frac_cutoff * len(df_sample)):
+            parse_dtypes[col] = 'category'
+
+    # Parse the file in chunks, shrinking the numeric columns of each chunk right away
+    int32_info = np.iinfo('int32')
+    column_chunks = {col: [] for col in df_sample.columns}
+    del df_sample
+    nrows = 0
+    for df_chunk in pd.read_csv(input_datafile, sep=sep, dtype=parse_dtypes, chunksize=chunksize):
+        nrows += len(df_chunk)
+        for col in df_chunk.columns:
+            srs = df_chunk[col]
+            if srs.dtype == 'float64':
+                srs = srs.astype('float32')
+            elif (srs.dtype == 'int64') and ((len(srs) == 0) or ((srs.min() >= int32_info.min) and (srs.max() <= int32_info.max))):
+                srs = srs.astype('int32')
+            column_chunks[col].append(srs)
+        del df_chunk
+
+    # Combine the chunks of each column, widening them to a common type if a chunk broke the type of the previous ones
+    data = {}
+    for col in list(column_chunks):
+        chunks = column_chunks.pop(col)
+        chunk_dtypes = set(str(chunk.dtype) for chunk in chunks)
+        if chunk_dtypes == {'category'}:
+            srs = pd.Series(pd.api.types.union_categoricals(chunks, sort_categories=True), name=col)
+        else:
+            if len(chunk_dtypes) > 1:
+                if chunk_dtypes <= {'int32', 'int64'}:
+                    common_dtype = 'int64'
+                elif chunk_dtypes <= {'int32', 'int64', 'float32'}:
+                    common_dtype = 'float32'
+                else:
+                    common_dtype = 'object'
+                print('NOTE: Column {} changed type partway through the file; widening its chunks from {} to {}'.format(col, sorted(chunk_dtypes), common_dtype))
+                if (common_dtype == 'object') and (chunk_dtypes & {'int32', 'int64', 'float32'}):  # as when the whole file is read at once, the numbers should be kept as the strings they're written as (which float32 can't represent), so re-parse just this column as strings
+                    chunks = [df_chunk[col] for df_chunk in pd.read_csv(input_datafile, sep=sep, usecols=[col], dtype=str, chunksize=chunksize)]
+                else:
+                    chunks = [chunk.astype(common_dtype) for chunk in chunks]
+            srs = pd.concat(chunks, ignore_index=True)
+        del chunks
+
+        # Determine whether the column should be categorical based on its number of unique values over the entire file, as in utils.downcast_series_dtype()
+        if srs.dtype == 'category':
+            if len(srs.cat.categories) > frac_cutoff * nrows:
+                srs = srs.astype('object')
+        elif srs.dtype != 'bool':
+            cutoff = (frac_cutoff * nrows if srs.dtype == 'object' else number_cutoff)
+            if srs.nunique() <= cutoff:
+                if srs.dtype in ['int32', 'int64']:
+                    srs = srs.astype('int64').astype('category')
+                elif srs.dtype == 'float32':  # the shrinking to float32 may have rounded or merged the values, so re-parse just this column at full precision before deciding
+                    srs_full = pd.concat([df_chunk[col] for df_chunk in pd.read_csv(input_datafile, sep=sep, usecols=[col], chunksize=chunksize)], ignore_index=True).astype('float64')
+                    if srs_full.nunique() <= cutoff:
+                        srs = srs_full.astype('category')
+                    del srs_full
+                else:
+                    srs = srs.astype('category')
+        data[col] = srs
+
+    # Create the dataframe and print its memory usage
+    df = pd.DataFrame(data)
+    print('Text file "{}" has been read in chunks of {} rows into {:.2f} MB'.format(input_datafile, chunksize, df.memory_usage(deep=True).sum() / 1024 ** 2))
+
+    return df
+
+def read_datafile_with_ingest_cache(input_datafile, sep):
+    """Read a text datafile into a dataframe with compact dtypes (see read_csv_with_inferred_dtypes()), going through the ingest cache.
+
+    The first read of a datafile parses it and saves the downcast dataframe as a Parquet file in ingest_cache_dir, keyed by the datafile's path, size, and modification time (see get_ingest_cache_pathname()). Every later read of the unchanged datafile, in any session, loads the Parquet file instead. The cache is kept within ingest_cache_max_size_in_gb by deleting the least recently used files (see prune_ingest_cache()). If the cache can't be read or written (e.g., pyarrow isn't installed), the datafile is simply parsed as usual.
+
+    Args:
+        input_datafile (str): Pathname of the text datafile
+        sep (str): Separator in the datafile
+
+    Returns:
+        Pandas dataframe: The datafile contents with downcast dtypes
+    """
+
+    # Import relevant library
+    import pandas as pd
+
+    # Get the ingest cache file of the datafile in its current state
+    cache_pathname = get_ingest_cache_pathname(input_datafile)
+
+    # If the cache file exists, read the dataframe from it
+    if os.path.exists(cache_pathname):
+        try:
+            import pyarrow.parquet as pq
+            df = pd.read_parquet(cache_pathname)
+
+            # Restore the categorical columns that pyarrow decodes densely (e.g., those with integer categories)
+            for column_metadata in pq.read_schema(cache_pathname).pandas_metadata['columns']:
+                if (column_metadata['pandas_type'] == 'categorical') and (not isinstance(df[column_metadata['name']].dtype, pd.CategoricalDtype)):
+                    df[column_metadata['name']] = df[column_metadata['name']].astype('category')
+
+            # Mark the cache file as recently used so that it's pruned last (see prune_ingest_cache())
+            try:
+                os.utime(cache_pathname)
+            except OSError:
+                pass
+
+            print('Text file "{}" has been read from its ingest cache file "{}"'.format(input_datafile, cache_pathname))
+            return df
+        except Exception as e:
+            print('WARNING: Could not read the ingest cache file "{}" ({}); parsing the text file instead'.format(cache_pathname, e))
+
+    # Otherwise, parse the text file into compact dtypes
+    df = read_csv_with_inferred_dtypes(input_datafile, sep)
+
+    # Atomically write the cache file, deleting the cache files of previous states of the datafile
+    tmp_pathname = '{}.{}.tmp'.format(cache_pathname, os.getpid())
+    try:
+        os.makedirs(ingest_cache_dir, exist_ok=True)
+        df.to_parquet(tmp_pathname, index=False)
+        os.replace(tmp_pathname, cache_pathname)
+        path_hash_prefix = os.path.basename(cache_pathname).split('-')[0] + '-'
+        for cache_filename in os.listdir(ingest_cache_dir):
+            if cache_filename.startswith(path_hash_prefix) and cache_filename.endswith('.parquet') and (cache_filename != os.path.basename(cache_pathname)):
+                os.remove(os.path.join(ingest_cache_dir, cache_filename))
+        print('Text file "{}" has been cached to ingest cache file "{}"'.format(input_datafile, cache_pathname))
+    except Exception as e:
+        print('WARNING: Could not write the ingest cache file "{}" ({})'.format(cache_pathname, e))
+        if os.path.exists(tmp_pathname):
+            os.remove(tmp_pathname)
+
+    # Keep the total size of the ingest cache bounded
+    prune_ingest_cache(keep_pathname=cache_pathname)
+
+    # Return the dataframe
+    return df
+
+def prune_ingest_cache(max_size_in_gb=None, keep_pathname=None):
+    """Delete the least recently used ingest cache files until their total size is within the limit.
+
+    The files' modification times are used as their last-use times, since read_datafile_with_ingest_cache() updates them on every read.
+
+    Args:
+        max_size_in_gb (float, optional): Maximum total size of the ingest cache files in gigabytes. Defaults to None, meaning ingest_cache_max_size_in_gb.
+        keep_pathname (str, optional): Cache file never to delete, e.g., the one just written. Defaults to None.
+    """
+
+    # Get the limit in bytes
+    if max_size_in_gb is None:
+        max_size_in_gb = ingest_cache_max_size_in_gb
+    max_size_in_bytes = max_size_in_gb * 1024 ** 3
+
+    # Get the size and last-use time of every cache file, skipping any deleted in the meantime (e.g., by another session)
+    cache_files = []
+    if not os.path.isdir(ingest_cache_dir):
+        return
+    for cache_filename in os.listdir(ingest_cache_dir):
+        if cache_filename.endswith('.parquet'):
+            cache_pathname = os.path.join(ingest_cache_dir, cache_filename)
+            try:
+                stat_result = os.stat(cache_pathname)
+            except OSError:
+                continue
+            cache_files.append((stat_result.st_mtime, stat_result.st_size, cache_pathname))
+
+    # Delete the least recently used files until the rest fit
+    total_size = sum(cache_file[1] for cache_file in cache_files)
+    for _, size, cache_pathname in sorted(cache_files):
+        if total_size <= max_size_in_bytes:
+            break
+        if (keep_pathname is not None) and (os.path.abspath(cache_pathname) == os.path.abspath(keep_pathname)):
+            continue
+        try:
+            os.remove(cache_pathname)
+            total_size -= size
+            print('Deleted least recently used ingest cache file "{}" to keep the ingest cache within {} GB'.format(cache_pathname, max_size_in_gb))
+        except OSError as e:
+            print('WARNING: Could not delete the ingest cache file "{}" ({})'.format(cache_pathname, e))
+
 # Extract just the bare-minimum columns to keep in the trimmed dataframe
 def trim_dataframe_basic(df):
     cols_to_keep = ['Slide ID', 'tag', 'Cell X Position', 'Cell Y Position'] + df.loc[0, :].filter(regex='^Phenotype ').index.tolist()
@@ -240,13 +611,12 @@ class Native:
         sep = self.sep
         images_to_analyze = self.images_to_analyze
 
-        # Import relevant libraries
+        # Import relevant library
         import os
-        import pandas as pd
 
-        # Import the text file using Pandas
+        # Import the text file using Pandas, via the ingest cache
         if os.path.exists(input_datafile):
-            df = utils.downcast_dataframe_dtypes(pd.read_csv(input_datafile, sep=sep))
+            df = read_datafile_with_ingest_cache(input_datafile, sep)
             if images_to_analyze is None:  # if this is unset, choose all images in the dataset (i.e., effectively do not filter)
                 print('Text file "{}" with separator "{}" has been successfully read (no image filtering has been performed)'.format(input_datafile, sep))
             else:
@@ -384,14 +754,16 @@ class Native:
             # Set the global minimum coordinate spacing to an unreasonably high number
             min_coord_spacing = 4444
 
-            # For each ROI in the overall dataframe...
-            for roi in df['tag'].unique():
+            # Calculate the minimum coordinate spacings along each axis for all ROIs at once
+            rois, spacings_x, spacings_y, zero_spacings_x, zero_spacings_y = get_min_coord_spacings_per_roi(df)
 
-                # Get the current slice of the overall dataframe
-                curr_df = df[df['tag'] == roi]
+            # For each ROI in the overall dataframe...
+            for iroi, roi in enumerate(rois):
 
-                # Calculate the minimum coordinate spacing in this slice of the overall dataframe
-                min_coord_spacing_in_roi = get_min_coord_spacing_in_dataframe(curr_df)
+                # Combine the minimum coordinate spacings along the two axes in this ROI
+                spacing_x = check_smallest_spacing_aside_from_zero(spacings_x[iroi], zero_spacings_x[iroi])
+                spacing_y = check_smallest_spacing_aside_from_zero(spacings_y[iroi], zero_spacings_y[iroi])
+                min_coord_spacing_in_roi = combine_min_coord_spacings(spacing_x, spacing_y)
 
                 # Output the result
                 print('Minimum spacing in ROI {}: {} microns'.format(roi, min_coord_spacing_in_roi))
@@ -1309,9 +1681,6 @@ def get_min_coord_spacing_in_dataframe(df, print_output=True):
         float: Calculated minimum coordinate spacing
     """
 
-    # Import relevant libraries
-    import numpy as np
-
     def get_smallest_spacing_aside_from_zero(arr):
         # This should exit cleanly now when arr = [0], which should probably never happen though it might... yes I think it does because I don't think I've dropped the "trivial" ROIs yet
         tol = 1e-8
@@ -1341,6 +1710,25 @@ def get_min_coord_spacing_in_dataframe(df, print_output=True):
     spacing_x = get_smallest_spacing_aside_from_zero((sorted_x[1:].reset_index(drop=True) - sorted_x[:-1].reset_index(drop=True)).sort_values().unique())
     spacing_y = get_smallest_spacing_aside_from_zero((sorted_y[1:].reset_index(drop=True) - sorted_y[:-1].reset_index(drop=True)).sort_values().unique())
 
+    # Return the minimum coordinate spacing in the dataframe
+    return combine_min_coord_spacings(spacing_x, spacing_y, print_output=print_output)
+
+
+def combine_min_coord_spacings(spacing_x, spacing_y, print_output=True):
+    """Combine the minimum coordinate spacings along the x- and y-axes into a single minimum coordinate spacing
+
+    Args:
+        spacing_x (float): Minimum x-coordinate spacing
+        spacing_y (float): Minimum y-coordinate spacing
+        print_output (bool, optional): Whether to print the combined minimum coordinate spacing, including whether the x- and y-values are different. Defaults to True.
+
+    Returns:
+        float: Combined minimum coordinate spacing
+    """
+
+    # Import relevant library
+    import numpy as np
+
     # If the minimum coordinate spacings for the x- and y-coordinates don't agree, say so and set the global minimum to the smaller of the two
     if spacing_x != spacing_y:
         min_coord_spacing = np.min([spacing_x, spacing_y])
@@ -1353,10 +1741,87 @@ def get_min_coord_spacing_in_dataframe(df, print_output=True):
         if print_output:
             print('Calculated minimum coordinate spacing: {}'.format(min_coord_spacing))
 
-    # Return the minimum coordinate spacing in the dataframe
+    # Return the combined minimum coordinate spacing
     return min_coord_spacing
 
 
+def check_smallest_spacing_aside_from_zero(smallest_spacing, zero_spacing, large_num=1e8):
+    """Check the smallest spacing aside from zero along an axis of a ROI as calculated by get_min_coord_spacings_per_roi(), returning a large number for "trivial" ROIs in the same way get_min_coord_spacing_in_dataframe() does
+
+    Args:
+        smallest_spacing (float): Smallest spacing aside from zero, or NaN if there is none
+        zero_spacing (float): First essentially-zero spacing, or NaN if there is none
+        large_num (float, optional): Value to return for trivial ROIs. Defaults to 1e8.
+
+    Returns:
+        float: Smallest spacing aside from zero, or large_num if there is none
+    """
+
+    # Import relevant library
+    import numpy as np
+
+    # If there is no spacing aside from zero, the ROI is likely trivial
+    if np.isnan(smallest_spacing):
+        arr = ([zero_spacing] if not np.isnan(zero_spacing) else [])
+        print('WARNING: This ROI is likely "trivial." Here are its first ten smallest spacings: {}. Returning {}.'.format(arr[:10], large_num))
+        return large_num
+
+    return smallest_spacing
+
+
+def get_min_coord_spacings_per_roi(df, tol=1e-8):
+    """Calculate the smallest spacing aside from zero along each axis of every ROI (i.e., "tag") in a single sort-based pass
+
+    For each axis, the coordinates are sorted by ROI and then by value, the differences between consecutive coordinates in the same ROI are taken, and the smallest of them aside from zero is found for each ROI. This gives the same spacings as calling get_min_coord_spacing_in_dataframe() on each ROI separately, in O(N log N) time rather than O(ROIs x N).
+
+    Args:
+        df (Pandas dataframe): Dataframe containing "tag", "Cell X Position", and "Cell Y Position" fields
+        tol (float, optional): Spacings below this are considered to be zero. Defaults to 1e-8.
+
+    Returns:
+        1D numpy array: ROIs in order of first appearance in the dataframe
+        1D numpy array: Smallest x-coordinate spacing aside from zero in each ROI, or NaN if there is none
+        1D numpy array: Smallest y-coordinate spacing aside from zero in each ROI, or NaN if there is none
+        1D numpy array: Smallest essentially-zero x-coordinate spacing in each ROI, or NaN if there is none
+        1D numpy array: Smallest essentially-zero y-coordinate spacing in each ROI, or NaN if there is none
+    """
+
+    # Import relevant libraries
+    import numpy as np
+    import pandas as pd
+
+    # Label each object with the index of its ROI, in order of first appearance
+    roi_codes, rois = pd.factorize(df['tag'])
+    rois = np.asarray(rois)
+    nrois = len(rois)
+    has_roi = roi_codes >= 0
+
+    # For each axis...
+    spacing_holder = []
+    for coord_col in ['Cell X Position', 'Cell Y Position']:
+
+        # Sort the coordinates by ROI and then by value
+        coords = df[coord_col].to_numpy()[has_roi]
+        codes = roi_codes[has_roi]
+        sort_order = np.lexsort((coords, codes))
+        coords = coords[sort_order]
+        codes = codes[sort_order]
+
+        # Take the differences between consecutive coordinates in the same ROI
+        in_same_roi = codes[1:] == codes[:-1]
+        diffs = (coords[1:] - coords[:-1])[in_same_roi]
+        diff_codes = codes[1:][in_same_roi]
+
+        # Reduce them per ROI to the smallest spacing aside from zero and the smallest essentially-zero spacing
+        is_nonzero = diffs > tol
+        is_zero = diffs < tol
+        smallest_spacings = pd.Series(diffs[is_nonzero]).groupby(diff_codes[is_nonzero]).min().reindex(range(nrois)).to_numpy()
+        zero_spacings = pd.Series(diffs[is_zero]).groupby(diff_codes[is_zero]).min().reindex(range(nrois)).to_numpy()
+        spacing_holder.append((smallest_spacings, zero_spacings))
+
+    return rois, spacing_holder[0][0], spacing_holder[1][0], spacing_holder[0][1], spacing_holder[1][1]
+
+
 def calculate_roi_coords(min_coord, max_coord, roi_width, overlap=0):
     """Break up the coordinates of whole slide images into individual ROIs/patches.
 
@@ -1416,11 +1881,62 @@ def get_coord_descriptors(df, coord_cols):
     return XMin, XMax, YMin, YMax, xmid, ymid
 
 
+def get_patch_memberships_along_axis(coords, roi_starts, roi_ends):
+    """Assign coordinates along a single axis to the (possibly overlapping) patches along that axis by integer binning.
+
+    Since the patches from calculate_roi_coords() are evenly spaced, the index of the last patch starting at or before a coordinate is obtained by integer division, and the only other patches that can contain it are the few preceding ones (as many as overlap a single point). Each candidate is then checked against the exact patch boundaries, so the result is the same as testing every coordinate against every patch.
+
+    Args:
+        coords (1D numpy array): Coordinates along the axis
+        roi_starts (1D numpy array): Beginning (smaller) coordinates of each patch along the axis
+        roi_ends (1D numpy array): Ending (larger) coordinates of each patch along the axis
+
+    Returns:
+        1D numpy array: Index into coords of each membership, sorted
+        1D numpy array: Index of the patch of each membership, in increasing order for each coordinate
+    """
+
+    # Import relevant library
+    import numpy as np
+
+    # If there are no patches, there are no memberships
+    num_rois = len(roi_starts)
+    if num_rois == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+    # Get the spacing of the patches and the maximum number of them that can contain a single coordinate
+    roi_step_size = (roi_starts[1] - roi_starts[0]) if num_rois > 1 else (roi_ends[0] - roi_starts[0])
+    max_rois_per_coord = int(np.ceil((roi_ends[0] - roi_starts[0]) / roi_step_size))
+
+    # Bin the coordinates to get the last patch that can contain each one (one extra candidate on either side guards against rounding)
+    last_roi = np.floor((coords - roi_starts[0]) / roi_step_size).astype(np.int64) + 1
+
+    # Check each candidate patch for every coordinate against the exact patch boundaries
+    coord_index_holder = []
+    roi_index_holder = []
+    for offset in range(max_rois_per_coord + 2, -1, -1):
+        roi_index = last_roi - offset
+        valid = (roi_index >= 0) & (roi_index < num_rois)
+        roi_index_clipped = np.clip(roi_index, 0, num_rois - 1)
+        valid &= (coords >= roi_starts[roi_index_clipped]) & (coords < roi_ends[roi_index_clipped])
+        coord_index_holder.append(np.flatnonzero(valid))
+        roi_index_holder.append(roi_index[valid])
+
+    # Sort the memberships by coordinate and then by patch
+    coord_index = np.concatenate(coord_index_holder)
+    roi_index = np.concatenate(roi_index_holder)
+    sort_order = np.lexsort((roi_index, coord_index))
+
+    return coord_index[sort_order], roi_index[sort_order]
+
+
 def break_up_slide_into_patches(df, roi_width=1230.77, overlap=246.15, coord_cols=['XMin', 'XMax', 'YMin', 'YMax']):
-    """Break up a slide's dataframe into patches/ROIs, returning a Pandas series with the appropriate ROI labels for each object
+    """Break up a slide's dataframe into patches/ROIs, returning an exploded table of the ROIs to which each object belongs
+
+    Objects are assigned to patches by integer binning of their coordinates along each axis (see get_patch_memberships_along_axis()). Objects in the overlap of multiple patches get one row in the returned table per patch.
 
     Sample call:
-        df.loc[curr_loc, 'tag'] = break_up_slide_into_patches(curr_df, roi_width=(roi_width / coord_units_in_microns), overlap=(overlap / coord_units_in_microns))
+        df_patches = break_up_slide_into_patches(curr_df, roi_width=(roi_width / coord_units_in_microns), overlap=(overlap / coord_units_in_microns))
 
     Args:
         df (Pandas dataframe): Dataframe corresponding to a single slide containing coordinates (columns XMin, XMax, YMin, YMax) in pixels
@@ -1428,11 +1944,12 @@ def break_up_slide_into_patches(df, roi_width=1230.77, overlap=246.15, coord_col
         overlap (float, optional): Desired patching overlap in pixels. Defaults to 246.15 ~ 80 / 0.325.
 
     Returns:
-        Pandas series: Series corresponding to the tag/ROI column of the dataframe of the input slide
+        Pandas dataframe: One row per object/ROI membership, sorted by object and then by ROI, with columns "object_index" (integer position of the object in the input dataframe) and "tag" (name of the ROI, categorical)
     """
 
     # Import relevant libraries
     import numpy as np
+    import pandas as pd
 
     # Since the current dataset can have cell gate coordinates or the cell centroid coordinates, get the full set of coordinate descriptors based on the coordinate-related columns present in the input file
     XMin, XMax, YMin, YMax, xmid, ymid = get_coord_descriptors(df, coord_cols)
@@ -1440,7 +1957,6 @@ def break_up_slide_into_patches(df, roi_width=1230.77, overlap=246.15, coord_col
     # Get items for the ROI name
     max_num_digits = len(str(max([XMax.max(), YMax.max()])))  # get the maximum number of digits to format into the ROI names; assume the input coordinates are non-negative integers
     format_string = '[{:0' + str(max_num_digits) + 'd},{:0' + str(max_num_digits) + 'd}]'
-    # slide_id = df.head(1)['Slide ID']  # get the current Slide ID; it should be same for every row in the input dataframe
     slide_id = df['Slide ID'].iloc[0]
     print('On slide {}...'.format(slide_id))
 
@@ -1448,88 +1964,36 @@ def break_up_slide_into_patches(df, roi_width=1230.77, overlap=246.15, coord_col
     x_roi_starts, x_roi_ends = calculate_roi_coords(min_coord=XMin.min(), max_coord=XMax.max(), roi_width=roi_width, overlap=overlap)
     y_roi_starts, y_roi_ends = calculate_roi_coords(min_coord=YMin.min(), max_coord=YMax.max(), roi_width=roi_width, overlap=overlap)
 
-    # # Print out the minimum coordinates of every patch
-    # print('Breaking up the slide into patches:')
-    # print('  x minimum coordinates: {}'.format(x_roi_starts))
-    # print('  y minimum coordinates: {}'.format(y_roi_starts))
-
-    # Initialize four relevant columns in the dataframe
-    # df.loc[:, 'tag'] = []
-    # df.loc[:, 'roi_count'] = 0
-    df['tag'] = [[]] * len(df)
-    df['roi_count'] = 0
-    # xmid = df['XMin'] + (df['XMax'] - df['XMin']) / 2
-    # ymid = df['YMin'] + (df['YMax'] - df['YMin']) / 2
-
-    # Loop over every ROI and assign an object to a ROI accordingly
-    total_object_count = 0
-    for xmin, xmax in zip(x_roi_starts, x_roi_ends):
-        for ymin, ymax in zip(y_roi_starts, y_roi_ends):
-            in_roi = (xmid >= xmin) & (xmid < xmax) & (ymid >= ymin) & (ymid < ymax)
-            roi_name = slide_id + '_roi_' + format_string.format(int(np.round((xmin + xmax) / 2)), int(np.round((ymin + ymax) / 2)))  # the ROI name is the slide ID appended with the middle x- and y-coordinates of the current ROI
-            # df.loc[in_roi, 'tag'] = roi_name
-            # df.loc[in_roi, 'tag'] = df.loc[in_roi, 'tag'].apply(lambda x: x.append(roi_name), axis='rows')
-            # df.loc[in_roi, 'tag'] = df.loc[in_roi, 'tag'].apply(lambda x: x.append(roi_name))
-            df.loc[in_roi, 'tag'] = df.loc[in_roi, 'tag'].apply(lambda x: x + [roi_name])
-            df.loc[in_roi, 'roi_count'] = df.loc[in_roi, 'roi_count'] + 1
-            num_objects_in_roi = in_roi.sum()
-            total_object_count = total_object_count + num_objects_in_roi
-            print('Number of objects in ROI {}: {}'.format(roi_name, num_objects_in_roi))
+    # Name every ROI, ordered with the x-coordinate varying slowest; the ROI name is the slide ID appended with the middle x- and y-coordinates of the ROI
+    roi_names = [slide_id + '_roi_' + format_string.format(int(np.round((xmin + xmax) / 2)), int(np.round((ymin + ymax) / 2))) for xmin, xmax in zip(x_roi_starts, x_roi_ends) for ymin, ymax in zip(y_roi_starts, y_roi_ends)]
+
+    # Get the patch memberships of the objects along each axis
+    x_object_index, x_roi_index = get_patch_memberships_along_axis(xmid.to_numpy(), x_roi_starts, x_roi_ends)
+    y_object_index, y_roi_index = get_patch_memberships_along_axis(ymid.to_numpy(), y_roi_starts, y_roi_ends)
+
+    # Combine them into the memberships of the 2D patches, i.e., for each object the cross product of its x and y memberships
+    nobjects = len(df)
+    x_counts = np.bincount(x_object_index, minlength=nobjects)
+    y_counts = np.bincount(y_object_index, minlength=nobjects)
+    y_offsets = np.concatenate(([0], np.cumsum(y_counts)[:-1]))
+    x_repeats = y_counts[x_object_index]  # each x membership is paired with every y membership of the same object
+    object_index = np.repeat(x_object_index, x_repeats)
+    pair_start = np.repeat(np.cumsum(x_repeats) - x_repeats, x_repeats)
+    y_membership = y_offsets[object_index] + np.arange(len(object_index)) - pair_start
+    roi_index = np.repeat(x_roi_index, x_repeats) * len(y_roi_starts) + y_roi_index[y_membership]
+
+    # Print the number of objects in each ROI
+    roi_object_counts = np.bincount(roi_index, minlength=len(roi_names))
+    for roi_name, num_objects_in_roi in zip(roi_names, roi_object_counts):
+        print('Number of objects in ROI {}: {}'.format(roi_name, num_objects_in_roi))
 
     # Output some items to check
-    print(len(df), total_object_count, df['roi_count'].sum())  # if there is overlap then the latter two numbers, which should be the same, should be at least as big as the first number. If there is no overlap, then all three numbers should be the same.
-    print('Unique ROI counts: {}'.format(df['roi_count'].unique()))  # should be [1, 2, 4] if there is overlap; otherwise, just [1]
-
-    # Return the ROI names
-    return df['tag']
+    roi_count = x_counts * y_counts
+    print(nobjects, roi_object_counts.sum(), roi_count.sum())  # if there is overlap then the latter two numbers, which should be the same, should be at least as big as the first number. If there is no overlap, then all three numbers should be the same.
+    print('Unique ROI counts: {}'.format(pd.unique(roi_count)))  # should be [1, 2, 4] if there is overlap; otherwise, just [1]
 
-
-def duplicate_rows(df, col_to_repeat='tag'):
-    """Duplicate rows of a dataframe based on a column containing iterables whose entries should be different for each duplicate
-
-    Args:
-        df (Pandas dataframe): Dataframe whose rows should be repeated with the differences in repeated rows specified by the entries in the col_to_repeat column
-        col_to_repeat (str, optional): Name of the column containing iterables whose values should be the difference between the duplicated rows. Defaults to 'tag'.
-
-    Returns:
-        Pandas dataframe: New dataframe with repeated rows except for the col_to_repeat column
-    """
-
-    # Import relevant library
-    import pandas as pd
-
-    # Get the lengths of the entries in the column on which repetition should be performed
-    col_lengths = df[col_to_repeat].apply(lambda x: len(x))
-
-    # Get the unique lengths
-    unique_col_lengths = col_lengths.unique()
-
-    # Initialize a list from which the new dataframe will be built
-    new_df_list = []
-
-    # For each unique length...
-    for unique_col_length in unique_col_lengths:
-
-        # Get a view of the main dataframe with just the rows having the current column length
-        curr_df = df[col_lengths == unique_col_length]
-
-        # For each item in each row's iterable...
-        for list_index in range(unique_col_length):
-
-            # Make a copy of the view
-            new_curr_df = curr_df.copy()
-
-            # Replace the contents of the column of interest with the current item in the iterable
-            new_curr_df[col_to_repeat] = curr_df[col_to_repeat].apply(lambda x: x[list_index])
-
-            # Append the new dataframe to the master dataframe list
-            new_df_list.append(new_curr_df)
-
-    # Create the new Pandas dataframe from the master list
-    new_df = pd.concat(new_df_list).reset_index(drop=True)
-
-    # Return the new dataframe
-    return new_df
+    # Return the exploded table of ROI memberships
+    return pd.DataFrame({'object_index': object_index, 'tag': pd.Categorical.from_codes(roi_index, categories=roi_names)})
 
 
 def calculate_min_coord_spacing_per_slide(df):
@@ -1590,6 +2054,7 @@ def potentially_apply_patching(df, input_datafile_or_coord_cols_or_df, roi_width
     '''Either patch up the dataset into ROIs and assign the ROI ("tag") column accordingly, or don't and assign the ROI column accordingly.
     '''
 
+    import numpy as np
     import pandas as pd
 
     # Obtain the coordinate-relate columns for the current datafile format type
@@ -1611,6 +2076,10 @@ def potentially_apply_patching(df, input_datafile_or_coord_cols_or_df, roi_width
         doing_casting = True
         df['tag'] = df['tag'].astype('object')
 
+    # Initialize the holders of the exploded tables of ROI memberships of all the slides
+    object_index_holder = []
+    tag_holder = []
+
     # For each slide...
     for unique_slide in unique_slides:
 
@@ -1629,19 +2098,37 @@ def potentially_apply_patching(df, input_datafile_or_coord_cols_or_df, roi_width
         else:
             print('Patching will be performed...')
             curr_df[coord_cols] = func_coords_to_pixels(curr_df[coord_cols])
-            df.loc[curr_loc, 'tag'] = break_up_slide_into_patches(curr_df, roi_width=func_microns_to_pixels(roi_width), overlap=func_microns_to_pixels(overlap), coord_cols=coord_cols)
+            df_patches = break_up_slide_into_patches(curr_df, roi_width=func_microns_to_pixels(roi_width), overlap=func_microns_to_pixels(overlap), coord_cols=coord_cols)
+            object_index_holder.append(np.flatnonzero(curr_loc)[df_patches['object_index'].to_numpy()])  # convert to positions in the overall dataframe
+            tag_holder.append(df_patches['tag'].astype(str).to_numpy())
 
     # Print out the current dataframe size
     print('Current dataframe length: {}'.format(len(df)))
 
-    # If patching was performed, then the 'tag' column will be lists of strings, not strings
+    # If patching was performed, expand the dataframe to one row per object/ROI membership
     if roi_width is not None:
 
+        # Combine the ROI memberships of all the slides
+        object_index = np.concatenate(object_index_holder) if object_index_holder else np.array([], dtype=np.int64)
+        tags = np.concatenate(tag_holder) if tag_holder else np.array([], dtype=object)
+
         # Print out the expected length of the new dataframe
-        print('Expected length of duplicated dataframe: {}'.format(df['tag'].apply(lambda x: len(x)).sum()))
+        print('Expected length of duplicated dataframe: {}'.format(len(object_index)))
+
+        # Order the rows grouped by the number of ROIs containing the object (in order of first appearance), then by the ROI's position among the object's ROIs, then by the object's position in the dataframe
+        roi_count = np.bincount(object_index, minlength=len(df))
+        unique_roi_counts, roi_count_first_appearance = np.unique(roi_count, return_index=True)
+        roi_count_rank = np.empty(len(unique_roi_counts), dtype=np.int64)
+        roi_count_rank[np.argsort(roi_count_first_appearance)] = np.arange(len(unique_roi_counts))
+        roi_count_rank = roi_count_rank[np.searchsorted(unique_roi_counts, roi_count)]
+        object_order = np.argsort(object_index, kind='stable')
+        position_in_object = np.empty(len(object_index), dtype=np.int64)
+        position_in_object[object_order] = np.arange(len(object_index)) - np.repeat(np.cumsum(roi_count) - roi_count, roi_count)
+        row_order = np.lexsort((object_index, position_in_object, roi_count_rank[object_index]))
 
         # Repeat objects that are in multiple ROIs
-        df = duplicate_rows(df, col_to_repeat='tag')
+        df = df.iloc[object_index[row_order]].reset_index(drop=True)
+        df['tag'] = tags[row_order]
 
         # Print the length of the new dataframe
         print('Length of duplicated dataframe: {}'.format(len(df)))
@@ -1663,17 +2150,35 @@ def delete_rois_with_single_coord(df):
     It technically doesn't make much sense to delete 1D ROIs as we do later in time_cell_interaction_lib.py (though *practically*, it's probably reasonable). That's because we *generally* want to get results that are rotationally invariant. E.g., if the coordinates were in a line, then we'd want to keep the ROI, even though it if the line were along the x- or y-axis, the ROI would appear to have zero area. This might be solved by no longer defining a ROI based on the their span in the x- and y-directions and instead defining it independent of the cell locations themselves. However, the drawback to that is that we'd need to determine a reasonable way to do this which isn't trivial because then we could artificially create empty space which would skew the results. So doing it the way we do it is probably still quite a reasonable way to go.
     """
 
+    # Import relevant libraries
+    import numpy as np
+    import pandas as pd
+
     # Obtain just the phenotype columns
     df_phenotypes = df[df.columns[df.columns.str.startswith('Phenotype ')]]
 
     # Delete empty objects
     df_pared = df[(df_phenotypes != '-').any(axis='columns')]
 
-    # Get a Series containing the number of unique coordinates in every ROI i.e. "tag"
-    num_unique_coords_per_roi = df_pared.groupby('tag', observed=False).apply(lambda x: x[['Cell X Position', 'Cell Y Position']].drop_duplicates().shape[0], include_groups=False)
+    # Sort the objects by ROI i.e. "tag" and then by coordinates
+    roi_codes, rois = pd.factorize(df_pared['tag'])
+    has_roi = roi_codes >= 0
+    roi_codes = roi_codes[has_roi]
+    x_coords = df_pared['Cell X Position'].to_numpy()[has_roi]
+    y_coords = df_pared['Cell Y Position'].to_numpy()[has_roi]
+    sort_order = np.lexsort((y_coords, x_coords, roi_codes))
+    roi_codes = roi_codes[sort_order]
+    x_coords = x_coords[sort_order]
+    y_coords = y_coords[sort_order]
+
+    # Count the number of unique coordinates in every ROI as the number of objects whose ROI or coordinates differ from those of the previous object (with missing coordinates considered equal, as in drop_duplicates())
+    is_same_x = (x_coords[1:] == x_coords[:-1]) | (pd.isna(x_coords[1:]) & pd.isna(x_coords[:-1]))
+    is_same_y = (y_coords[1:] == y_coords[:-1]) | (pd.isna(y_coords[1:]) & pd.isna(y_coords[:-1]))
+    is_new_coord = np.concatenate(([True], (roi_codes[1:] != roi_codes[:-1]) | ~is_same_x | ~is_same_y))
+    num_unique_coords_per_roi = np.bincount(roi_codes[is_new_coord], minlength=len(rois))
 
     # Get the set of ROIs containing a single unique coordinate
-    rois_with_single_unique_coord = set(num_unique_coords_per_roi.loc[num_unique_coords_per_roi == 1].index)
+    rois_with_single_unique_coord = set(np.asarray(rois)[num_unique_coords_per_roi == 1])
 
     # Drop these ROIs from the dataset
     print('Dropping {} ROIs with valid objects that have only a single unique spatial coordinate: {}'.format(len(rois_with_single_unique_coord), rois_with_single_unique_coord))
@@ -1683,18 +2188,10 @@ def delete_rois_with_single_coord(df):
     return df
 
 def get_image_series_in_datafile(input_datafile_or_df):
-    import pandas as pd
-    relevant_column_str, string_processing_func, _, _, _, _ = extract_datafile_metadata(input_datafile_or_df)
     if isinstance(input_datafile_or_df, str):
-        sep = (',' if input_datafile_or_df.split('.')[-1] == 'csv' else '\t')
-    if isinstance(relevant_column_str, str):
-        if isinstance(input_datafile_or_df, str):
-            return pd.read_csv(input_datafile_or_df, sep=sep, usecols=[relevant_column_str]).iloc[:, 0].apply(lambda x: string_processing_func(x).strip())
-        else:
-            return input_datafile_or_df[relevant_column_str].iloc[:, 0].apply(lambda x: string_processing_func(x).strip())
-    else:  # if it's I believe a list
-        if isinstance(input_datafile_or_df, str):
-            df_image_cols = pd.read_csv(input_datafile_or_df, sep=sep, usecols=relevant_column_str)[relevant_column_str]  # preseve column order with the [relevant_column_str] at the end
-        else:
-            df_image_cols = input_datafile_or_df[relevant_column_str]  # preseve column order with the [relevant_column_str] at the end
-        return df_image_cols.iloc[:, 0].apply(lambda x: string_processing_func[0](x).strip()) + '__' + df_image_cols.iloc[:, 1].apply(lambda x: string_processing_func[1](x).strip())
+        metadata = scan_datafile(input_datafile_or_df, scan_columns=False)['metadata']
+        relevant_column_str, string_processing_func, _, _, _, _ = metadata
+        return get_image_series_from_columns(read_datafile_columns(input_datafile_or_df, get_image_columns(metadata, include_class=False)), relevant_column_str, string_processing_func)
+    else:
+        relevant_column_str, string_processing_func, _, _, _, _ = extract_datafile_metadata(input_datafile_or_df)
+        return get_image_series_from_columns(input_datafile_or_df, relevant_column_str, string_processing_func)
@@ -14,7 +14,6 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 from sklearn.cluster import KMeans # K-Means
-import umap  # slow
 from scipy import ndimage as ndi
 
 import basic_phenotyper_lib as bpl  # Useful functions for cell phenotyping
@@ -22,7 +21,6 @@ import nidap_dashboard_lib as ndl   # Useful functions for dashboards connected
 from benchmark_collector import benchmark_collector # Benchmark Collector Class
 from SpatialUMAP import SpatialUMAP
 import PlottingTools as umPT
-import utils
 from natsort import natsorted
 class NeighborhoodProfiles:
     '''
@@ -174,7 +172,7 @@ class NeighborhoodProfiles:
         self.spatial_umap.umap_completed        = False
         self.spatial_umap.cluster_completed     = False
 
-    def perform_density_calc(self, calc_areas, cpu_pool_size = 1, area_threshold = 0.001):
+    def perform_density_calc(self, calc_areas, cpu_pool_size = 1, area_threshold = 0.001, area_method = 'ellipse'):
         '''
         Calculate the cell counts, cell areas,
         perform the cell densities and cell proportions analyses.
@@ -185,6 +183,7 @@ class NeighborhoodProfiles:
             spatial_umap (SpatialUMAP): SpatialUMAP object
             bc (benchmark_collector): Benchmark Collector object
             cpu_pool_size (int): Number of CPUs to use for parallel processing
+            area_method (str): Region boundary to use for cell areas, 'ellipse' or 'hull'
 
         Returns:
             SpatialUMAP: SpatialUMAP object with the cell counts, cell areas, 
@@ -206,7 +205,7 @@ class NeighborhoodProfiles:
         # get the areas of cells and save to pickle file
         print(f'\nStarting Cell Areas process with area threshold of {area_threshold}')
         self.bc.startTimer()
-        self.spatial_umap.get_areas(calc_areas, area_threshold, pool_size=cpu_pool_size)
+        self.spatial_umap.get_areas(calc_areas, area_threshold, pool_size=cpu_pool_size, area_method=area_method)
         self.bc.printElapsedTime(f'Calculating Areas for {len(self.spatial_umap.cells)} cells')
 
         # calculate density based on counts of cells / area of each arc examine
@@ -237,16 +236,16 @@ class NeighborhoodProfiles:
         print('Setting Train/Test Split')
         self.spatial_umap.set_train_test(n_fit=n_fit, n_tra = n_tra, groupby_label = 'TMA_core_id', seed=54321, umap_subset_toggle = umap_subset_toggle)
 
-        # fit umap on training cells
+        # fit umap on training cells, reusing the model if the training densities are unchanged
         self.bc.startTimer()
         print('Fitting Model')
-        self.spatial_umap.umap_fit = umap.UMAP().fit(self.spatial_umap.density[self.spatial_umap.cells['umap_train'].values].reshape((self.spatial_umap.cells['umap_train'].sum(), -1)))
+        self.spatial_umap.umap_fit, umap_cache_key = bpl.fit_umap_cached(self.spatial_umap.density[self.spatial_umap.cells['umap_train'].values].reshape((self.spatial_umap.cells['umap_train'].sum(), -1)))
         self.bc.printElapsedTime(f'      Fitting {np.sum(self.spatial_umap.cells["umap_train"] == 1)} points to a model')
 
-        # Transform test cells based on fitted model
+        # Transform test cells based on fitted model, skipping density profiles that model has already transformed
         self.bc.startTimer()
         print('Transforming Data')
-        self.spatial_umap.umap_test = self.spatial_umap.umap_fit.transform(self.spatial_umap.density[self.spatial_umap.cells['umap_test'].values].reshape((self.spatial_umap.cells['umap_test'].sum(), -1)))
+        self.spatial_umap.umap_test = bpl.transform_umap_incrementally(self.spatial_umap.umap_fit, self.spatial_umap.density[self.spatial_umap.cells['umap_test'].values].reshape((self.spatial_umap.cells['umap_test'].sum(), -1)), cache_key = umap_cache_key)
         self.bc.printElapsedTime(f'      Transforming {np.sum(self.spatial_umap.cells["umap_test"] == 1)} points with the model')
 
         self.spatial_umap.umap_completed = True
@@ -324,12 +323,7 @@ class NeighborhoodProfiles:
             wcss (list): List of within-cluster sum of squares
         '''
         clust_range = range(clust_minmax[0], clust_minmax[1])
-        wcss = [] # Within-Cluster Sum of Squares
-        for n_clusters in clust_range:
-            # Perform clustering for chosen
-            kmeans_obj = self.kmeans_calc(self.spatial_umap, n_clusters)
-            # Append Within-Cluster Sum of Squares measurement
-            wcss.append(kmeans_obj.inertia_)
+        wcss, _ = bpl.kmeans_sweep(self.spatial_umap.umap_test, clust_range)
         return list(clust_range), wcss
 
     def perform_clustering(self, n_clusters, clust_minmax, cpu_pool_size = 8):
@@ -339,6 +333,7 @@ class NeighborhoodProfiles:
         Args:
             spatial_umap (spatial_umap): spatial_umap object
             n_clusters (int): Number of clusters to use
+            cpu_pool_size (int): Number of CPUs to use for the KMeans fits
 
         Returns:
             spatial_umap: spatial_umap object with the clustering performed
@@ -348,33 +343,12 @@ class NeighborhoodProfiles:
 
         clust_range = range(clust_minmax[0], clust_minmax[1]+1)
 
-        kwargs_list = []
-        for clust in clust_range:
-            kwargs_list.append(
-                (
-                    self.spatial_umap.umap_test,
-                    clust
-                )
-            )
-
-        results = utils.execute_data_parallelism_potentially(self.kmeans_calc,
-                                                            kwargs_list,
-                                                            nworkers = cpu_pool_size,
-                                                            task_description='KMeans Clustering',
-                                                            use_starmap=True)
-        # mp_start_method = mp.get_start_method()
-        # # Create a pool of worker processes
-        # with mp.get_context(mp_start_method).Pool(processes=cpu_pool_size) as pool:
-        #     results = pool.starmap(kmeans_calc, kwargs_list)
-
-        wcss = [x.inertia_ for x in results]
+        # Sweep over the numbers of clusters, reusing any fits already performed on this embedding
+        wcss, labels = bpl.kmeans_sweep(self.spatial_umap.umap_test, clust_range, n_clusters = n_clusters, n_jobs = cpu_pool_size)
 
         # Create WCSS Elbow Plot
         self.spatial_umap.elbow_fig = self.draw_wcss_elbow_plot(clust_range, wcss, n_clusters)
 
-        # Identify the kmeans obj that matches the selected cluster number
-        kmeans_obj_targ = results[n_clusters-1]
-
         self.spatial_umap.cluster_dict = dict()
         for i in range(n_clusters):
             self.spatial_umap.cluster_dict[i+1] = f'Cluster {i+1}'
@@ -386,7 +360,7 @@ class NeighborhoodProfiles:
         self.spatial_umap.palette_dict['No Cluster'] = 'white'
 
         # Assign values to cluster_label column in df_umap
-        self.spatial_umap.df_umap.loc[:, 'clust_label'] = [self.spatial_umap.cluster_dict[key] for key in (kmeans_obj_targ.labels_+1)]
+        self.spatial_umap.df_umap.loc[:, 'clust_label'] = [self.spatial_umap.cluster_dict[key] for key in (labels+1)]
 
         # After assigning the cluster labels, perform mean measure calculations
         self.spatial_umap.mean_measures()
@@ -870,47 +844,17 @@ class UMAPDensityProcessing():
         cond1_ind = np.nonzero(dens_mat_cmp == -1)
         cells_cond1 = np.vstack(cond1_ind).T
 
-        kwargs_list_0 = []
-        kwargs_list_1 = []
-        for clust in clust_range:
-            kwargs_list_0.append(
-                (
-                    cells_cond0,
-                    clust
-                )
-            )
-            kwargs_list_1.append(
-                (
-                    cells_cond1,
-                    clust
-                )
-            )
-
-        results_0 = utils.execute_data_parallelism_potentially(self.kmeans_calc,
-                                                               kwargs_list_0,
-                                                               nworkers = cpu_pool_size,
-                                                               task_description='KMeans Clustering for False Condition',
-                                                               use_starmap=True)
-
-        results_1 = utils.execute_data_parallelism_potentially(self.kmeans_calc,
-                                                               kwargs_list_1,
-                                                               nworkers = cpu_pool_size,
-                                                               task_description='KMeans Clustering for True Condition',
-                                                               use_starmap=True)
-
-        wcss_0 = [x.inertia_ for x in results_0]
-        wcss_1 = [x.inertia_ for x in results_1]
+        # Sweep over the numbers of clusters for each condition, reusing any fits already performed on the same cells
+        wcss_0, labels_0 = bpl.kmeans_sweep(cells_cond0, clust_range, n_clusters = num_clus_0, n_jobs = cpu_pool_size)
+        wcss_1, labels_1 = bpl.kmeans_sweep(cells_cond1, clust_range, n_clusters = num_clus_1, n_jobs = cpu_pool_size)
 
         # Create WCSS Elbow Plot
         self.elbow_fig_0 = self.draw_wcss_elbow_plot(clust_range, wcss_0, num_clus_0)
         self.elbow_fig_1 = self.draw_wcss_elbow_plot(clust_range, wcss_1, num_clus_1)
 
-        kmeans_obj_cond0 = results_0[num_clus_0 - 1]
-        kmeans_obj_cond1 = results_1[num_clus_1 - 1]
-
         # Replace the labels in the density matrix with the cluster labels
-        self.dens_mat[cond0_ind] = kmeans_obj_cond0.labels_ + 1
-        self.dens_mat[cond1_ind] = -kmeans_obj_cond1.labels_ - 1
+        self.dens_mat[cond0_ind] = labels_0 + 1
+        self.dens_mat[cond1_ind] = -labels_1 - 1
 
         unique_fals, counts_fals = np.unique(self.dens_mat[cond0_ind], return_counts=True)
         unique_true, counts_true = np.unique(self.dens_mat[cond1_ind], return_counts=True)
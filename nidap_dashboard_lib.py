@@ -135,6 +135,7 @@ def init_session_state(session_state):
     session_state.umap_subset_toggle = True
     session_state.umap_subset_per = 20
     session_state.area_filter_per = 0.001
+    session_state.area_method = 'ellipse'
     session_state.clust_minmax = [1, 10]
     session_state.toggle_clust_diff = False
     session_state.cluster_completed_diff = False
@@ -79,7 +79,8 @@ def init_spatial_umap():
                                                                  st.session_state.bc,
                                                                  st.session_state.calc_unique_areas_toggle,
                                                                  st.session_state.cpu_pool_size,
-                                                                 area_threshold = area_filter)
+                                                                 area_threshold = area_filter,
+                                                                 area_method = st.session_state['area_method'])
 
         # Record time elapsed
         st.session_state.bc.set_value_df('time_to_run_counts', st.session_state.bc.elapsedTime())
@@ -619,6 +620,13 @@ def main():
                                 of the ratio (close to 1) include fewer cells. This can be useful for removing
                                 cells that are on the edge of the tissue. This affects the number of cells included
                                 in the Spatial UMAP processing and the speed of that step.''')
+                st.selectbox('Area Boundary Method', options = ['ellipse', 'hull'], key = 'area_method',
+                             disabled=not st.session_state['calc_unique_areas_toggle'],
+                             help = '''How the edge of the tissue is determined when calculating
+                             unique areas. "ellipse" fits an ellipse to the cells of each image
+                             and measures the areas on a pixel mask. "hull" uses the convex hull
+                             of the cells of each image and calculates the areas exactly, which
+                             is much faster on large images.''')
             with neipro_settings[1]:
                 st.markdown(f'''Smallest image in dataset is {st.session_state.datafile_min_img_size} cells.
                             What percentage from each image should be used for the UMAP fitting step?''')
@@ -20,6 +20,9 @@ def main():
     # Set default widget values
     streamlit_utils.assign_default_values_in_session_state('num_workers', 7)
     streamlit_utils.assign_default_values_in_session_state('use_multiprocessing', True)
+    streamlit_utils.assign_default_values_in_session_state('neighbor_counts_nworkers', 0)
+    streamlit_utils.assign_default_values_in_session_state('single_dist_mat_cutoff_in_mb', 200)
+    streamlit_utils.assign_default_values_in_session_state('total_dist_mat_cutoff_in_mb', 0)
     block_names = ['Instantiate TIME class', 'Plot ROIs', 'Calculate P values', 'Check metrics, impose plotting settings, and convert to numpy format', 'Plot density heatmaps per ROI', 'Plot ROI outlines individually on the whole slides', 'Average density P values over ROIs for each slide', 'Plot all ROI outlines on the whole slides', 'Average density P values over ROIs for each annotation region type', 'Plot density P values for each ROI over slide spatial plot']
     component_bool_defaults = [True, True, True, True, True, True, True, True, False, False]
     component_checkbox_disabled = [False, False, False, False, False, False, False, False, False, False]
@@ -59,6 +62,11 @@ def main():
         # Get the number of threads to use for the calculations
         num_workers = st.number_input('Select number of threads for calculations:', min_value=1, max_value=os.cpu_count(), step=1, key='num_workers', disabled=(not use_multiprocessing))
 
+        # Get the number of threads and the memory budgets for counting the neighbors within each ROI when calculating the P values
+        neighbor_counts_nworkers = st.number_input('Select number of threads for counting neighbors within each ROI (0 for automatic):', min_value=0, max_value=os.cpu_count(), step=1, key='neighbor_counts_nworkers', help='Automatic uses all CPUs when the ROIs are processed one at a time and a single thread per ROI when multiple logical CPUs are used above.')
+        single_dist_mat_cutoff_in_mb = st.number_input('Select memory budget per neighbor counting thread (MB):', min_value=1, step=50, key='single_dist_mat_cutoff_in_mb', help='Maximum size of the distance matrix computed at once by each thread.')
+        total_dist_mat_cutoff_in_mb = st.number_input('Select total memory budget for neighbor counting (MB; 0 for automatic):', min_value=0, step=100, key='total_dist_mat_cutoff_in_mb', help='Maximum total size of the distance matrices computed at once by all threads, which limits the number of threads actually used. Automatic uses a quarter of the available memory.')
+
     with col_output:
 
         # Section title
@@ -112,7 +120,10 @@ def main():
                 start_time = time.time()
                 slices.calculate_metrics(
                     nworkers=num_workers,
-                    use_multiprocessing=use_multiprocessing
+                    use_multiprocessing=use_multiprocessing,
+                    single_dist_mat_cutoff_in_mb=single_dist_mat_cutoff_in_mb,
+                    total_dist_mat_cutoff_in_mb=(total_dist_mat_cutoff_in_mb if total_dist_mat_cutoff_in_mb > 0 else None),
+                    neighbor_counts_nworkers=(neighbor_counts_nworkers if neighbor_counts_nworkers > 0 else None)
                     )
                 benchmarking_message = '...calculate_metrics() took {} seconds using {} CPU(s) {} hyperthreading'.format(int(np.round(time.time() - start_time)), (num_workers if use_multiprocessing else 1), ('WITH' if use_multiprocessing else 'WITHOUT'))
                 print('')
@@ -4,6 +4,17 @@ import new_phenotyping_lib
 save_image_ext = 'jpg'
 # save_image_ext = 'png'
 
+# Fields (and their dtypes) of the columnar metrics store (see create_metrics_store() and finalize_metrics_store()), stored per center/neighbor/slice and per ROI, respectively
+metrics_store_pair_fields = {'has_data': 'bool', 'has_density_metrics': 'bool', 'nvalid_centers': 'int64', 'z_score': 'float64', 'left_pval': 'float64', 'right_pval': 'float64', 'nexpected': 'float64', 'npossible_neighbors': 'float64', 'roi_area_used': 'float64', 'slice_area_used': 'float64'}
+metrics_store_roi_fields = {'species_in_roi': 'bool', 'roi_min_coord_spacing': 'float64', 'roi_x_range': 'float64', 'roi_y_range': 'float64'}
+
+# Columns of df_data_by_roi sent to calculate_metrics_for_roi() for the ROI being processed
+roi_payload_columns = ['unique_roi', 'x_roi', 'y_roi', 'species_roi', 'x_min_prior_to_decimation', 'x_max_prior_to_decimation', 'y_min_prior_to_decimation', 'y_max_prior_to_decimation', 'x_range', 'y_range', 'spec2plot_roi']
+
+# Version of the metrics calculation, hashed into every metrics cache key (see get_metrics_cache_key()) so that bumping it invalidates all cached ROI and species pair results
+metrics_cache_version = 1
+
+
 class TIMECellInteraction:
     '''
     Instantiation of this class mainly loads Consolidata_data.txt into a Pandas dataframe (or reads in a simulated one in the case of simulated data) and performs some preprocessing on it
@@ -139,7 +150,7 @@ class TIMECellInteraction:
             self.webpage_dir = webpage_dir
 
 
-    def calculate_metrics(self, nworkers=1, do_logging=True, use_multiprocessing=True, delete_intermediate_pkl_files=True, keep_unnecessary_calculations=False):
+    def calculate_metrics(self, nworkers=1, do_logging=True, use_multiprocessing=True, delete_intermediate_pkl_files=True, keep_unnecessary_calculations=False, single_dist_mat_cutoff_in_mb=None, total_dist_mat_cutoff_in_mb=None, neighbor_counts_nworkers=None):
         '''
         Calculate the P values (and Z scores) from the coordinates of the species in every ROI in every slide.
 
@@ -156,11 +167,15 @@ class TIMECellInteraction:
           * Took ~47 (later: 65) minutes on laptop
           * Units here should be in the same units provided in Consolidated_data.txt (which were originally half-microns, i.e., for dr=8, each slice is 4 microns thick)
           * nworkers should probably be the number of CPUs allocated by SLURM less 1 just to be safe
+          * single_dist_mat_cutoff_in_mb, total_dist_mat_cutoff_in_mb, and neighbor_counts_nworkers are the per-thread memory budget, total memory budget, and number of threads of the neighbor counting within each ROI (see utils.get_neighbor_counts_settings() for their defaults). In particular, by default the neighbor counting uses all the CPUs when the ROIs are processed in serial and a single thread in each worker when they're processed by a pool. The counts are identical regardless
+          * The results are streamed from the workers as typed arrays into the columnar store pickle_dir/calculated_metrics (see create_metrics_store()), which is memory-mapped into self.metrics_store, so that peak memory is bounded by a single ROI's results. The full legacy data structure (self.metrics) is only available if keep_unnecessary_calculations is True, in which case its ROIs are loaded lazily from their individual pickle files (see LazyROIPickleList)
+          * The log messages of each ROI are captured in memory by its worker and written to output/logs/calculated_metrics.log in slide order
+          * The results of each ROI are cached in pickle_dir/metrics_cache under a hash of the ROI's coordinates, species, and extent and the settings affecting the metrics, so rerunning after changing the phenotypes or settings recalculates only the ROIs whose inputs actually changed, and within those only the center/neighbor species pairs whose coordinates changed
         '''
 
         # Import relevant libraries
         import os
-        import subprocess
+        import numpy as np
 
         # Set variables already defined as attributes
         unique_slides = self.unique_slides
@@ -179,96 +194,145 @@ class TIMECellInteraction:
         self.dr = thickness
 
         # Constants
-        pickle_file = 'calculated_metrics.pkl'
+        store_dir = os.path.join(pickle_dir, 'calculated_metrics')
+        cache_dir = os.path.join(pickle_dir, 'metrics_cache')
 
-        # If the pickle file doesn't already exist...
-        if not os.path.exists(os.path.join(pickle_dir, pickle_file)):
+        # Experiment-wide variables
+        all_species_list = [x[0] for x in plotting_map]
+        nall_species = len(all_species_list)
+        log_file = 'calculated_metrics.log'
+        slice_edges = np.arange(nslices + 1) * thickness
+
+        # Get the ROI indexes in slide order, which is the order of the ROIs in the store
+        roi_indexes = [roi_index for uslide in unique_slides for roi_index in df_data_by_roi.index[df_data_by_roi['unique_slide'] == uslide]]
+
+        # Determine the content-addressed cache key of every ROI from its data and the settings affecting the metrics, and from these the key of the entire store
+        metrics_params = (nslices, thickness, n_neighs, radius_instead_of_knn, min_coord_spacing, use_analytical_significance)
+        roi_payloads = {roi_index: df_data_by_roi.loc[roi_index, roi_payload_columns].to_dict() for roi_index in roi_indexes}
+        roi_cache_keys = {roi_index: get_roi_metrics_cache_key(roi_payloads[roi_index], metrics_params, all_species_list) for roi_index in roi_indexes}
+        store_key = get_metrics_cache_key('store', roi_indexes, [roi_cache_keys[roi_index] for roi_index in roi_indexes])
+
+        # Determine whether the metrics store has been completely written (its ROI index column is written last) for the current data and settings
+        store_key_file = os.path.join(store_dir, 'store_key.txt')
+        store_is_current = False
+        if os.path.exists(os.path.join(store_dir, 'roi_index.npy')) and os.path.exists(store_key_file):
+            with open(store_key_file, 'r') as f:
+                store_is_current = (f.read().strip() == store_key)
+
+        # If the metrics store is missing, incomplete, or stale...
+        if not store_is_current:
 
             # Print what we're doing
             print('Calculating metrics...')
 
-            # Experiment-wide variables
-            all_species_list = [x[0] for x in plotting_map]
-            nall_species = len(all_species_list)
-            nrois = len(df_data_by_roi)
-            log_file = 'calculated_metrics.log'
-
-            # ---- Calculate the metrics for all the ROIs that haven't already been calculated, saving the results in individual pickle files
-
-            # Determine the ROIs whose metrics need to be calculated, i.e., those whose corresponding pickle files are not present on the filesystem
-            retval = subprocess.run(['ls {}/calculated_metrics-roi_index_*.pkl'.format(pickle_dir)], shell=True, capture_output=True)
-            roi_ids_not_present = set(range(nrois)) - set([int(x.split('.pkl')[0].split('_')[-1]) for x in retval.stdout.decode().split('\n')[:-1]])
-
-            # Generate a list of tuple arguments each of which is inputted into calculate_metrics_for_roi() to be run by a single worker
-            constant_tuple = (pickle_dir, nslices, thickness, n_neighs, radius_instead_of_knn, min_coord_spacing, all_species_list, nall_species, do_logging, use_analytical_significance, df_data_by_roi, keep_unnecessary_calculations, nworkers)
+            # ---- Calculate the metrics for all the ROIs whose results aren't already in the content-addressed cache, saving the results in individual .npz files named by their cache keys
+
+            # Determine the ROIs whose metrics need to be calculated. Cached results for outdated data or settings are never picked up since their keys differ. Identical ROIs are calculated only once, unless the full legacy data structure (which isn't cached) is requested, in which case the ROIs missing their legacy pickle files are recalculated too
+            os.makedirs(cache_dir, exist_ok=True)
+            roi_cache_files = {roi_index: os.path.join(cache_dir, 'roi-{}.npz'.format(roi_cache_keys[roi_index])) for roi_index in roi_indexes}
+            rois_to_calculate = {}
+            for roi_index in roi_indexes:
+                if keep_unnecessary_calculations:
+                    if (not os.path.exists(roi_cache_files[roi_index])) or (not os.path.exists(os.path.join(pickle_dir, 'calculated_metrics-roi_index_{:06}.pkl'.format(roi_index)))):
+                        rois_to_calculate[roi_index] = roi_index
+                elif not os.path.exists(roi_cache_files[roi_index]):
+                    rois_to_calculate.setdefault(roi_cache_keys[roi_index], roi_index)
+            rois_to_calculate = list(rois_to_calculate.values())
+            print('Reusing the cached metrics of {} of {} ROIs'.format(len(roi_indexes) - len(rois_to_calculate), len(roi_indexes)))
+
+            # For each ROI to be calculated, get the cached results of the most recent calculation for the ROI of the same name, from which the results of the species pairs whose data haven't changed get reused
+            previous_roi_cache_files = {}
+            for roi_index in rois_to_calculate:
+                previous_roi_cache_files[roi_index] = None
+                latest_file = os.path.join(cache_dir, 'latest-{}.txt'.format(get_metrics_cache_key('name', roi_payloads[roi_index]['unique_roi'])))
+                if os.path.exists(latest_file):
+                    with open(latest_file, 'r') as f:
+                        previous_roi_cache_file = os.path.join(cache_dir, 'roi-{}.npz'.format(f.read().strip()))
+                    if os.path.exists(previous_roi_cache_file):
+                        previous_roi_cache_files[roi_index] = previous_roi_cache_file
+
+            # Generate a list of tuple arguments each of which is inputted into calculate_metrics_for_roi() to be run by a single worker. Only the current ROI's data (rather than all of df_data_by_roi) get sent with each tuple
+            constant_tuple = (pickle_dir, nslices, thickness, n_neighs, radius_instead_of_knn, min_coord_spacing, all_species_list, nall_species, do_logging, use_analytical_significance, keep_unnecessary_calculations, nworkers, single_dist_mat_cutoff_in_mb, total_dist_mat_cutoff_in_mb, neighbor_counts_nworkers)
             # list_of_tuple_arguments = [constant_tuple + (x,) for x in range(nrois)]  # doing it this lazy way potentially messes up the multiprocessing module, causing too many unnecessary-to-be-calculated ROIs to be sent into the Pool, causing only a single worker to actually be used
-            list_of_tuple_arguments = [constant_tuple + (x,) for x in roi_ids_not_present]
+            list_of_tuple_arguments = [constant_tuple + (roi_payloads[x], x, roi_cache_files[x], previous_roi_cache_files[x]) for x in rois_to_calculate]
+
+            # Create the empty metrics store, into which each ROI's results get written as soon as they stream back from the workers. Identical ROIs (those sharing a cache key) are written from the same results
+            store_columns = create_metrics_store(store_dir, len(roi_indexes), nall_species, nslices)
+            store_positions = {}
+            for iroi, roi_index in enumerate(roi_indexes):
+                store_positions.setdefault(roi_cache_keys[roi_index], []).append(iroi)
+            rois_written = np.zeros(len(roi_indexes), dtype=bool)
+            roi_log_lines = {}
+
+            # Function writing the results of a single ROI into the store, and holding onto its log messages, as they arrive
+            def store_roi_results(roi_results):
+                roi_log_lines[roi_results['roi_index']] = roi_results['log_lines']
+                if roi_results['metrics_arrays'] is not None:
+                    for iroi in store_positions[roi_cache_keys[roi_results['roi_index']]]:
+                        write_roi_to_metrics_store(store_columns, iroi, roi_results['metrics_arrays'])
+                        rois_written[iroi] = True
 
             # Since Squidpy commandeers multiprocessing, completely disable it if Squidpy has been requested
             if use_analytical_significance:
-                # Farm out the metrics calculations to the worker CPUs. This ensures that a pickle file gets created for each ROI
-                utils.execute_data_parallelism_potentially(function=calculate_metrics_for_roi, list_of_tuple_arguments=list_of_tuple_arguments, nworkers=(0 if not use_multiprocessing else nworkers), task_description='calculation of ROI metrics (Poisson)')
+                # Make sure the calibration behind the 'auto' neighbor counting method is measured (and cached locally) up front rather than by every worker at once
+                utils.get_neighbor_counts_calibration()
+
+                # Farm out the metrics calculations to the worker CPUs. This ensures that a cached .npz file gets created for each ROI
+                utils.execute_data_parallelism_potentially(function=calculate_metrics_for_roi, list_of_tuple_arguments=list_of_tuple_arguments, nworkers=(0 if not use_multiprocessing else nworkers), task_description='calculation of ROI metrics (Poisson)', result_callback=store_roi_results)
             else:  # Squidpy is being requested
                 print('Running {} function calls using 1 worker WITHOUT the multiprocessing module because Squidpy is being employed, which commandeers threads'.format(len(list_of_tuple_arguments)))
-                utils.execute_data_parallelism_potentially(function=calculate_metrics_for_roi, list_of_tuple_arguments=list_of_tuple_arguments, nworkers=0, task_description='calculation of ROI metrics (permutation test)')
-
-            # ---- Load the resulting individual pickle files into a new, single pickle file called calculated_metrics.pkl
-
-            # For each slide...
-            data_by_slide = []
-            roi_pickle_files = []  # store filenames to delete later
-            roi_log_files = []
-            for uslide in unique_slides:
-                print('Reading slide ' + uslide + '...')
-
-                # Get the unique ROIs in the current slide
-                unique_rois = df_data_by_roi[df_data_by_roi['unique_slide'] == uslide]['unique_roi'].unique()  # note the .unique() is likely unneeded
+                utils.execute_data_parallelism_potentially(function=calculate_metrics_for_roi, list_of_tuple_arguments=list_of_tuple_arguments, nworkers=0, task_description='calculation of ROI metrics (permutation test)', result_callback=store_roi_results)
 
-                # For each ROI in the slide...
-                data_by_roi = []
-                for uroi in unique_rois:
-                    print('  Reading ROI ' + uroi + '...')
+                # Identical ROIs are only calculated once, so give the others copies of the Squidpy images under their own names
+                copy_squidpy_images_to_identical_rois(roi_indexes, roi_cache_keys, {roi_index: roi_payloads[roi_index]['unique_roi'] for roi_index in roi_indexes})
 
-                    # Load the appropriate pickle file
-                    roi_index = df_data_by_roi.loc[df_data_by_roi['unique_roi'] == uroi, :].index[0]
-                    roi_pickle_file = 'calculated_metrics-roi_index_{:06}.pkl'.format(roi_index)
-                    roi_pickle_files.append(roi_pickle_file)
-                    roi_log_files.append('calculated_metrics-roi_index_{:06}.log'.format(roi_index))
-                    roi_data_item = load_pickle(pickle_dir, roi_pickle_file)
-
-                    # Save the loaded data
-                    data_by_roi.append(roi_data_item)
-                data_by_slide.append([uslide, unique_rois, data_by_roi])  # save the current slide data and the inputted parameters
+            # Write the ROIs that weren't calculated into the store from their cached .npz files, one at a time
+            for iroi in np.nonzero(~rois_written)[0]:
+                with np.load(roi_cache_files[roi_indexes[iroi]]) as roi_arrays:
+                    write_roi_to_metrics_store(store_columns, iroi, roi_arrays)
 
-            # Create the single pickle file saving all the data
-            make_pickle(data_by_slide, pickle_dir, pickle_file)
+            # Complete the store
+            finalize_metrics_store(store_dir, store_columns, roi_indexes, all_species_list, slice_edges, store_key=store_key)
+            del store_columns
 
-            # Concatenate all metrics calculation log files (one per ROI) into a single log file
-            logs_dir = os.path.join('.', 'output', 'logs')
-            if not os.path.exists(logs_dir):
-                os.makedirs(logs_dir)
-            with open(os.path.join(logs_dir, log_file), 'w') as outfile:
-                for roi_log_file in roi_log_files:
-                    with open(os.path.join(pickle_dir, roi_log_file)) as infile:
-                        outfile.write(infile.read())
+            # Record the current cache key of each ROI name for the species pair reuse of the next calculation
+            for roi_index in roi_indexes:
+                with open(os.path.join(cache_dir, 'latest-{}.txt'.format(get_metrics_cache_key('name', roi_payloads[roi_index]['unique_roi']))), 'w') as f:
+                    f.write(roi_cache_keys[roi_index])
 
-            # If the overall pickle file was successfully created, delete all intermediate pickle files for the ROIs
+            # Write the captured log messages of all the calculated ROIs, in slide order, to a single log file
+            if do_logging:
+                logs_dir = os.path.join('.', 'output', 'logs')
+                os.makedirs(logs_dir, exist_ok=True)
+                with open(os.path.join(logs_dir, log_file), 'w') as f:
+                    for roi_index in roi_indexes:
+                        for log_line in roi_log_lines.get(roi_index, []):
+                            f.write(log_line + '\n')
+
+            # Delete the cached ROI results that no longer correspond to any ROI (e.g., from before the data or settings changed), as well as the legacy pickle files if the full legacy data structure isn't wanted
             if delete_intermediate_pkl_files:
-                if os.path.exists(os.path.join(pickle_dir, pickle_file)):
-                    for roi_pickle_file in roi_pickle_files:
-                        os.remove(os.path.join(pickle_dir, roi_pickle_file))
-
-            # If the overall log file was successfully created, delete all intermediate log files for the ROIs
-            if os.path.exists(os.path.join(logs_dir, log_file)):
-                for roi_log_file in roi_log_files:
-                    os.remove(os.path.join(pickle_dir, roi_log_file))
-
-        # If the pickle file already exists, load it
+                current_cache_files = set(os.path.basename(x) for x in roi_cache_files.values())
+                for cache_file in os.listdir(cache_dir):
+                    if cache_file.startswith('roi-') and cache_file.endswith('.npz') and (cache_file not in current_cache_files):
+                        os.remove(os.path.join(cache_dir, cache_file))
+                if not keep_unnecessary_calculations:
+                    for roi_index in roi_indexes:
+                        roi_pickle_file = os.path.join(pickle_dir, 'calculated_metrics-roi_index_{:06}.pkl'.format(roi_index))
+                        if os.path.exists(roi_pickle_file):
+                            os.remove(roi_pickle_file)
+
+        # Save the memory-mapped metrics store as a property of the class object
+        self.metrics_store = load_metrics_store(store_dir)
+
+        # Save the full legacy data structure as a property of the class object if it was requested and exists (it is only needed by the legacy plotting methods). This is in the [[uslide, unique_rois, data_by_roi], ...] format of the former calculated_metrics.pkl, except that each ROI's data are only loaded from its individual pickle file when accessed
+        roi_pickle_files = ['calculated_metrics-roi_index_{:06}.pkl'.format(roi_index) for roi_index in roi_indexes]
+        if keep_unnecessary_calculations and all(os.path.exists(os.path.join(pickle_dir, x)) for x in roi_pickle_files):
+            self.metrics = []
+            for uslide in unique_slides:
+                slide_roi_indexes = df_data_by_roi.index[df_data_by_roi['unique_slide'] == uslide]
+                self.metrics.append([uslide, df_data_by_roi.loc[slide_roi_indexes, 'unique_roi'].values, LazyROIPickleList(pickle_dir, ['calculated_metrics-roi_index_{:06}.pkl'.format(roi_index) for roi_index in slide_roi_indexes])])
         else:
-            data_by_slide = load_pickle(pickle_dir, pickle_file)
-
-        # Save the calculated data as a property of the class object
-        self.metrics = data_by_slide
+            self.metrics = None
 
         # Create a density P value Pandas dataframe from the just-calculated metrics
         self.flatten_density_pvals()
@@ -936,7 +1000,7 @@ class TIMECellInteraction:
         '''
 
         # Import relevant libraries
-        # import pandas as pd
+        import pandas as pd
         import numpy as np
         import seaborn as sns
         import matplotlib.pyplot as plt
@@ -978,60 +1042,39 @@ class TIMECellInteraction:
 
             # Initialize the arrays of interest
             nmatches_holder    = np.zeros((nunique_slides, nall_species, nall_species, nslices))
-            log_dens_pvals_avg = np.zeros((nunique_slides, nall_species, nall_species, 2, nslices))
-            # log_pmf_pvals_avg  = np.zeros((nunique_slides, nall_species, nall_species, max_nbins, 2, nslices))
+            log_dens_pvals_avg = np.full((nunique_slides, nall_species, nall_species, 2, nslices), np.nan)
 
             # Set the log of the P value range for the color plotting
             vmin = log_pval_range[0]
             vmax = log_pval_range[1]
 
-            # For every unique slide...
-            for islide, slide in enumerate(unique_slides[:]):
-
-                print('Averaging slide {}'.format(slide))
-
-                # For every possible center species...
-                for icenter_spec, center_spec in enumerate(all_species_ids[:]):
-
-                    # For every possible neighbor species...
-                    for ineighbor_spec, neighbor_spec in enumerate(all_species_ids[:]):
-
-                        # Get a temporary dataframe containing the current slide/center/neighbor combination (this will usually be five rows, one per ROI)
-                        df_tmp = df[(((df['slide_name'] == slide) & (df['center_species_id'] == center_spec) & (df['neighbor_species_id'] == neighbor_spec)))]
-                        nrows = len(df_tmp)
-
-                        # For every slice...
-                        for islice in range(nslices):
-
-                            # Initialize and populate the three temporary arrays
-                            nvalid_centers_holder = np.zeros((nrows,))
-                            log_dens_pvals = np.zeros((nrows, 2))
-                            # log_pmf_pvals = np.zeros((nrows, max_nbins, 2))
-                            # for irow, (nvalid_centers_per_slice, left_log_dens_pvals, right_log_dens_pvals, left_log_pmf_pvals, right_log_pmf_pvals) in enumerate(zip(df_tmp['nvalid_centers_per_slice'], df_tmp['left_log_dens_pvals'], df_tmp['right_log_dens_pvals'], df_tmp['left_log_pmf_pvals'], df_tmp['right_log_pmf_pvals'])):
-                            for irow, (nvalid_centers_per_slice, left_log_dens_pvals, right_log_dens_pvals) in enumerate(zip(df_tmp['nvalid_centers_per_slice'], df_tmp['left_log_dens_pvals'], df_tmp['right_log_dens_pvals'])):
-                                nvalid_centers_holder[irow] = nvalid_centers_per_slice[islice]
-                                log_dens_pvals[irow, :] = np.array([left_log_dens_pvals[0][islice], right_log_dens_pvals[0][islice]])  # (2,)
-                                # log_pmf_pvals[irow, :, :] = np.c_[left_log_pmf_pvals[:, islice], right_log_pmf_pvals[:, islice]]  # (max_nbins,2)
-
-                            # Determine the rows in the temporary dataframe that have at least 1 valid center
-                            matches = nvalid_centers_holder >= min_num_valid_centers  # (nrows,)
-                            nmatches = matches.sum()
-                            nmatches_holder[islide, icenter_spec, ineighbor_spec, islice] = nmatches
-
-                            # Perform the weighted averaging over the ROIs
-                            if nmatches >= 1:
-                                log_dens_pvals_tmp = log_dens_pvals[matches, :]
-                                log_dens_pvals_tmp[np.isneginf(log_dens_pvals_tmp)] = vmin
-                                if weight_rois_by_num_valid_centers:
-                                    nvalid_centers_tmp = nvalid_centers_holder[matches][:, np.newaxis]  # (nmatches, 1)
-                                    log_dens_pvals_avg[islide, icenter_spec, ineighbor_spec, :, islice] = (nvalid_centers_tmp * log_dens_pvals_tmp).sum(axis=0) / nvalid_centers_tmp.sum(axis=0)  # (2,)
-                                else:
-                                    log_dens_pvals_avg[islide, icenter_spec, ineighbor_spec, :, islice] = (log_dens_pvals_tmp).sum(axis=0) / nmatches  # (2,)
-                                # nvalid_centers_tmp = nvalid_centers_tmp[:, :, np.newaxis]  # (nmatches, 1, 1)
-                                # log_pmf_pvals_avg[islide, icenter_spec, ineighbor_spec, :, :, islice] = (nvalid_centers_tmp * log_pmf_pvals[matches, :, :]).sum(axis=0) / nvalid_centers_tmp.sum(axis=0)  # (max_nbins, 2)
-                            else:
-                                log_dens_pvals_avg[islide, icenter_spec, ineighbor_spec, :, islice] = None
-                                # log_pmf_pvals_avg[islide, icenter_spec, ineighbor_spec, :, :, islice] = None
+            print('Averaging {} slides'.format(nunique_slides))
+
+            # Keep only the rows (ROIs/centers/neighbors/slices) having at least the minimum number of valid centers, for the centers and neighbors in the experiment
+            species_index_from_id = {species_id: ispecies for ispecies, species_id in enumerate(all_species_ids)}
+            df_matches = df[(df['nvalid_centers'] >= min_num_valid_centers) & df['center_species_id'].isin(species_index_from_id) & df['neighbor_species_id'].isin(species_index_from_id)]
+
+            # Get the weight of every ROI and its weighted left and right log density P values, setting the (negative) infinite values to the darkest color
+            weights = (df_matches['nvalid_centers'].to_numpy(dtype=float) if weight_rois_by_num_valid_centers else np.ones(len(df_matches)))
+            log_dens_pvals = df_matches[['left_log_dens_pval', 'right_log_dens_pval']].to_numpy(dtype=float)  # (nrows, 2)
+            log_dens_pvals[np.isneginf(log_dens_pvals)] = vmin
+            df_weighted = pd.DataFrame({
+                'islide': df_matches['slide_name'].map({slide: islide for islide, slide in enumerate(unique_slides)}).to_numpy(),
+                'icenter_spec': df_matches['center_species_id'].map(species_index_from_id).to_numpy(),
+                'ineighbor_spec': df_matches['neighbor_species_id'].map(species_index_from_id).to_numpy(),
+                'islice': df_matches['slice'].to_numpy(),
+                'nmatches': 1,
+                'weight': weights,
+                'weighted_left_log_dens_pval': weights * log_dens_pvals[:, 0],
+                'weighted_right_log_dens_pval': weights * log_dens_pvals[:, 1]
+            })
+
+            # Perform the weighted averaging over the ROIs for every slide/center/neighbor/slice at once; the combinations without any matching ROIs remain NaN
+            df_sums = df_weighted.groupby(by=['islide', 'icenter_spec', 'ineighbor_spec', 'islice'], sort=False).sum()
+            index = tuple(df_sums.index.get_level_values(level) for level in range(4))
+            nmatches_holder[index] = df_sums['nmatches'].to_numpy()
+            log_dens_pvals_avg[index[:3] + (0, index[3])] = (df_sums['weighted_left_log_dens_pval'] / df_sums['weight']).to_numpy()
+            log_dens_pvals_avg[index[:3] + (1, index[3])] = (df_sums['weighted_right_log_dens_pval'] / df_sums['weight']).to_numpy()
 
             # Set the (negative) infinite values to the darkest color (or else they won't be plotted, as inf values are not plotted)
             # log_dens_pvals_avg[np.isneginf(log_dens_pvals_avg)] = vmin
@@ -1459,29 +1502,25 @@ class TIMECellInteraction:
 
 
     def flatten_density_pvals(self):
-        """Return a Pandas dataframe of the heatmap data (the log of the density P values) flattened to a single dataframe, just like is obtained from slices.filedata. This can be directly compared with slices.filedata using:
+        """Flatten the density P values in the columnar metrics store (self.metrics_store) written by calculate_metrics() into a long-format Pandas dataframe (self.df_density_pvals) having a row per ROI/center/neighbor/slice and plain (non-object) columns.
 
-        pd.DataFrame(data=slices.filedata).drop(['roi_fig_pathname', 'pvals_fig_pathname', 'left_log_pmf_pvals', 'right_log_pmf_pvals'], axis='columns').equals(slices.flatten_density_pvals())
+        Rows are only created where both the center and neighbor species exist in the ROI and there is at least 1 *valid* center (so that density metrics exist), with the rows ordered by slide, ROI, center species, neighbor species, and slice. The combinations lacking data are only counted and reported, which is useful for debugging.
 
-        Also, output a log describing what data are *not* present in slices.metrics, which is useful for debugging.
+        See utils.create_filedata_from_metrics_log() for some more details of the two different situations when no data are obtained (i.e., when (1) either the centers or neighbors do not exist in the ROI, or (2) they both exist but there are no *valid* centers).
 
-        See utils.create_filedata_from_metrics_log() for some more details of the comments below that describe the two different situations when None values are obtains (i.e., when (1) either the centers or neighbors do not exist in the ROI, or (2) they both exist but there are no *valid* centers).
-
-        This function adds rows to df_density_pvals if both a center and neighbor exist and there is at least 1 *valid* center.
-
-        Returns:
-            Pandas dataframe: Dataframe holding the bare minimum heatmap data.
+        The columns are roi_index, roi_name, nrois_in_slide, roi_x_min, roi_x_max, roi_y_min, roi_y_max, roi_spacing, center_species_id, neighbor_species_id, center_species_name, neighbor_species_name, slice, nvalid_centers, left_log_dens_pval, and right_log_dens_pval.
         """
 
         # Import relevant libraries
         import numpy as np
         import pandas as pd
-        import os
 
         # Define variables already defined as attributes
-        metrics = self.metrics
+        metrics_store = self.metrics_store
         plotting_map = self.plotting_map
         mapping_dict = self.mapping_dict
+        df_data_by_roi = self.df_data_by_roi
+        unique_slides = self.unique_slides
 
         # Print what we're doing
         print('Flattening the calculated metrics into a single dataframe...')
@@ -1489,93 +1528,56 @@ class TIMECellInteraction:
         # Get the full list of phenotypes in the dataset in decreasing frequency order
         plotting_map_species = [x[0] for x in plotting_map]  # same as all_species_list previously
         num_all_species = len(plotting_map_species)  # same as nall_species previously
-        range_num_all_species = range(num_all_species)
+        all_species_list = np.array(metrics_store['all_species_ids'])
 
         # Get an array of the species names in decreasing frequency order
-        # all_species_list = [x[0] for x in plotting_map]
-        # nall_species = len(all_species_list)
         if mapping_dict is not None:
             species_names = [get_descriptive_cell_label(x[1], mapping_dict)[0] for x in plotting_map]
         else:
             species_names = [phenotypes_to_string(x[1]) for x in plotting_map]
 
-        # Initialize the main file data holder that will be concatenated into a Pandas dataframe
-        filedata_list = []
-
-        # Open a log file for writing notes about the data as we add it to the filedata structure
-        logs_dir = os.path.join('.', 'output', 'logs')
-        if not os.path.exists(logs_dir):
-            os.makedirs(logs_dir)
-        with open(os.path.join(logs_dir, 'metrics_check.log'), 'wt') as f:
-
-            num_slides = len(metrics)
-
-            # For every slide...
-            progress_int_old = 0
-            for islide, (curr_slide, unique_rois, data_by_roi) in enumerate(metrics):  # for each slide of metrics data...
-
-                # Determine the number of ROIs in the current slide
-                nrois_in_slide = len(unique_rois)  # get the number of ROIs in the current slide; I checked that this len always equals that of data_by_roi but I can always add an assert statement to make sure
-
-                # For every ROI in the current slide...
-                for iroi, (roi_name, roi_data) in enumerate(zip(unique_rois, data_by_roi)):
-
-                    # Don't do tuple unpacking in the loop definition but do it here so we can explicitly define roi_data to save for later
-                    roi_min_coord_spacing = roi_data['roi_min_coord_spacing']
-                    unique_species_in_roi = roi_data['unique_species_in_roi']
-                    real_data = roi_data['real_data']
-                    all_species_list = roi_data['all_species_list']
-                    roi_x_range = roi_data['roi_x_range']
-                    roi_y_range = roi_data['roi_y_range']
-
-                    # For every center-neighbor combination in the current ROI...
-                    for icenter_spec in range_num_all_species:
-                        for ineighbor_spec in range_num_all_species:
-
-                            # Get an ID string for the current slide/ROI/center/neighbor
-                            center_species_id = all_species_list[icenter_spec]
-                            neighbor_species_id = all_species_list[ineighbor_spec]
-                            current_id = 'slide {}, roi {}, center_spec {}, neighbor_spec {}'.format(curr_slide, roi_name, center_species_id, neighbor_species_id)
-
-                            # Get the current dataset
-                            curr_real_data = real_data[icenter_spec, ineighbor_spec, 0]
-
-                            # If there is no current dataset (i.e., when either the center or neighbor species does not exist in the ROI), say so
-                            if curr_real_data is None:
-                                f.write('NOTE: No real data exist for {}\n'.format(current_id))
-
-                            # If there currently is a real dataset (i.e., if both the center and neighbor species are in the ROI)...
-                            else:
-
-                                # Extract the individual pieces from the current real dataset
-                                density_metrics_real, pmf_metrics_real, nexpected_real, nvalid_centers_real, coords_centers_real, coords_neighbors_real, valid_centers_real, edges_real, npossible_neighbors_real, roi_area_used_real, slice_area_used_real, center_species, neighbor_species, small_rad, large_rad, islice = curr_real_data
-
-                                # If there is no current set of density metrics (i.e., there are no *valid* centers), say so
-                                if density_metrics_real is None:
-                                    f.write('NOTE: Real data exist but the density metrics do not for {}\n'.format(current_id))
-
-                                # If there currently is a set of density metrics (i.e., there are *some* valid centers)...
-                                else:
-
-                                    # Extract the individual pieces from the current density metrics
-                                    z_score, left_p_val, right_p_val = density_metrics_real
-
-                                    # Print a warning if either the left or right P values do not exist (this never occurs)
-                                    if (left_p_val is None) or (right_p_val is None):
-                                        f.write('NOTE: Density metrics exist but the left ({}) and/or right ({}) P values are None for {}\n'.format(left_p_val, right_p_val, current_id))
-
-                                    # If both the left and right P values exist, which at this point they always do, add all relevant data to the filedata structure
-                                    else:
-                                        filedata_list.append({'nrois_in_slide': nrois_in_slide, 'roi_name': roi_name, 'unique_species_in_roi': list(filter(lambda x: x in unique_species_in_roi, plotting_map_species)), 'roi_x_range': np.array(roi_x_range), 'roi_y_range': np.array(roi_y_range), 'roi_spacing': roi_min_coord_spacing, 'center_species_id': center_species_id, 'neighbor_species_id': neighbor_species_id, 'center_species_name': species_names[icenter_spec], 'neighbor_species_name': species_names[ineighbor_spec], 'nvalid_centers_per_slice': [nvalid_centers_real], 'left_log_dens_pvals': [[np.log10(left_p_val)]], 'right_log_dens_pvals': [[np.log10(right_p_val)]]})
-
-                    # Output flattening progress
-                    progress_int = round((iroi + 1) / nrois_in_slide * (islide + 1) / num_slides * 100)
-                    if progress_int != progress_int_old:
-                        print('{:d}% done flattening calculated metrics'.format(progress_int), end="\r")
-                        progress_int_old = progress_int
-
-        # Return a Pandas dataframe from the filedata structure
-        self.df_density_pvals = pd.DataFrame(data=filedata_list)
+        # Get the ROIs in slide order and their corresponding rows in the metrics store
+        df_rois = pd.concat([df_data_by_roi[df_data_by_roi['unique_slide'] == curr_slide] for curr_slide in unique_slides])
+        store_rows = pd.Series(np.arange(len(metrics_store['roi_index'])), index=metrics_store['roi_index'])[df_rois.index].to_numpy()
+
+        # Read the per-pair arrays of those ROIs from the store, each of shape (nrois, nall_species, nall_species, nslices)
+        has_data = np.asarray(metrics_store['has_data'])[store_rows]
+        has_density_metrics = np.asarray(metrics_store['has_density_metrics'])[store_rows]
+        left_pvals = np.asarray(metrics_store['left_pval'])[store_rows]
+        right_pvals = np.asarray(metrics_store['right_pval'])[store_rows]
+        has_pvals = has_density_metrics & ~np.isnan(left_pvals) & ~np.isnan(right_pvals)
+
+        # Report the ROI/center/neighbor/slice combinations for which there is no data (i.e., when either the center or neighbor species does not exist in the ROI), for which there are no density metrics (i.e., there are no *valid* centers), and for which the left or right P values do not exist (this never occurs)
+        print('NOTE: Of the {} ROI/center/neighbor/slice combinations, no real data exist for {}, real data exist but the density metrics do not for {}, and density metrics exist but the left and/or right P values do not for {}'.format(has_data.size, (~has_data).sum(), (has_data & ~has_density_metrics).sum(), (has_density_metrics & ~has_pvals).sum()))
+
+        # Get the indexes of the ROI/center/neighbor/slice combinations having both the left and right P values, which is C order, i.e., the order of the rows
+        iroi, icenter_spec, ineighbor_spec, islice = np.nonzero(has_pvals)
+
+        # Gather the per-ROI data for every row
+        roi_x_range = np.asarray(metrics_store['roi_x_range'])[store_rows][iroi]
+        roi_y_range = np.asarray(metrics_store['roi_y_range'])[store_rows][iroi]
+        nrois_in_slide = df_rois['unique_slide'].map(df_rois['unique_slide'].value_counts()).to_numpy()
+
+        # Create the long-format dataframe
+        with np.errstate(divide='ignore'):
+            self.df_density_pvals = pd.DataFrame({
+                'roi_index': df_rois.index.to_numpy()[iroi],
+                'roi_name': df_rois['unique_roi'].to_numpy()[iroi],
+                'nrois_in_slide': nrois_in_slide[iroi],
+                'roi_x_min': roi_x_range[:, 0],
+                'roi_x_max': roi_x_range[:, 1],
+                'roi_y_min': roi_y_range[:, 0],
+                'roi_y_max': roi_y_range[:, 1],
+                'roi_spacing': np.asarray(metrics_store['roi_min_coord_spacing'])[store_rows][iroi],
+                'center_species_id': all_species_list[icenter_spec],
+                'neighbor_species_id': all_species_list[ineighbor_spec],
+                'center_species_name': np.array(species_names)[icenter_spec],
+                'neighbor_species_name': np.array(species_names)[ineighbor_spec],
+                'slice': islice,
+                'nvalid_centers': np.asarray(metrics_store['nvalid_centers'])[store_rows][iroi, icenter_spec, ineighbor_spec, islice],
+                'left_log_dens_pval': np.log10(left_pvals[iroi, icenter_spec, ineighbor_spec, islice]),
+                'right_log_dens_pval': np.log10(right_pvals[iroi, icenter_spec, ineighbor_spec, islice])
+            })
 
         # Define some items we used to pass using "metadata"
         self.all_species_names = species_names
@@ -1863,7 +1865,7 @@ class TIMECellInteraction:
             # ---- Check and put into array form the metrics for all the ROIs that haven't already been processed, saving the results in individual pickle files
 
             # Determine the ROIs and indexes that are present in the metrics data and that have at least one center species with a minimum number of valid centers
-            max_num_valid_centers_per_roi = df_density_pvals.groupby(by='roi_name')['nvalid_centers_per_slice'].agg(lambda x: x.max()[0])
+            max_num_valid_centers_per_roi = df_density_pvals.groupby(by='roi_name')['nvalid_centers'].max()
             rois_with_at_least_one_valid_heatmap_cell = max_num_valid_centers_per_roi[max_num_valid_centers_per_roi >= num_valid_centers_minimum].index  # this prevents plotting of blank heatmaps per ROI by sending in to generate_dens_pvals_array_for_roi() only ROIs having at least one center species with a minimum number of valid centers. The averaging and subsequent plotting of heatmaps for slide averaged over ROI would be unaffected (since ROIs only contribute to the average if they contain center-neighbor data); this line only prevents blank per-ROI heatmaps. In other words, doing this prevents df_density_pvals_arrays from having all nan values for a ROI in the already reduced set of ROIs, which could otherwise occur if the number of valid centers for all species is less than the minimum
             index_holder = []
             for roi_name in rois_with_at_least_one_valid_heatmap_cell:
@@ -2629,6 +2631,286 @@ def make_pickle(data_to_save, pickle_dir, pickle_file):
         pickle.dump(data_to_save, f)
 
 
+def get_metrics_cache_key(*items):
+    """Hash the contents of a set of items (numpy arrays, lists of them, or anything with a deterministic repr()) into a key for the content-addressed metrics cache.
+
+    Args:
+        *items: Items whose contents determine the key, in order; metrics_cache_version is always included
+
+    Returns:
+        str: 40-character hex digest
+    """
+
+    # Import relevant libraries
+    import hashlib
+    import numpy as np
+
+    # Hash each item in turn, arrays by their dtype, shape, and raw bytes and everything else by its repr
+    hasher = hashlib.sha1(repr(metrics_cache_version).encode())
+    for item in items:
+        if isinstance(item, np.ndarray):
+            item = np.ascontiguousarray(item)
+            if item.dtype == object:
+                item = item.astype(str)
+            hasher.update(repr((item.dtype.str, item.shape)).encode())
+            hasher.update(item.tobytes())
+        else:
+            hasher.update(repr(item).encode())
+        hasher.update(b'|')
+
+    return hasher.hexdigest()
+
+
+def get_squidpy_images_dir():
+    """Get the directory in which Squidpy's images (scatter plots and heatmaps) of the ROIs are saved.
+
+    Returns:
+        str: Pathname of the directory
+    """
+
+    # Import relevant library
+    import os
+
+    return os.path.join('.', 'output', 'images', 'squidpy')
+
+
+def get_squidpy_image_filename_prefix(roi_index, roi_name):
+    """Get the prefix of the filenames of Squidpy's images (scatter plot and heatmap) of a ROI in get_squidpy_images_dir().
+
+    Args:
+        roi_index (int): Index of the ROI in df_data_by_roi
+        roi_name (str): Name of the ROI
+
+    Returns:
+        str: Filename prefix
+    """
+    return 'roi_index-{}__roi_name-{}-'.format(roi_index, roi_name)
+
+
+def copy_squidpy_images_to_identical_rois(roi_indexes, roi_cache_keys, roi_names):
+    """Give every ROI without Squidpy images copies of those of an identical ROI (one sharing its metrics cache key), since identical ROIs are calculated only once but their images are looked up by each ROI's own index and name.
+
+    Args:
+        roi_indexes (list): Indexes into df_data_by_roi of the ROIs
+        roi_cache_keys (dict): Metrics cache key of each ROI (see get_roi_metrics_cache_key()), keyed by ROI index
+        roi_names (dict): Name of each ROI, keyed by ROI index
+    """
+
+    # Import relevant libraries
+    import os
+    import shutil
+
+    # Get the image filenames of every ROI
+    squidpy_images_dir = get_squidpy_images_dir()
+    if not os.path.isdir(squidpy_images_dir):
+        return
+    image_filenames = os.listdir(squidpy_images_dir)
+    roi_image_suffixes = {}
+    for roi_index in roi_indexes:
+        filename_prefix = get_squidpy_image_filename_prefix(roi_index, roi_names[roi_index])
+        roi_image_suffixes[roi_index] = [filename[len(filename_prefix):] for filename in image_filenames if filename.startswith(filename_prefix) and ('-' not in filename[len(filename_prefix):])]  # e.g., "scatter.jpg", but not the images of another ROI whose name merely starts with this one's
+
+    # Copy the images of the first ROI having them to each identical ROI lacking them
+    source_rois = {}
+    for roi_index in roi_indexes:
+        if roi_image_suffixes[roi_index]:
+            source_rois.setdefault(roi_cache_keys[roi_index], roi_index)
+    for roi_index in roi_indexes:
+        source_roi_index = source_rois.get(roi_cache_keys[roi_index])
+        if (not roi_image_suffixes[roi_index]) and (source_roi_index is not None):
+            for suffix in roi_image_suffixes[source_roi_index]:
+                shutil.copyfile(os.path.join(squidpy_images_dir, get_squidpy_image_filename_prefix(source_roi_index, roi_names[source_roi_index]) + suffix), os.path.join(squidpy_images_dir, get_squidpy_image_filename_prefix(roi_index, roi_names[roi_index]) + suffix))
+            print('Copied the Squidpy images of ROI {} to the identical ROI {}'.format(roi_names[source_roi_index], roi_names[roi_index]))
+
+
+def get_roi_metrics_cache_key(roi_payload, metrics_params, all_species_list):
+    """Get the content-addressed cache key of a ROI's metrics, which changes whenever the ROI's coordinates, species, or extent or any setting affecting the metrics does.
+
+    Args:
+        roi_payload (dict): The ROI's data from its row of df_data_by_roi (see roi_payload_columns)
+        metrics_params (tuple): The settings affecting the metrics (see calculate_metrics())
+        all_species_list (list): Species IDs in the experiment, which set the layout of the ROI's metrics arrays
+
+    Returns:
+        str: 40-character hex digest
+    """
+
+    # Import relevant library
+    import numpy as np
+
+    # Hash everything but the ROI's name and index, so that identical ROIs share their results
+    return get_metrics_cache_key('roi', metrics_params, list(all_species_list), *[np.asarray(roi_payload[column]) for column in roi_payload_columns if column not in ['unique_roi', 'spec2plot_roi']])
+
+
+def get_metrics_arrays_for_roi(real_data, species_in_roi, roi_min_coord_spacing, roi_x_range, roi_y_range):
+    """Convert the object array of real-data tuples for a single ROI into typed, fixed-shape numeric arrays.
+
+    Args:
+        real_data (numpy.ndarray): Object array of shape (nall_species, nall_species, nslices) holding the 16-element tuples (or None) created in calculate_metrics_for_roi()
+        species_in_roi (numpy.ndarray): Boolean array of shape (nall_species,) specifying whether each species in the experiment exists in the ROI
+        roi_min_coord_spacing (float): Minimum coordinate spacing in the ROI
+        roi_x_range (numpy.ndarray): x range of the ROI prior to decimation
+        roi_y_range (numpy.ndarray): y range of the ROI prior to decimation
+
+    Returns:
+        dict: Dictionary of numpy arrays keyed by the fields of metrics_store_roi_fields and metrics_store_pair_fields. Per-pair fields have shape (nall_species, nall_species, nslices), with NaN (or False/0) where there is no data
+    """
+
+    # Import relevant library
+    import numpy as np
+
+    # Initialize the per-pair arrays
+    shape = real_data.shape
+    metrics_arrays = {}
+    for field, dtype in metrics_store_pair_fields.items():
+        metrics_arrays[field] = np.zeros(shape, dtype=dtype) if dtype in ['bool', 'int64'] else np.full(shape, np.nan, dtype=dtype)
+
+    # For every center/neighbor/slice having real data, extract the scalar results from the tuple
+    for index in np.ndindex(shape):
+        if real_data[index] is None:
+            continue
+        density_metrics, _, nexpected, nvalid_centers, _, _, _, _, npossible_neighbors, roi_area_used, slice_area_used = real_data[index][:11]
+        metrics_arrays['has_data'][index] = True
+        metrics_arrays['nvalid_centers'][index] = nvalid_centers
+        if density_metrics is not None:
+            metrics_arrays['has_density_metrics'][index] = True
+            metrics_arrays['z_score'][index], metrics_arrays['left_pval'][index], metrics_arrays['right_pval'][index] = [(np.nan if x is None else x) for x in density_metrics]
+        for field, value in zip(['nexpected', 'npossible_neighbors', 'roi_area_used', 'slice_area_used'], [nexpected, npossible_neighbors, roi_area_used, slice_area_used]):
+            if value is not None:
+                metrics_arrays[field][index] = value
+
+    # Add the per-ROI arrays
+    metrics_arrays['species_in_roi'] = np.array(species_in_roi, dtype=metrics_store_roi_fields['species_in_roi'])
+    metrics_arrays['roi_min_coord_spacing'] = np.array(roi_min_coord_spacing, dtype=metrics_store_roi_fields['roi_min_coord_spacing'])
+    metrics_arrays['roi_x_range'] = np.array(roi_x_range, dtype=metrics_store_roi_fields['roi_x_range'])
+    metrics_arrays['roi_y_range'] = np.array(roi_y_range, dtype=metrics_store_roi_fields['roi_y_range'])
+
+    return metrics_arrays
+
+
+def create_metrics_store(store_dir, nrois, nall_species, nslices):
+    """Create an empty columnar metrics store, i.e., a directory holding one memory-mapped .npy file per field of metrics_store_pair_fields and metrics_store_roi_fields whose first axis runs over the ROIs.
+
+    The ROIs' arrays are then written one at a time via write_roi_to_metrics_store() (e.g., as they stream back from the workers) so that only a single ROI's arrays need to be in memory at a time, and the store is completed via finalize_metrics_store().
+
+    Args:
+        store_dir (str): Directory in which to create the store
+        nrois (int): Number of ROIs in the store
+        nall_species (int): Number of species in the experiment
+        nslices (int): Number of slices (annuli)
+
+    Returns:
+        dict: Writable memory-mapped columns keyed by field
+    """
+
+    # Import relevant libraries
+    import os
+    import numpy as np
+
+    # Print what we're doing
+    print('Writing the metrics store to {}...'.format(store_dir))
+
+    # Start from an empty store directory
+    os.makedirs(store_dir, exist_ok=True)
+    for filename in os.listdir(store_dir):
+        os.remove(os.path.join(store_dir, filename))
+
+    # Create the memory-mapped columns
+    field_shapes = {'species_in_roi': (nall_species,), 'roi_min_coord_spacing': (), 'roi_x_range': (2,), 'roi_y_range': (2,)}
+    columns = {}
+    for field, dtype in metrics_store_pair_fields.items():
+        columns[field] = np.lib.format.open_memmap(os.path.join(store_dir, field + '.npy'), mode='w+', dtype=dtype, shape=(nrois, nall_species, nall_species, nslices))
+    for field, dtype in metrics_store_roi_fields.items():
+        columns[field] = np.lib.format.open_memmap(os.path.join(store_dir, field + '.npy'), mode='w+', dtype=dtype, shape=(nrois,) + field_shapes[field])
+
+    return columns
+
+
+def write_roi_to_metrics_store(columns, iroi, roi_arrays):
+    """Write the typed metrics arrays of a single ROI into the columns of a metrics store created by create_metrics_store().
+
+    Args:
+        columns (dict): Writable memory-mapped columns returned by create_metrics_store()
+        iroi (int): Position of the ROI in the store
+        roi_arrays (dict or numpy.lib.npyio.NpzFile): Typed metrics arrays of the ROI (see get_metrics_arrays_for_roi()); other fields such as the pair cache keys are ignored
+    """
+    for field, column in columns.items():
+        column[iroi] = roi_arrays[field]
+
+
+def finalize_metrics_store(store_dir, columns, roi_indexes, all_species_ids, slice_edges, store_key=None):
+    """Flush the columns of a metrics store created by create_metrics_store() and save the experiment-wide arrays, writing the roi_index column last so that its existence marks a complete store.
+
+    Args:
+        store_dir (str): Directory holding the store
+        columns (dict): Writable memory-mapped columns returned by create_metrics_store()
+        roi_indexes (list): Indexes into df_data_by_roi of the ROIs in the store, in store order
+        all_species_ids (list): Species IDs in the experiment, in the order of the species axes of the stored arrays
+        slice_edges (numpy.ndarray): Radii delimiting the slices (annuli), of length nslices + 1
+        store_key (str, optional): Cache key of the data and settings the store is calculated from, saved to store_key.txt so that a stale store can be detected. Defaults to None (not saved)
+    """
+
+    # Import relevant libraries
+    import os
+    import numpy as np
+
+    # Flush the columns to disk
+    for column in columns.values():
+        column.flush()
+
+    # Save the experiment-wide arrays and finally the ROI indexes, which marks the store as complete
+    np.save(os.path.join(store_dir, 'all_species_ids.npy'), np.array(all_species_ids))
+    np.save(os.path.join(store_dir, 'slice_edges.npy'), np.array(slice_edges))
+    if store_key is not None:
+        with open(os.path.join(store_dir, 'store_key.txt'), 'w') as f:
+            f.write(store_key)
+    np.save(os.path.join(store_dir, 'roi_index.npy'), np.array(roi_indexes, dtype='int64'))
+
+
+def load_metrics_store(store_dir, mmap_mode='r'):
+    """Load the columnar metrics store created by create_metrics_store() and completed by finalize_metrics_store().
+
+    Args:
+        store_dir (str): Directory holding the store
+        mmap_mode (str, optional): Memory-map mode passed to numpy.load(); use None to read the columns fully into memory. Defaults to 'r'.
+
+    Returns:
+        dict: Dictionary of (memory-mapped) numpy arrays keyed by field name, plus the roi_index, all_species_ids, and slice_edges arrays
+    """
+
+    # Import relevant libraries
+    import os
+    import numpy as np
+
+    # Load every column in the store
+    print('Loading the metrics store from {}...'.format(store_dir))
+    return {filename[:-len('.npy')]: np.load(os.path.join(store_dir, filename), mmap_mode=mmap_mode) for filename in sorted(os.listdir(store_dir)) if filename.endswith('.npy')}
+
+
+class LazyROIPickleList:
+    '''
+    Read-only list of the full legacy data structures of ROIs (see calculate_metrics_for_roi()), each of which is only loaded from its individual pickle file when accessed, so that iterating over the ROIs holds a single ROI's data in memory at a time
+
+    It stands in for the list of ROI data of a slide in the legacy metrics data structure, i.e., data_by_roi in [[uslide, unique_rois, data_by_roi], ...]
+    '''
+
+    def __init__(self, pickle_dir, pickle_files):
+        self.pickle_dir = pickle_dir
+        self.pickle_files = list(pickle_files)
+
+    def __len__(self):
+        return len(self.pickle_files)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return load_pickle(self.pickle_dir, self.pickle_files[index])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
 def plot_roi(fig, spec2plot, species, x, y, plotting_map, colors, x_range, y_range, title, marker_size_step, default_marker_size, dpi, mapping_dict, coord_units_in_microns, filepath=None, do_plot=True, alpha=1, edgecolors='k', yaxis_dir=1, boxes_to_plot=None, pval_params=None, roi_pval_alpha=0.5, num_colors=2**16, title_suffix=None):
     '''
     For the raw data (coordinates) for a given ROI, plot a circle (scatter plot) representing each species, whether known (in which case get_descriptive_cell_label() is used) or unknown; plot a legend too
@@ -2814,10 +3096,43 @@ def roi_checks_and_output(x_roi, y_roi, do_printing=True, do_main_printing=True)
     return(x_range, y_range, min_coordinate_spacing)
 
 
-def calculate_metrics_from_coords(min_coord_spacing, input_coords=None, neighbors_eq_centers=False, ncenters_roi=1300, nneighbors_roi=220, nbootstrap_resamplings=0, rad_range=(2.2, 5.1), use_theoretical_counts=False, roi_edge_buffer_mult=1, roi_x_range=(1.0, 100.0), roi_y_range=(0.5, 50.0), silent=False, log_file_data=None, keep_unnecessary_calculations=False, neighbor_counts_method='cdist avoiding oom'):
+def simulate_coords_on_grid(ncoords, min_coord_spacing, roi_x_range, roi_y_range, rng):
+    """Randomly place coordinates on distinct points of the grid spanning a ROI, i.e., generate a null (complete spatial randomness) dataset.
+
+    By sampling without replacement, we're simulating our real data in that no two coordinates occupy the same point on the grid. The grid points are sampled as flat indices and converted to x and y indices so that the full grid of indices never needs to be created.
+
+    Args:
+        ncoords (int): Number of coordinates to place
+        min_coord_spacing (float): Spacing of the grid
+        roi_x_range (tuple): Minimum and maximum x coordinates of the ROI
+        roi_y_range (tuple): Minimum and maximum y coordinates of the ROI
+        rng (numpy.random.Generator): Random number generator, e.g., seeded per ROI so that the null dataset is reproducible
+
+    Returns:
+        numpy.ndarray: Array of shape (ncoords, 2) of the simulated coordinates
+    """
+
+    # Import relevant library
+    import numpy as np
+
+    # Number of grid points in each direction
+    ngridpoints_x = int((roi_x_range[1] - roi_x_range[0]) / min_coord_spacing + 1)
+    ngridpoints_y = int((roi_y_range[1] - roi_y_range[0]) / min_coord_spacing + 1)
+
+    # Draw distinct grid points, in the same order as the rows of np.indices((ngridpoints_x, ngridpoints_y)).reshape((2, -1)).T
+    flat_indices = rng.choice(ngridpoints_x * ngridpoints_y, size=ncoords, replace=False, shuffle=False)
+    grid_indices = np.stack(np.divmod(flat_indices, ngridpoints_y), axis=1)
+
+    # Convert the grid indices to coordinates
+    return (grid_indices * min_coord_spacing) + np.array([roi_x_range[0], roi_y_range[0]])[np.newaxis, :]
+
+
+def calculate_metrics_from_coords(min_coord_spacing, input_coords=None, neighbors_eq_centers=False, ncenters_roi=1300, nneighbors_roi=220, nbootstrap_resamplings=0, rad_range=(2.2, 5.1), use_theoretical_counts=False, roi_edge_buffer_mult=1, roi_x_range=(1.0, 100.0), roi_y_range=(0.5, 50.0), silent=False, log_file_data=None, keep_unnecessary_calculations=False, neighbor_counts_method='cdist avoiding oom', precomputed_nneighbors=None, single_dist_mat_cutoff_in_mb=None, total_dist_mat_cutoff_in_mb=None, neighbor_counts_nworkers=None):
     '''
     Given a set of coordinates (whether actual coordinates or ones to be simulated), calculate the P values and Z scores.
 
+    If precomputed_nneighbors is set, it should hold the number of neighbors in the slice around every center in input_coords (e.g., one column of the output of utils.calculate_neighbor_counts_for_radii()), in which case no distances are calculated here. Otherwise, single_dist_mat_cutoff_in_mb, total_dist_mat_cutoff_in_mb, and neighbor_counts_nworkers set the memory budgets and number of threads of the neighbor counting (see utils.get_neighbor_counts_settings()).
+
     See the calculate_metrics() method of the TIMECellInteraction class for further documentation.
     '''
 
@@ -2857,9 +3172,6 @@ def calculate_metrics_from_coords(min_coord_spacing, input_coords=None, neighbor
 
     # Calculate some properties of the ROI itself
     roi_area_adj = (roi_x_range[1] - roi_x_range[0] + min_coord_spacing) * (roi_y_range[1] - roi_y_range[0] + min_coord_spacing) - min_coord_spacing**2
-    ngridpoints_x = int((roi_x_range[1] - roi_x_range[0]) / min_coord_spacing + 1)
-    ngridpoints_y = int((roi_y_range[1] - roi_y_range[0]) / min_coord_spacing + 1)
-    grid_indices = np.indices((ngridpoints_x, ngridpoints_y)).reshape((2, -1)).T
 
     # Properties of the slice
     slice_area = np.pi * (rad_range[1]**2 - rad_range[0]**2)
@@ -2895,11 +3207,11 @@ def calculate_metrics_from_coords(min_coord_spacing, input_coords=None, neighbor
     # Generate random coordinates for the centers and neighbors; by sampling without replacement, we're simulating our real data in that no two species occupy the same point on the grid
     if neighbors_eq_centers:
         if simulate_coords:
-            coords_centers = (rng.choice(grid_indices, size=ncenters_roi, replace=False, shuffle=False) * min_coord_spacing) + np.array([roi_x_range[0], roi_y_range[0]])[np.newaxis, :]
+            coords_centers = simulate_coords_on_grid(ncenters_roi, min_coord_spacing, roi_x_range, roi_y_range, rng)
         coords_neighbors = coords_centers
     else:
         if simulate_coords:
-            coords_tmp = (rng.choice(grid_indices, size=(ncenters_roi + nneighbors_roi), replace=False, shuffle=False) * min_coord_spacing) + np.array([roi_x_range[0], roi_y_range[0]])[np.newaxis, :]
+            coords_tmp = simulate_coords_on_grid(ncenters_roi + nneighbors_roi, min_coord_spacing, roi_x_range, roi_y_range, rng)
             coords_centers = coords_tmp[:ncenters_roi, :]
             coords_neighbors = coords_tmp[ncenters_roi:, :]
 
@@ -2925,13 +3237,19 @@ def calculate_metrics_from_coords(min_coord_spacing, input_coords=None, neighbor
                 print('NOTE: Using artificial distribution')
             nneighbors = scipy.stats.poisson.rvs(nexpected, size=(nvalid_centers,))
         else:
-            if neighbor_counts_method == 'pure cdist':
+            if (precomputed_nneighbors is None) and (neighbor_counts_method == 'auto'):  # choose the fastest method for this pair of point sets
+                neighbor_counts_method = utils.choose_neighbor_counts_method(coords_centers[valid_centers, :], coords_neighbors, radii, single_dist_mat_cutoff_in_mb=single_dist_mat_cutoff_in_mb, total_dist_mat_cutoff_in_mb=total_dist_mat_cutoff_in_mb, nworkers=neighbor_counts_nworkers)
+            if precomputed_nneighbors is not None:  # counts in [small radius, large radius) already calculated for all the centers
+                nneighbors = precomputed_nneighbors[valid_centers]
+            elif neighbor_counts_method == 'pure cdist':
                 dist_mat = scipy.spatial.distance.cdist(coords_centers[valid_centers, :], coords_neighbors, 'euclidean')  # calculate the distances between the valid centers and all the neighbors
                 nneighbors = ((dist_mat >= rad_range[0]) & (dist_mat < rad_range[1])).sum(axis=1)  # count the number of neighbors in the slice around every valid center
             elif neighbor_counts_method == 'cdist avoiding oom':  # returns number of points in [0, radius)
-                nneighbors = utils.calculate_neighbor_counts_with_possible_chunking(center_coords=coords_centers[valid_centers, :], neighbor_coords=coords_neighbors, radii=radii, single_dist_mat_cutoff_in_mb=200, verbose=False)[:, 0]  # (num_centers,)
-            elif neighbor_counts_method == 'kdtree':  # returns number of points in [0, radius) (with the "tol" correction within)
-                nneighbors = utils.calculate_neighbor_counts_with_kdtree(center_coords=coords_centers[valid_centers, :], neighbor_coords=coords_neighbors, radius=radii[1])
+                nneighbors = utils.calculate_neighbor_counts_with_possible_chunking(center_coords=coords_centers[valid_centers, :], neighbor_coords=coords_neighbors, radii=radii, verbose=False, single_dist_mat_cutoff_in_mb=single_dist_mat_cutoff_in_mb, total_dist_mat_cutoff_in_mb=total_dist_mat_cutoff_in_mb, nworkers=neighbor_counts_nworkers)[:, 0]  # (num_centers,)
+            elif neighbor_counts_method == 'kdtree':  # difference the numbers of points in [0, radius) (with the "tol" correction within) so that, like the cdist methods, this counts [small radius, large radius)
+                nneighbors = np.diff(utils.calculate_cumulative_neighbor_counts_with_kdtree(center_coords=coords_centers[valid_centers, :], neighbor_coords=coords_neighbors, radii=radii, workers=utils.get_neighbor_counts_settings(nworkers=neighbor_counts_nworkers)[2]), axis=1)[:, 0]
+            else:
+                raise ValueError(f'Unknown neighbor counts method "{neighbor_counts_method}"')
             if (neighbors_eq_centers) and (rad_range[0] < tol):
                 nneighbors = nneighbors - 1  # we're always going to count the center as a neighbor of itself in this case, so account for this; see also physical notebook notes on 1/7/21
 
@@ -3392,37 +3710,48 @@ def calculate_metrics_for_roi(args_as_single_tuple):
     """Calculate the metrics for a single ROI
 
     Args:
-        args_as_single_tuple (tuple): Tuple of arguments to be unpacked below, in this format so that the metrics can be calculated using the multiprocessing library in the traditional way. See the calculate_metrics() method of the TIMECellInteraction class above for more details. Arguments are: pickle_dir, nslices, thickness, min_coord_spacing, data, all_species_list, nall_species, df_data_by_roi, keep_unnecessary_calculations, roi_index
+        args_as_single_tuple (tuple): Tuple of arguments to be unpacked below, in this format so that the metrics can be calculated using the multiprocessing library in the traditional way. See the calculate_metrics() method of the TIMECellInteraction class above for more details. Arguments are: pickle_dir, nslices, thickness, n_neighs, radius_instead_of_knn, min_coord_spacing, all_species_list, nall_species, do_logging, use_analytical_significance, keep_unnecessary_calculations, n_jobs, single_dist_mat_cutoff_in_mb, total_dist_mat_cutoff_in_mb, neighbor_counts_nworkers, roi_payload, roi_index, roi_cache_file, previous_roi_cache_file, where roi_payload is the dictionary of the ROI's data from its row of df_data_by_roi (see roi_payload_columns) so that only the current ROI's data get sent to the worker, roi_cache_file is the path of the content-addressed .npz file to which the ROI's typed metrics arrays get saved, and previous_roi_cache_file is the path of the cached results of the most recent calculation for the same ROI name (or None), whose center/neighbor species pairs with unchanged data get reused rather than recalculated
+
+    Returns:
+        dict: The ROI index ('roi_index'), the typed metrics arrays of the ROI ('metrics_arrays'; see get_metrics_arrays_for_roi(), or None if they were already cached), and the log messages captured for the ROI ('log_lines'; empty if do_logging is False)
     """
 
     # Import relevant modules
     import os
     import numpy as np
     import time
+    import io
     import contextlib
     import tci_squidpy_supp_lib
 
     # Unpack the arguments
-    pickle_dir, nslices, thickness, n_neighs, radius_instead_of_knn, min_coord_spacing, all_species_list, nall_species, do_logging, use_analytical_significance, df_data_by_roi, keep_unnecessary_calculations, n_jobs, roi_index = args_as_single_tuple
+    pickle_dir, nslices, thickness, n_neighs, radius_instead_of_knn, min_coord_spacing, all_species_list, nall_species, do_logging, use_analytical_significance, keep_unnecessary_calculations, n_jobs, single_dist_mat_cutoff_in_mb, total_dist_mat_cutoff_in_mb, neighbor_counts_nworkers, roi_payload, roi_index, roi_cache_file, previous_roi_cache_file = args_as_single_tuple
 
     # Constants which I can later turn into a parameter if desired
     my_seed = 42
     z_hardcode = 0  # this shouldn't matter anyway since I don't do anything with Z scores
+    neighbor_counts_method = 'auto'  # chosen separately for each center/neighbor pair based on the calibration cached by utils.get_neighbor_counts_calibration()
 
-    # Determine the pickle filename using the ROI index
+    # Edges of all the slices, i.e., the radii delimiting the annuli
+    slice_edges = np.arange(nslices + 1) * thickness
+
+    # Determine the legacy pickle filename using the ROI index; the typed arrays always get saved to the cached .npz file while the full legacy data structure only gets pickled if keep_unnecessary_calculations is True
     pickle_file = 'calculated_metrics-roi_index_{:06}.pkl'.format(roi_index)
-    log_file = 'calculated_metrics-roi_index_{:06}.log'.format(roi_index)
 
-    with (open(file=os.path.join(pickle_dir, log_file), mode='wt') if do_logging else contextlib.nullcontext()) as log_file_handle:
+    # The typed metrics arrays of the ROI, which remain None if they're already cached
+    metrics_arrays = None
+
+    # Capture the log messages in memory rather than in a per-ROI log file
+    with (io.StringIO() if do_logging else contextlib.nullcontext()) as log_file_handle:
 
         # Determine the ROI name from the ROI index
-        uroi = df_data_by_roi.loc[roi_index, 'unique_roi']
+        uroi = roi_payload['unique_roi']
 
         if do_logging:
             log_file_handle.write('ROI {:06d} (split 00, {}): ROI processing started at {}\n'.format(roi_index, uroi, utils.get_timestamp(pretty=True)))
 
-        # If the pickle file doesn't already exist...
-        if not os.path.exists(os.path.join(pickle_dir, pickle_file)):
+        # If the cached .npz file (or, if requested, the legacy pickle file) doesn't already exist...
+        if (not os.path.exists(roi_cache_file)) or (keep_unnecessary_calculations and (not os.path.exists(os.path.join(pickle_dir, pickle_file)))):
 
             # Save the starting time
             start_time = time.time()
@@ -3431,22 +3760,22 @@ def calculate_metrics_for_roi(args_as_single_tuple):
             print('Calculating metrics for ROI {} (ROI index {})'.format(uroi, roi_index))
 
             if do_logging:
-                log_file_handle.write('ROI {:06d} (split 01, {}): pickle file {}/{} does not already exist for the ROI\n'.format(roi_index, uroi, pickle_dir, pickle_file))
+                log_file_handle.write('ROI {:06d} (split 01, {}): cached .npz file {} does not already exist for the ROI\n'.format(roi_index, uroi, roi_cache_file))
 
             # Get the needed ROI data
-            x_roi = df_data_by_roi.loc[roi_index, 'x_roi']
-            y_roi = df_data_by_roi.loc[roi_index, 'y_roi']
-            species_roi = df_data_by_roi.loc[roi_index, 'species_roi']
-            roi_x_range_prior_to_decimation = np.array([df_data_by_roi.loc[roi_index, 'x_min_prior_to_decimation'], df_data_by_roi.loc[roi_index, 'x_max_prior_to_decimation']])
-            roi_y_range_prior_to_decimation = np.array([df_data_by_roi.loc[roi_index, 'y_min_prior_to_decimation'], df_data_by_roi.loc[roi_index, 'y_max_prior_to_decimation']])
+            x_roi = roi_payload['x_roi']
+            y_roi = roi_payload['y_roi']
+            species_roi = roi_payload['species_roi']
+            roi_x_range_prior_to_decimation = np.array([roi_payload['x_min_prior_to_decimation'], roi_payload['x_max_prior_to_decimation']])
+            roi_y_range_prior_to_decimation = np.array([roi_payload['y_min_prior_to_decimation'], roi_payload['y_max_prior_to_decimation']])
             unique_species_in_roi = np.unique(species_roi)
             num_unique_species_in_roi = len(unique_species_in_roi)
             coords_roi = np.c_[x_roi, y_roi]
 
             # Run some checks
             roi_x_range, roi_y_range, roi_min_coord_spacing = roi_checks_and_output(x_roi, y_roi, do_printing=False)  # note I don't believe roi_min_coord_spacing is ever actually used for anything other than saving the value to a text file
-            assert (roi_x_range == df_data_by_roi.loc[roi_index, 'x_range']).all(), 'ERROR: ROI x range is not consistent ({} != {})'.format(roi_x_range, df_data_by_roi.loc[roi_index, 'x_range'])
-            assert (roi_y_range == df_data_by_roi.loc[roi_index, 'y_range']).all(), 'ERROR: ROI y range is not consistent ({} != {})'.format(roi_y_range, df_data_by_roi.loc[roi_index, 'y_range'])
+            assert (roi_x_range == roi_payload['x_range']).all(), 'ERROR: ROI x range is not consistent ({} != {})'.format(roi_x_range, roi_payload['x_range'])
+            assert (roi_y_range == roi_payload['y_range']).all(), 'ERROR: ROI y range is not consistent ({} != {})'.format(roi_y_range, roi_payload['y_range'])
             # if (not ([x_roi.min(),x_roi.max()]==roi_x_range)) or (not ([y_roi.min(),y_roi.max()]==roi_y_range)) or (not (0.5==roi_min_coord_spacing)):
             if (not ([x_roi.min(), x_roi.max()] == roi_x_range)) or (not ([y_roi.min(), y_roi.max()] == roi_y_range)):
                 print('ERROR: A basic check failed')
@@ -3458,8 +3787,24 @@ def calculate_metrics_for_roi(args_as_single_tuple):
             real_data = np.empty((nall_species, nall_species, nslices), dtype=object)
             sim_data = np.empty((nall_species, nall_species, nslices), dtype=object)
 
+            # Cache keys of the data going into each center/neighbor species pair, empty for pairs that aren't calculated individually
+            pair_cache_keys = np.full((nall_species, nall_species), '', dtype='U40')
+            reused_pair_arrays = {}
+
             if use_analytical_significance:
 
+                # Load the per-pair results of the most recent calculation for the ROI of the same name, keyed by the pairs' cache keys. The full legacy data structure isn't cached, so nothing is reused if it's requested
+                previous_pair_arrays = {}
+                if (previous_roi_cache_file is not None) and (not keep_unnecessary_calculations) and os.path.exists(previous_roi_cache_file):
+                    with np.load(previous_roi_cache_file) as previous_arrays:
+                        previous_pair_cache_keys = previous_arrays['pair_cache_key']
+                        for icenter_spec, ineighbor_spec in zip(*np.nonzero(previous_pair_cache_keys != '')):
+                            previous_pair_arrays[previous_pair_cache_keys[icenter_spec, ineighbor_spec]] = {field: previous_arrays[field][icenter_spec, ineighbor_spec] for field in metrics_store_pair_fields}
+
+                # Simulate a single null dataset for the entire ROI, seeded by the ROI, by randomly placing all its cells (keeping their species) on the grid. Every center/neighbor pair and slice shares this one placement rather than drawing its own
+                if keep_unnecessary_calculations:
+                    coords_roi_sim = simulate_coords_on_grid(len(coords_roi), min_coord_spacing, roi_x_range_prior_to_decimation, roi_y_range_prior_to_decimation, np.random.default_rng([my_seed, roi_index]))
+
                 # For every center and neighbor species in the entire experiment...
                 for icenter_spec, center_species in enumerate(all_species_list):
                     for ineighbor_spec, neighbor_species in enumerate(all_species_list):
@@ -3474,28 +3819,45 @@ def calculate_metrics_for_roi(args_as_single_tuple):
                             coords_centers = coords_roi[species_roi == center_species, :]
                             coords_neighbors = coords_roi[species_roi == neighbor_species, :]
 
+                            # Determine the cache key of everything the metrics of the current pair depend on, and if the previous calculation for the ROI has results for the same key, reuse them rather than recalculating them
+                            pair_cache_keys[icenter_spec, ineighbor_spec] = get_metrics_cache_key('pair', slice_edges, min_coord_spacing, roi_x_range_prior_to_decimation, roi_y_range_prior_to_decimation, (neighbor_species == center_species), coords_centers, coords_neighbors)
+                            if pair_cache_keys[icenter_spec, ineighbor_spec] in previous_pair_arrays:
+                                reused_pair_arrays[(icenter_spec, ineighbor_spec)] = previous_pair_arrays[pair_cache_keys[icenter_spec, ineighbor_spec]]
+                                if do_logging:
+                                    log_file_handle.write('ROI {:06d} (split 02, {}): reusing the previously calculated metrics for center {} and neighbor {}, whose data have not changed\n'.format(roi_index, uroi, center_species, neighbor_species))
+                                continue
+
+                            # Count the neighbors around every center for every slice at once so that the center-neighbor distances are calculated only once per pair rather than once per slice
+                            nneighbors_per_slice = utils.calculate_neighbor_counts_for_radii(center_coords=coords_centers, neighbor_coords=coords_neighbors, radii=slice_edges, neighbor_counts_method=neighbor_counts_method, single_dist_mat_cutoff_in_mb=single_dist_mat_cutoff_in_mb, total_dist_mat_cutoff_in_mb=total_dist_mat_cutoff_in_mb, nworkers=neighbor_counts_nworkers)  # (num_centers, nslices)
+
+                            # Do the same for the current center and neighbor species in the simulated null dataset
+                            if keep_unnecessary_calculations:
+                                coords_centers_sim = coords_roi_sim[species_roi == center_species, :]
+                                coords_neighbors_sim = coords_roi_sim[species_roi == neighbor_species, :]
+                                nneighbors_per_slice_sim = utils.calculate_neighbor_counts_for_radii(center_coords=coords_centers_sim, neighbor_coords=coords_neighbors_sim, radii=slice_edges, neighbor_counts_method=neighbor_counts_method, single_dist_mat_cutoff_in_mb=single_dist_mat_cutoff_in_mb, total_dist_mat_cutoff_in_mb=total_dist_mat_cutoff_in_mb, nworkers=neighbor_counts_nworkers)  # (num_centers, nslices)
+
                             # For every radius/slice...
                             for islice in range(nslices):
 
                                 # Define the inner and outer radii of the current slice
-                                small_rad = islice * thickness
-                                large_rad = (islice + 1) * thickness
+                                small_rad = slice_edges[islice]
+                                large_rad = slice_edges[islice + 1]
 
-                                # Count the neighbors, calculate the PMFs, and from these determine the P values of interest for the single set of real data
+                                # Calculate the PMFs and from these determine the P values of interest for the single set of real data using the neighbor counts for the current slice
                                 density_metrics_real, pmf_metrics_real, nexpected_real, nvalid_centers_real, coords_centers_real, coords_neighbors_real, valid_centers_real, edges_real, npossible_neighbors_real, roi_area_used_real, slice_area_used_real = \
-                                    calculate_metrics_from_coords(min_coord_spacing, input_coords=(coords_centers, coords_neighbors), neighbors_eq_centers=(neighbor_species == center_species), nbootstrap_resamplings=0, rad_range=(small_rad, large_rad), use_theoretical_counts=False, roi_edge_buffer_mult=1, roi_x_range=roi_x_range_prior_to_decimation, roi_y_range=roi_y_range_prior_to_decimation, silent=False, log_file_data=(log_file_handle, roi_index, uroi, center_species, neighbor_species), keep_unnecessary_calculations=keep_unnecessary_calculations)
+                                    calculate_metrics_from_coords(min_coord_spacing, input_coords=(coords_centers, coords_neighbors), neighbors_eq_centers=(neighbor_species == center_species), nbootstrap_resamplings=0, rad_range=(small_rad, large_rad), use_theoretical_counts=False, roi_edge_buffer_mult=1, roi_x_range=roi_x_range_prior_to_decimation, roi_y_range=roi_y_range_prior_to_decimation, silent=False, log_file_data=(log_file_handle, roi_index, uroi, center_species, neighbor_species), keep_unnecessary_calculations=keep_unnecessary_calculations, neighbor_counts_method=neighbor_counts_method, precomputed_nneighbors=nneighbors_per_slice[:, islice], single_dist_mat_cutoff_in_mb=single_dist_mat_cutoff_in_mb, total_dist_mat_cutoff_in_mb=total_dist_mat_cutoff_in_mb, neighbor_counts_nworkers=neighbor_counts_nworkers)
 
                                 # Save the results, plus some other data, into a primary array of interest
                                 real_data[icenter_spec, ineighbor_spec, islice] = (density_metrics_real, pmf_metrics_real, nexpected_real, nvalid_centers_real, coords_centers_real, coords_neighbors_real, valid_centers_real, edges_real, npossible_neighbors_real, roi_area_used_real, slice_area_used_real, center_species, neighbor_species, small_rad, large_rad, islice)
 
                                 if keep_unnecessary_calculations:
 
-                                    # Count the neighbors, calculate the PMFs, and from these determine the P values of interest for a single set of simulated data with the same properties as the real data
-                                    density_metrics_sim, pmf_metrics_sim, nexpected_sim, nvalid_centers_sim, coords_centers_sim, coords_neighbors_sim, valid_centers_sim, edges_sim, npossible_neighbors_sim, roi_area_used_sim, slice_area_used_sim = \
-                                        calculate_metrics_from_coords(min_coord_spacing, input_coords=None, neighbors_eq_centers=(neighbor_species == center_species), ncenters_roi=coords_centers.shape[0], nneighbors_roi=coords_neighbors.shape[0], nbootstrap_resamplings=0, rad_range=(small_rad, large_rad), use_theoretical_counts=False, roi_edge_buffer_mult=1, roi_x_range=roi_x_range_prior_to_decimation, roi_y_range=roi_y_range_prior_to_decimation, silent=False, log_file_data=(log_file_handle, roi_index, uroi, center_species, neighbor_species), keep_unnecessary_calculations=keep_unnecessary_calculations)
+                                    # Calculate the PMFs and from these determine the P values of interest for the ROI's simulated null dataset, which has the same properties as the real data
+                                    density_metrics_sim, pmf_metrics_sim, nexpected_sim, nvalid_centers_sim, coords_centers_sim_used, coords_neighbors_sim_used, valid_centers_sim, edges_sim, npossible_neighbors_sim, roi_area_used_sim, slice_area_used_sim = \
+                                        calculate_metrics_from_coords(min_coord_spacing, input_coords=(coords_centers_sim, coords_neighbors_sim), neighbors_eq_centers=(neighbor_species == center_species), nbootstrap_resamplings=0, rad_range=(small_rad, large_rad), use_theoretical_counts=False, roi_edge_buffer_mult=1, roi_x_range=roi_x_range_prior_to_decimation, roi_y_range=roi_y_range_prior_to_decimation, silent=False, log_file_data=(log_file_handle, roi_index, uroi, center_species, neighbor_species), keep_unnecessary_calculations=keep_unnecessary_calculations, neighbor_counts_method=neighbor_counts_method, precomputed_nneighbors=nneighbors_per_slice_sim[:, islice], single_dist_mat_cutoff_in_mb=single_dist_mat_cutoff_in_mb, total_dist_mat_cutoff_in_mb=total_dist_mat_cutoff_in_mb, neighbor_counts_nworkers=neighbor_counts_nworkers)
 
                                     # Save the results, plus some other data, into a primary array of interest
-                                    sim_data[icenter_spec, ineighbor_spec, islice] = (density_metrics_sim, pmf_metrics_sim, nexpected_sim, nvalid_centers_sim, coords_centers_sim, coords_neighbors_sim, valid_centers_sim, edges_sim, npossible_neighbors_sim, roi_area_used_sim, slice_area_used_sim, center_species, neighbor_species, small_rad, large_rad, islice)
+                                    sim_data[icenter_spec, ineighbor_spec, islice] = (density_metrics_sim, pmf_metrics_sim, nexpected_sim, nvalid_centers_sim, coords_centers_sim_used, coords_neighbors_sim_used, valid_centers_sim, edges_sim, npossible_neighbors_sim, roi_area_used_sim, slice_area_used_sim, center_species, neighbor_species, small_rad, large_rad, islice)
 
                                 else:
 
@@ -3523,10 +3885,10 @@ def calculate_metrics_for_roi(args_as_single_tuple):
                 else:
 
                     # Create and store the name of the directory in which to store Squidpy's scatter plots and heatmaps
-                    squidpy_dir = os.path.join('.', 'output', 'images', 'squidpy')
+                    squidpy_dir = get_squidpy_images_dir()
                     if not os.path.exists(squidpy_dir):
                         os.makedirs(squidpy_dir)
-                    image_path_prefix = os.path.join(squidpy_dir, 'roi_index-{}__roi_name-{}-'.format(roi_index, uroi))
+                    image_path_prefix = os.path.join(squidpy_dir, get_squidpy_image_filename_prefix(roi_index, uroi))
                     
                     if do_logging:
                         log_file_handle.write('ROI {:06d} (split 02, {}): calculating P values using SquidPy for all centers and neighbors\n'.format(roi_index, uroi))
@@ -3572,13 +3934,28 @@ def calculate_metrics_for_roi(args_as_single_tuple):
             roi_data_item = {'roi_min_coord_spacing': roi_min_coord_spacing, 'unique_species_in_roi': unique_species_in_roi, 'real_data': real_data, 'sim_data': sim_data, 'all_species_list': all_species_list, 'roi_x_range': roi_x_range_prior_to_decimation, 'roi_y_range': roi_y_range_prior_to_decimation}
 
             # Run a check on the unique species in the ROI
-            if not (set(df_data_by_roi.loc[roi_index, 'spec2plot_roi']) == set(unique_species_in_roi)):
-                print('spec2plot_roi:', df_data_by_roi.loc[roi_index, 'spec2plot_roi'])
+            if not (set(roi_payload['spec2plot_roi']) == set(unique_species_in_roi)):
+                print('spec2plot_roi:', roi_payload['spec2plot_roi'])
                 print('unique_species_in_roi:', unique_species_in_roi)
-            assert set(df_data_by_roi.loc[roi_index, 'spec2plot_roi']) == set(unique_species_in_roi), 'ERROR: spec2plot_roi does not equal unique_species_in_roi!'
-
-            # Create a pickle file saving the data that we just calculated
-            make_pickle(roi_data_item, pickle_dir, pickle_file)
+            assert set(roi_payload['spec2plot_roi']) == set(unique_species_in_roi), 'ERROR: spec2plot_roi does not equal unique_species_in_roi!'
+
+            # Save the typed metrics arrays for the ROI, which is all that's needed downstream
+            metrics_arrays = get_metrics_arrays_for_roi(real_data, species_in_roi=[(x in unique_species_in_roi) for x in all_species_list], roi_min_coord_spacing=roi_min_coord_spacing, roi_x_range=roi_x_range_prior_to_decimation, roi_y_range=roi_y_range_prior_to_decimation)
+            for (icenter_spec, ineighbor_spec), pair_arrays in reused_pair_arrays.items():
+                for field, pair_array in pair_arrays.items():
+                    metrics_arrays[field][icenter_spec, ineighbor_spec] = pair_array
+            metrics_arrays['pair_cache_key'] = pair_cache_keys
+            if len(reused_pair_arrays) > 0:
+                print('Reused the previously calculated metrics of {} center/neighbor species pairs for ROI {} (ROI index {})'.format(len(reused_pair_arrays), uroi, roi_index))
+
+            # Write the cached .npz file atomically so that an interrupted calculation never leaves a partial file under the ROI's cache key
+            tmp_cache_file = '{}.{}.tmp.npz'.format(roi_cache_file[:-len('.npz')], os.getpid())
+            np.savez(tmp_cache_file, **metrics_arrays)
+            os.replace(tmp_cache_file, roi_cache_file)
+
+            # Create a pickle file saving the full data structure (including the coordinates, PMFs, and simulated data) that we just calculated
+            if keep_unnecessary_calculations:
+                make_pickle(roi_data_item, pickle_dir, pickle_file)
 
             # Output the metrics calculation time for the current ROI
             duration = time.time() - start_time
@@ -3586,11 +3963,17 @@ def calculate_metrics_for_roi(args_as_single_tuple):
 
         else:
 
-            # The pickle file already exists
-            print('The pickle file {} in directory {} already exists'.format(pickle_file, pickle_dir))
+            # The cached .npz file already exists
+            print('The cached .npz file {} already exists'.format(roi_cache_file))
 
             if do_logging:
-                log_file_handle.write('ROI {:06d} (split 01, {}): pickle file {}/{} already exists for the ROI\n'.format(roi_index, uroi, pickle_dir, pickle_file))
+                log_file_handle.write('ROI {:06d} (split 01, {}): cached .npz file {} already exists for the ROI\n'.format(roi_index, uroi, roi_cache_file))
+
+        # Get the captured log messages
+        log_lines = (log_file_handle.getvalue().splitlines() if do_logging else [])
+
+    # Return the ROI's results to be written into the metrics store by the main process as they stream back from the workers
+    return {'roi_index': roi_index, 'metrics_arrays': metrics_arrays, 'log_lines': log_lines}
 
 
 def save_figs_and_corresp_data_for_roi(args_as_single_tuple):
@@ -4216,41 +4599,30 @@ def generate_dens_pvals_array_for_roi(args_as_single_tuple):
     df_density_pvals_roi = df_density_pvals[df_density_pvals['roi_name'] == roi_name]
 
     # Keep only those entries in the data for which there is a minimum number of valid centers
-    df_valid = df_density_pvals_roi[df_density_pvals_roi['nvalid_centers_per_slice'].apply(lambda x: x[0]) >= num_valid_centers_minimum]
-
-    # For every possible center and neighbor species...
-    for icenter_spec, center_spec in enumerate(all_species_ids[:]):
-        for ineighbor_spec, neighbor_spec in enumerate(all_species_ids[:]):
-
-            # Get a dataframe of, if present, the P value data for the current ROI/center/neighbor. There should never be more than one match, and there could be zero matches due to having too few center species present
-            one_or_zero_rows = df_valid[(df_valid['center_species_id'] == center_spec) & (df_valid['neighbor_species_id'] == neighbor_spec)]
-            nrows = len(one_or_zero_rows)
+    df_valid = df_density_pvals_roi[df_density_pvals_roi['nvalid_centers'] >= num_valid_centers_minimum]
 
-            # Ensure there is exactly zero or one matches in the data for the current ROI/center/neighbor
-            if nrows not in {0, 1}:
-                print('ERROR: There is more than one match for the current ROI/center/neighbor: {}/{}/{}'.format(roi_name, center_spec, neighbor_spec))
-                exit()
-
-            # For debugging purposes, if there are no matches for the current ROI/center/neighbor, print that information
-            if nrows == 0:
-                if debug:
-                    print('NOTE: There is no data for ROI/center/neighbor: {}/{}/{}'.format(roi_name, center_spec, neighbor_spec))
-
-            # If there's a single match for the current ROI/center/neighbor (nrows=1)
-            else:
-
-                # Store the current index of the single row since we use it twice below
-                index = one_or_zero_rows.index[0]
-
-                # Store the log of the left and right P values in the numpy array
-                log_dens_pvals_arr[icenter_spec, ineighbor_spec, :, 0] = np.array([one_or_zero_rows.loc[index, 'left_log_dens_pvals'][0][0],
-                                                                                   one_or_zero_rows.loc[index, 'right_log_dens_pvals'][0][0]])
-
-                # I SHOULD PROBABLY MOVE THIS OUT OF THE ELSE STATEMENT!!!!, I doubt that would hurt anything and would rather be generally helpful!
-                roi_center_neighbor_holder[icenter_spec, ineighbor_spec, :] = np.array([center_spec, neighbor_spec])
+    # Ensure there is at most one row in the data for each center/neighbor/slice of the current ROI
+    if df_valid.duplicated(subset=['center_species_id', 'neighbor_species_id', 'slice']).any():
+        print('ERROR: There is more than one match for a center/neighbor/slice in ROI {}'.format(roi_name))
+        exit()
 
-                # Store the current number of valid centers
-                num_valid_centers[icenter_spec, ineighbor_spec, 0] = one_or_zero_rows.loc[index, 'nvalid_centers_per_slice'][0]
+    # Determine the center and neighbor species indexes of every row
+    species_index_from_id = {species_id: ispecies for ispecies, species_id in enumerate(all_species_ids)}
+    icenter_spec = df_valid['center_species_id'].map(species_index_from_id).to_numpy()
+    ineighbor_spec = df_valid['neighbor_species_id'].map(species_index_from_id).to_numpy()
+    islice = df_valid['slice'].to_numpy()
+
+    # Store the log of the left and right P values, the centers and neighbors, and the number of valid centers in the numpy arrays
+    log_dens_pvals_arr[icenter_spec, ineighbor_spec, 0, islice] = df_valid['left_log_dens_pval'].to_numpy()
+    log_dens_pvals_arr[icenter_spec, ineighbor_spec, 1, islice] = df_valid['right_log_dens_pval'].to_numpy()
+    roi_center_neighbor_holder[icenter_spec, ineighbor_spec, 0] = df_valid['center_species_id'].to_numpy()
+    roi_center_neighbor_holder[icenter_spec, ineighbor_spec, 1] = df_valid['neighbor_species_id'].to_numpy()
+    num_valid_centers[icenter_spec, ineighbor_spec, islice] = df_valid['nvalid_centers'].to_numpy()
+
+    # For debugging purposes, print the ROI/center/neighbor combinations for which there is no data
+    if debug:
+        for icenter_spec_no_data, ineighbor_spec_no_data in zip(*np.nonzero(roi_center_neighbor_holder[:, :, 0] == -1)):
+            print('NOTE: There is no data for ROI/center/neighbor: {}/{}/{}'.format(roi_name, all_species_ids[icenter_spec_no_data], all_species_ids[ineighbor_spec_no_data]))
 
     # Set the (negative) infinite values to the darkest color (or else they won't be plotted, as inf values are not plotted)
     if not correct_flooring:
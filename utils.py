@@ -13,6 +13,9 @@ from datetime import datetime
 import anndata
 import time
 import pickle
+import json
+import concurrent.futures
+import threading
 
 def set_filename_corresp_to_roi(df_paths, roi_name, curr_colname, curr_dir, curr_dir_listing):
     """Update the path in a main paths-holding dataframe corresponding to a particular ROI in a particular directory.
@@ -458,19 +461,14 @@ def get_unique_image_ids_from_datafile(datafile_path):
     # Import relevant libraries
     import dataset_formats
 
-    # Obtain the image number extraction parameters
-    relevant_column_str, string_processing_func, _, _, _, _ = dataset_formats.extract_datafile_metadata(datafile_path)
+    # Obtain the memoized scan of the datafile, which reads its image column(s) only once per version of the file
+    scan = dataset_formats.scan_datafile(datafile_path)
 
     # If the datafile is some recognized file format...
-    if relevant_column_str is not None:
+    if scan['metadata'] is not None:
 
-        sep = (',' if datafile_path.split('.')[-1] == 'csv' else '\t')
-
-        # Efficiently get just the relevant column of the datafile
-        df = pd.read_csv(datafile_path, usecols=[relevant_column_str], sep=sep)
-
-        # Extract from it the unique image IDs (note this is a good way to sort the correct order of e.g. 1 and 10)
-        return [y.strip() for y in sorted([string_processing_func(x) for x in df[relevant_column_str].unique()])]
+        # Return the unique image IDs extracted during the scan (sorted so as to get the correct order of e.g. 1 and 10)
+        return scan['unique_image_ids']
 
     # If the datafile is not a recognized file format...
     else:
@@ -527,8 +525,157 @@ def is_symmetric_all(arr):
     # Return the boolean declaring whether all contained matrices are symmetric
     return all_are_symmetric
 
-def execute_data_parallelism_potentially(function=(lambda x: x), list_of_tuple_arguments=[(4444,)], nworkers=0, task_description='', do_benchmarking=False, mp_start_method=None, use_starmap=False):  # spawn works with name=main block in Home.py
+# Process-lifetime worker pools, keyed by (start method, number of workers, preload key), where the preload key is None for plain pools, which are shared by all the parallel call sites (of all sessions); each value is [pool, number of callers currently holding the pool, whether the pool has been retired, i.e., is to be shut down once released]
+persistent_pools = {}
+
+# Lock guarding persistent_pools, since Streamlit sessions run as threads of the same process
+persistent_pools_lock = threading.Lock()
+
+# Whether shutdown_persistent_pools() has been registered to run at interpreter exit
+persistent_pools_exit_handler_registered = False
+
+# Read-only data preloaded into the current (worker) process by initialize_pool_worker()
+worker_preloaded_data = None
+
+# Read-only data made available to the tasks run in serial by execute_data_parallelism_potentially(), per thread so that concurrent Streamlit sessions don't see each other's data
+serial_preloaded_data = threading.local()
+
+# Modules imported once by the forkserver process so that each forked worker doesn't need to re-import them
+forkserver_preload_modules = ['numpy', 'pandas', 'scipy.spatial', 'scipy.stats', 'utils']
+
+
+def initialize_pool_worker(preloaded_data):
+    """Store read-only data in a worker process once, at worker startup.
+
+    Args:
+        preloaded_data (object): Data to make available to every task run by the worker via get_worker_preloaded_data()
+    """
+    global worker_preloaded_data
+    worker_preloaded_data = preloaded_data
+
+
+def get_worker_preloaded_data():
+    """Get the read-only data preloaded into the current process by get_persistent_pool() (or by execute_data_parallelism_potentially() when running in serial).
+
+    Returns:
+        object: The preloaded data, or None if none were preloaded
+    """
+    preloaded_data = getattr(serial_preloaded_data, 'data', None)
+    return (preloaded_data if preloaded_data is not None else worker_preloaded_data)
+
+
+def get_persistent_pool(nworkers, mp_start_method=None, preloaded_data=None, preload_key=None):
+    """Get a worker pool that lives for the duration of the process and is shared by all callers requesting the same start method and number of workers.
+
+    Creating a pool (and, for the forkserver and spawn start methods, re-importing numpy/scipy/pandas in every child) is expensive, so plain pools are reused rather than shut down when released (see release_persistent_pool()). Only one plain pool is kept per start method though: requesting a different number of workers retires the current one, which is shut down as soon as its callers have released it, so that idle workers don't pile up in a long-running server. If preloaded_data is specified, it is sent to each worker once at startup (see get_worker_preloaded_data()) rather than with every task. Such a pool belongs to its caller(s): it's only shared with callers specifying the same preload_key, and it's shut down once all of them have released it (see release_persistent_pool()), so that one caller (e.g., another Streamlit session) can never shut down a pool that is still in use.
+
+    Args:
+        nworkers (int): Number of worker processes
+        mp_start_method (str, optional): Start method of the multiprocessing module; the "fork" start method is replaced by "forkserver". Defaults to None, which uses the default start method for the OS.
+        preloaded_data (object, optional): Read-only data to preload into each worker. Defaults to None.
+        preload_key (hashable, optional): Key identifying preloaded_data so that a pool already holding the same data can be shared. Defaults to None, in which case a pool with preloaded data is never shared.
+
+    Returns:
+        multiprocessing.pool.Pool: The worker pool, which must be released via release_persistent_pool() once done with
+    """
+
+    # Import relevant libraries
+    import multiprocessing as mp
+    import atexit
+    import uuid
+    global persistent_pools_exit_handler_registered
+
+    # Determine the start method, forcing forkserver instead of fork as in execute_data_parallelism_potentially()
+    if mp_start_method is None:
+        mp_start_method = mp.get_start_method()
+    if mp_start_method == 'fork':
+        mp_start_method = 'forkserver'
+
+    # A pool with preloaded data but no key identifying the data should never be shared
+    if preloaded_data is None:
+        preload_key = None
+    elif preload_key is None:
+        preload_key = uuid.uuid4().hex
+
+    pools_to_shut_down = []
+    with persistent_pools_lock:
+
+        # Retire the other plain pools of the same start method, shutting down right away those that no caller is holding
+        pool_key = (mp_start_method, nworkers, preload_key)
+        if preload_key is None:
+            for other_pool_key, pool_info in list(persistent_pools.items()):
+                if (other_pool_key != pool_key) and (other_pool_key[0] == mp_start_method) and (other_pool_key[2] is None):
+                    if pool_info[1] == 0:
+                        del persistent_pools[other_pool_key]
+                        pools_to_shut_down.append(pool_info[0])
+                    else:
+                        pool_info[2] = True
+
+        # Return the existing pool if there is one, recording the new caller
+        pool = None
+        if pool_key in persistent_pools:
+            pool_info = persistent_pools[pool_key]
+            pool_info[1] += 1
+            pool_info[2] = False
+            pool = pool_info[0]
+
+        # Otherwise, create a new pool
+        else:
+            print('Starting a persistent pool of {} workers using the "{}" protocol{}'.format(nworkers, mp_start_method, (' with preloaded data' if preloaded_data is not None else '')))
+            ctx = mp.get_context(mp_start_method)
+            if mp_start_method == 'forkserver':
+                ctx.set_forkserver_preload(forkserver_preload_modules)
+            pool = ctx.Pool(nworkers, initializer=initialize_pool_worker, initargs=(preloaded_data,))
+            if not persistent_pools_exit_handler_registered:
+                atexit.register(shutdown_persistent_pools)
+                persistent_pools_exit_handler_registered = True
+            persistent_pools[pool_key] = [pool, 1, False]
+
+    # Shut down the retired pools that nobody was holding
+    for pool_to_shut_down in pools_to_shut_down:
+        pool_to_shut_down.close()
+        pool_to_shut_down.join()
+
+    return pool
+
+
+def release_persistent_pool(pool):
+    """Release a pool obtained from get_persistent_pool().
+
+    A pool holding preloaded data is shut down, freeing the workers' copies of the data, once every caller that obtained it has released it. Plain pools are kept available for reuse unless they've been retired (see get_persistent_pool()), in which case they're likewise shut down once released by all their callers.
+
+    Args:
+        pool (multiprocessing.pool.Pool): The pool to release
+    """
+    with persistent_pools_lock:
+        for pool_key, pool_info in list(persistent_pools.items()):
+            if pool_info[0] is pool:
+                pool_info[1] -= 1
+                if (pool_info[1] > 0) or ((pool_key[2] is None) and (not pool_info[2])):
+                    return
+                del persistent_pools[pool_key]
+                break
+        else:
+            return
+    pool.close()
+    pool.join()
+
+
+def shutdown_persistent_pools():
+    """Shut down all the pools obtained from get_persistent_pool(); this is registered to run at interpreter exit.
+    """
+    with persistent_pools_lock:
+        pools = [pool_info[0] for pool_info in persistent_pools.values()]
+        persistent_pools.clear()
+    for pool in pools:
+        pool.close()
+        pool.join()
+
+
+def execute_data_parallelism_potentially(function=(lambda x: x), list_of_tuple_arguments=[(4444,)], nworkers=0, task_description='', do_benchmarking=False, mp_start_method=None, use_starmap=False, preloaded_data=None, preload_key=None, result_callback=None):  # spawn works with name=main block in Home.py
     # Note I forced mp_start_method = 'spawn' up until 4/27/23. Removing that and letting Python choose the default for the OS got parallelism working on NIDAP. I likely forced it to be spawn a long time ago maybe to get it working on Biowulf or my laptop or something like that. This worked in all scenarios including on my laptop (in WSL) though I get weird warnings I believe. I got confident about doing it this most basic way on 4/27/23 after reading Goyo's 2/7/23 example [here](https://discuss.streamlit.io/t/streamlit-session-state-with-multiprocesssing/29230/2) showing the same exact method I've been using except for forcing multiprocessing to use the "spawn" start method.
+    # The workers come from the process-lifetime pool returned by get_persistent_pool() so that they're not restarted on every call. preloaded_data (see get_persistent_pool()) is made available to function via get_worker_preloaded_data() in both the parallel and serial cases.
+    # If result_callback is specified, each result is instead passed to it as soon as it's ready (in completion order, not submission order) rather than all results being accumulated, so that the caller can aggregate them while bounding memory to a single result; None is then returned. This isn't supported together with use_starmap.
 
     # Import relevant library
     import multiprocessing as mp
@@ -551,28 +698,76 @@ def execute_data_parallelism_potentially(function=(lambda x: x), list_of_tuple_a
     # Farm out the function execution to multiple CPUs on different parts of the data
     if use_multiprocessing:
         print('Running {} function calls using the "{}" protocol with {} workers for the {}'.format(len(list_of_tuple_arguments), mp_start_method, nworkers, task_description))
-        with mp.get_context(mp_start_method).Pool(nworkers) as pool:
-            if not use_starmap:
-                pool.map(function, list_of_tuple_arguments)
+        pool = get_persistent_pool(nworkers, mp_start_method=mp_start_method, preloaded_data=preloaded_data, preload_key=preload_key)
+        try:
+            if result_callback is not None:
+                # Stream the results back as the workers finish them
+                for result in pool.imap_unordered(function, list_of_tuple_arguments):
+                    result_callback(result)
+                results = None
+            elif not use_starmap:
+                results = pool.map(function, list_of_tuple_arguments)
             else:
                 # Apply the calculate_density_matrix_for_image function to each set of keyword arguments in kwargs_list, i.e., list_of_tuple_arguments is really a kwargs_list
                 # A single call would be something like: calculate_density_matrix_for_image(**kwargs_list[4])
                 results = pool.starmap(function, list_of_tuple_arguments)
 
+        # Release the pool even if a task or the callback failed, which frees the workers' copies of any preloaded data
+        finally:
+            release_persistent_pool(pool)
+
     # Execute fully in serial without use of the multiprocessing module
     else:
         print('NOT using multiprocessing for the {}'.format(task_description))
-        for args_as_single_tuple in list_of_tuple_arguments:
-            function(args_as_single_tuple)
+        serial_preloaded_data.data = preloaded_data
+        try:
+            if result_callback is not None:
+                for args_as_single_tuple in list_of_tuple_arguments:
+                    result_callback(function(args_as_single_tuple))
+                results = None
+            elif not use_starmap:
+                results = [function(args_as_single_tuple) for args_as_single_tuple in list_of_tuple_arguments]
+            else:
+                results = [function(*args_as_tuple) for args_as_tuple in list_of_tuple_arguments]
+        finally:
+            serial_preloaded_data.data = None
 
     # Output how long the task took
     if do_benchmarking:
         elapsed_time = time.time() - start_time
         print('BENCHMARKING: The task took {:.2f} seconds using {} CPU(s) {} hyperthreading'.format(elapsed_time, (nworkers if use_multiprocessing else 1), ('WITH' if use_multiprocessing else 'WITHOUT')))
 
-    # Since I don't usually return the results from .map() and I'm only doing it in the case that's making me implement starmap here, only return results when starmap is used (plus I'm still not returning it in map() above)
-    if use_starmap:
-        return results
+    # Return the results from either .map() or .starmap()
+    return results
+
+def get_neighbor_counts_settings(single_dist_mat_cutoff_in_mb=None, total_dist_mat_cutoff_in_mb=None, nworkers=None):
+    """
+    Fill in the defaults of the memory budget and parallelism of the neighbor counting methods (see calculate_neighbor_counts_with_possible_chunking() and calculate_neighbor_counts_for_radii()).
+
+    Args:
+        single_dist_mat_cutoff_in_mb (float, optional): The maximum size in megabytes of the distance matrix of each chunk, i.e., per thread. Defaults to None, meaning 200 MB.
+        total_dist_mat_cutoff_in_mb (float, optional): The maximum total size in megabytes of the distance matrices of all chunks processed at once. Defaults to None, meaning a quarter of the currently available memory.
+        nworkers (int, optional): The number of threads to use. Defaults to None, meaning all the CPUs, unless we're already in a worker process (e.g., of a pool parallelizing over ROIs or images), in which case 1.
+
+    Returns:
+        float: The maximum size in megabytes of the distance matrix of each chunk
+        float: The maximum total size in megabytes of the distance matrices of all chunks processed at once
+        int: The number of threads to use
+    """
+
+    # Import relevant libraries
+    import multiprocessing as mp
+    import psutil
+
+    # Fill in the defaults
+    if single_dist_mat_cutoff_in_mb is None:
+        single_dist_mat_cutoff_in_mb = 200
+    if total_dist_mat_cutoff_in_mb is None:
+        total_dist_mat_cutoff_in_mb = psutil.virtual_memory().available / 1024 ** 2 / 4
+    if nworkers is None:
+        nworkers = (1 if mp.parent_process() is not None else (os.cpu_count() or 1))
+
+    return single_dist_mat_cutoff_in_mb, total_dist_mat_cutoff_in_mb, max(int(nworkers), 1)
 
 # Only used for the not-yet-used multiprocessing functionality in calculate_neighbor_counts_with_possible_chunking
 def wrap_calculate_neighbor_counts(args):
@@ -628,7 +823,7 @@ def calculate_neighbor_counts(center_coords=None, neighbor_coords=None, radii=No
     # Return the neighbor counts
     return neighbor_counts
 
-def calculate_neighbor_counts_with_possible_chunking(center_coords=None, neighbor_coords=None, radii=None, single_dist_mat_cutoff_in_mb=200, test=False, verbose=False, swap_inequalities=False):
+def calculate_neighbor_counts_with_possible_chunking(center_coords=None, neighbor_coords=None, radii=None, single_dist_mat_cutoff_in_mb=None, test=False, verbose=False, swap_inequalities=False, total_dist_mat_cutoff_in_mb=None, nworkers=None):
     """
     Andrew's comments:
     Efficiently count neighbors around centers for an arbitrary number of radius ranges, while ensuring that no intermediate matrices (i.e., the distance matrices) are too large in memory, with the maximum cutoff in MB corresponding to single_dist_mat_cutoff_in_mb
@@ -639,9 +834,12 @@ def calculate_neighbor_counts_with_possible_chunking(center_coords=None, neighbo
         center_coords (np.ndarray): The coordinates of the centers. Shape is (num_centers, 2).
         neighbor_coords (np.ndarray): The coordinates of the neighbors. Shape is (num_neighbors, 2).
         radii (np.ndarray): The radii to use for the neighbor counting. Shape is (num_ranges + 1,) = (num_radii,).
-        single_dist_mat_cutoff_in_mb (float): The maximum size in megabytes of the distance matrix for all centers and neighbors. Default is 200 MB.
+        single_dist_mat_cutoff_in_mb (float): The maximum size in megabytes of the distance matrix for all centers and neighbors, i.e., of each chunk. Default is None, meaning 200 MB (see get_neighbor_counts_settings()).
         test (bool): Whether to use test data. Default is False.
         verbose (bool): Whether to print debugging output. Default is False.
+        swap_inequalities (bool): Whether to count neighbors in (radii[k], radii[k + 1]] instead of [radii[k], radii[k + 1]). Default is False.
+        total_dist_mat_cutoff_in_mb (float): The maximum total size in megabytes of the distance matrices of all chunks processed at once, which limits the number of threads actually used. Default is None, meaning a quarter of the available memory (see get_neighbor_counts_settings()).
+        nworkers (int): The number of threads among which to distribute the chunks. The results are identical regardless. Default is None, meaning all the CPUs unless we're already in a worker process, in which case 1 (see get_neighbor_counts_settings()).
 
     Returns:
         np.ndarray: The neighbor counts for each center and radius range. Shape is (num_centers, num_ranges).
@@ -661,6 +859,9 @@ def calculate_neighbor_counts_with_possible_chunking(center_coords=None, neighbo
     single_dist_mat_cutoff_in_mb: Maximum size in megabytes of a single distance matrix
     test:
     verbose:
+    swap_inequalities:
+    total_dist_mat_cutoff_in_mb: Maximum size in megabytes of all distance matrices being calculated at once
+    nworkers: Number of threads among which to distribute the chunks
 
     Returns
     -------
@@ -671,6 +872,9 @@ def calculate_neighbor_counts_with_possible_chunking(center_coords=None, neighbo
     element_size_in_bytes = 8  # as is the case for np.float64, the default float size. "element" refers to matrix element
     bytes_per_mb = 1024 ** 2
 
+    # Fill in the defaults of the memory budget and parallelism
+    single_dist_mat_cutoff_in_mb, total_dist_mat_cutoff_in_mb, nworkers = get_neighbor_counts_settings(single_dist_mat_cutoff_in_mb, total_dist_mat_cutoff_in_mb, nworkers)
+
     # If using test data, which should produce four chunks
     if test:
         rng = np.random.default_rng()
@@ -682,8 +886,7 @@ def calculate_neighbor_counts_with_possible_chunking(center_coords=None, neighbo
     # Otherwise, check the input data just a bit
     else:
         if (center_coords is None) or (neighbor_coords is None) or (radii is None):
-            print('ERROR: None of center_coords, neighbor_coords, or radii can be None')
-            return None
+            raise ValueError('None of center_coords, neighbor_coords, or radii can be None')
 
     # Get the sizes of the input arrays
     tot_num_centers = center_coords.shape[0]
@@ -734,25 +937,35 @@ def calculate_neighbor_counts_with_possible_chunking(center_coords=None, neighbo
         # Initialize the neighbor_counts array to an impossible number of counts
         neighbor_counts = np.ones(shape=((tot_num_centers, num_ranges)), dtype=int) * -1
 
-        # Calculate the neighbor counts for each chunk
-        # list_of_tuple_arguments = []  # only needed for the not-yet-used multiprocessing functionality below
-        for ichunk, (curr_start_index, curr_stop_index) in enumerate(zip(center_start_indices, center_stop_indices)):
+        # Calculate the neighbor counts for a single chunk, writing them into its own rows of neighbor_counts
+        def count_neighbors_for_chunk(ichunk):
+            curr_start_index, curr_stop_index = center_start_indices[ichunk], center_stop_indices[ichunk]
 
             # Debugging output
             if verbose:
                 print(f'     On chunk {ichunk + 1} ({curr_stop_index - curr_start_index} centers) of {num_chunks}...')
-                # print(np.arange(curr_start_index, curr_stop_index))
+
             # Calculate the neighbor counts for the current chunk
             neighbor_counts[curr_start_index:curr_stop_index, :] = calculate_neighbor_counts(center_coords=center_coords[curr_start_index:curr_stop_index, :],
                                                                                              neighbor_coords=neighbor_coords,
                                                                                              radii=radii,
                                                                                              test = test,
                                                                                              swap_inequalities=swap_inequalities)
-            
-            # list_of_tuple_arguments.append((center_coords[curr_start_index:curr_stop_index, :], neighbor_coords, radii))  # works using the multiprocessing function below, though never implemented the saving of the results
 
-        # # Used for testing implementation of parallelism, which is incomplete per the comment above and am not using it in production
-        # execute_data_parallelism_potentially(function=wrap_calculate_neighbor_counts, list_of_tuple_arguments=list_of_tuple_arguments, nworkers=7)
+        # Determine how many chunks to process at once, limited by the total memory budget. Threads suffice since cdist and the numpy comparisons and sums release the GIL, and, unlike processes, they can be used from within pool workers
+        nthreads = min(nworkers, num_chunks, max(int(total_dist_mat_cutoff_in_mb // chunk_size_in_mb), 1))
+
+        # Debugging output
+        if verbose:
+            print(f'  Number of threads: {nthreads}')
+
+        # Calculate the neighbor counts for each chunk. The chunks are independent and each writes only its own rows, so the results are identical regardless of the number of threads
+        if nthreads == 1:
+            for ichunk in range(num_chunks):
+                count_neighbors_for_chunk(ichunk)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) as executor:
+                list(executor.map(count_neighbors_for_chunk, range(num_chunks)))
 
         # Confirm there are no negative neighbor counts
         assert (neighbor_counts < 0).sum() == 0, 'ERROR: The neighbor counts for at least some centers did not get populated'
@@ -773,20 +986,220 @@ def calculate_neighbor_counts_with_possible_chunking(center_coords=None, neighbo
     return neighbor_counts
 
 
-def calculate_neighbor_counts_with_kdtree(center_coords, neighbor_coords, radius, tol=1e-9):
-    # NOTE FOR FUTURE: Probably reconsider using scipy.spatial.KDTree.count_neighbors() since that may align with the statistic of interest in both Poisson and permutation methods, i.e., the sum of the neighbor counts over all centers. Perhaps force that to work because that may really perfectly match the statistic of interest. E.g., note in calculate_density_metrics() that the full output of this function (num_centers,) is not used but is rather summed, which I believe would be the output of count_neighbors(). I.e., query_ball_tree() returns extra, unused information. I would need to make sure there would never be memory issues though, e.g., if an entire large slide were to run count_neighbors() at once. If there are P phenotypes, we'd still have to build 2P trees and call count_neighbors P^2 times per ROI, so both timing and memory usage should be tested thoroughly.
+def calculate_neighbor_counts_with_kdtree(center_coords, neighbor_coords, radius, tol=1e-9, workers=1):
+    # Count-only query: query_ball_point(return_length=True) counts the neighbors within the radius of each center in C without ever building the lists of neighbor indices, and can split the centers among threads
     radius = radius - tol  # to essentially make the check [0, radius) instead of [0, radius]
-    center_tree = scipy.spatial.KDTree(center_coords)
     neighbor_tree = scipy.spatial.KDTree(neighbor_coords)
-    indexes = center_tree.query_ball_tree(neighbor_tree, r=radius)
-    return np.array([len(neighbors_list) for neighbors_list in indexes])  # (num_centers,)
+    return neighbor_tree.query_ball_point(center_coords, r=radius, return_length=True, workers=workers).astype(int)  # (num_centers,)
+
+
+def calculate_cumulative_neighbor_counts_with_kdtree(center_coords, neighbor_coords, radii, tol=1e-9, workers=1):
+    """
+    Count the neighbors within [0, radius) of every center for each of several radii, building the neighbor tree only once and never materializing any lists of neighbor indices.
+
+    Args:
+        center_coords (np.ndarray): The coordinates of the centers. Shape is (num_centers, 2).
+        neighbor_coords (np.ndarray): The coordinates of the neighbors, which can differ from the centers. Shape is (num_neighbors, 2).
+        radii (np.ndarray): The radii at which to count the neighbors. Shape is (num_radii,).
+        tol (float, optional): The amount by which to shrink each radius to turn the tree's [0, radius] check into [0, radius), as in calculate_neighbor_counts_with_kdtree(). Defaults to 1e-9.
+        workers (int, optional): The number of threads among which to split the centers (-1 means all CPUs). Defaults to 1.
+
+    Returns:
+        np.ndarray: The cumulative neighbor counts for each center and radius. Shape is (num_centers, num_radii).
+    """
+
+    # Construct the neighbor tree once for all radii
+    neighbor_tree = scipy.spatial.KDTree(neighbor_coords)
+
+    # Count the neighbors at each radius, leaving zero counts for non-positive radii
+    cumulative_counts = np.zeros((len(center_coords), len(radii)), dtype=int)
+    for iradius, radius in enumerate(radii):
+        if radius > 0:
+            cumulative_counts[:, iradius] = neighbor_tree.query_ball_point(center_coords, r=(radius - tol), return_length=True, workers=workers)
+
+    # Return the cumulative neighbor counts
+    return cumulative_counts  # (num_centers, num_radii)
+
+
+# Per-operation costs of the neighbor counting methods measured on this machine by calibrate_neighbor_counts_methods(), loaded or measured the first time choose_neighbor_counts_method() needs them
+neighbor_counts_calibration = None
+
+# Local file in which the calibration is cached so that it is only ever measured once per machine and library versions
+neighbor_counts_calibration_path = os.path.join(os.path.expanduser('~'), '.cache', 'multiplex-analysis-web-apps', 'neighbor_counts_calibration.json')
+
+
+def calibrate_neighbor_counts_methods(nrepeats=3):
+    """
+    Run a small microbenchmark of the 'cdist avoiding oom' and 'kdtree' neighbor counting methods to measure their per-operation costs on this machine.
+
+    Args:
+        nrepeats (int, optional): The number of times to repeat each timing, the fastest of which is used. Defaults to 3.
+
+    Returns:
+        dict: The seconds per center-neighbor-radius element of the cdist method, and the seconds per tree point, per query (per center and radius), and per found pair of the kdtree method.
+    """
+
+    # Time a function, taking the fastest of several runs
+    def time_it(function):
+        times = []
+        for _ in range(nrepeats):
+            start_time = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start_time)
+        return min(times)
+
+    # Uniformly random points in the unit square
+    rng = np.random.default_rng(42)
+    ncdist, ntree = 1500, 20000
+    cdist_coords = rng.random(size=(ncdist, 2))
+    tree_coords = rng.random(size=(ntree, 2))
+    radii = np.array([0, 0.01, 0.02, 0.04])
+    large_radius = 0.03  # about 57 neighbors per center
+
+    # cdist: the cost is proportional to the number of centers times neighbors times radii
+    cdist_time = time_it(lambda: calculate_neighbor_counts(center_coords=cdist_coords, neighbor_coords=cdist_coords, radii=radii))
+
+    # kdtree: tree construction, then count-only queries finding (nearly) no pairs and many pairs
+    build_time = time_it(lambda: scipy.spatial.KDTree(tree_coords))
+    tree = scipy.spatial.KDTree(tree_coords)
+    empty_query_time = time_it(lambda: tree.query_ball_point(tree_coords, r=1e-9, return_length=True))
+    full_query_time = time_it(lambda: tree.query_ball_point(tree_coords, r=large_radius, return_length=True))
+    npairs = ntree * ntree * np.pi * large_radius ** 2
+
+    # Return the per-operation costs
+    return {
+        'numpy_version': np.__version__,
+        'scipy_version': scipy.__version__,
+        'cpu_count': os.cpu_count(),
+        'cdist_sec_per_element': cdist_time / (ncdist * ncdist * len(radii)),
+        'kdtree_sec_per_point': build_time / ntree,
+        'kdtree_sec_per_query': empty_query_time / ntree,
+        'kdtree_sec_per_pair': max(full_query_time - empty_query_time, 0) / npairs,
+    }
+
+
+def get_neighbor_counts_calibration():
+    """
+    Get the neighbor counting calibration, from memory, from the local cache file, or (only if neither is available or it was measured with different library versions or CPU counts) by running calibrate_neighbor_counts_methods() and caching the result.
+
+    Returns:
+        dict: The calibration returned by calibrate_neighbor_counts_methods().
+    """
+
+    # Declare the in-memory calibration global so it can be set here
+    global neighbor_counts_calibration
+
+    # Load the calibration from the cache file if it hasn't been loaded yet and it applies to this environment
+    if neighbor_counts_calibration is None:
+        try:
+            with open(neighbor_counts_calibration_path, 'r') as f:
+                calibration = json.load(f)
+            if (calibration.get('numpy_version') == np.__version__) and (calibration.get('scipy_version') == scipy.__version__) and (calibration.get('cpu_count') == os.cpu_count()):
+                neighbor_counts_calibration = calibration
+        except (OSError, ValueError):
+            pass
+
+    # Otherwise, measure it and save it to the cache file, writing to a temporary file first so concurrent processes never read a partial file
+    if neighbor_counts_calibration is None:
+        print('Calibrating the neighbor counting methods (this is only done once per machine)...')
+        neighbor_counts_calibration = calibrate_neighbor_counts_methods()
+        try:
+            os.makedirs(os.path.dirname(neighbor_counts_calibration_path), exist_ok=True)
+            tmp_path = '{}.{}.tmp'.format(neighbor_counts_calibration_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(neighbor_counts_calibration, f, indent=4)
+            os.replace(tmp_path, neighbor_counts_calibration_path)
+        except OSError:
+            print('WARNING: Could not cache the neighbor counting calibration to {}'.format(neighbor_counts_calibration_path))
+
+    # Return the calibration
+    return neighbor_counts_calibration
+
+
+def choose_neighbor_counts_method(center_coords, neighbor_coords, radii, single_dist_mat_cutoff_in_mb=None, total_dist_mat_cutoff_in_mb=None, nworkers=None):
+    """
+    Choose the fastest neighbor counting method for a particular set of centers, neighbors, and radii using the cached calibration.
+
+    The cost of the 'cdist avoiding oom' method is proportional to the number of centers times the number of neighbors times the number of radii, whereas that of the 'kdtree' method depends on the number of neighbors (tree construction), the number of centers times the number of radii (queries), and the expected number of center-neighbor pairs within the radii, which is estimated from the radii relative to the spatial extent of the neighbors. The 'kdtree' method is also chosen whenever a single chunk of the cdist method would not comfortably fit in the available memory. The two methods give identical counts except possibly for distances within 1e-9 of a radius.
+
+    Args:
+        center_coords (np.ndarray): The coordinates of the centers. Shape is (num_centers, 2).
+        neighbor_coords (np.ndarray): The coordinates of the neighbors. Shape is (num_neighbors, 2).
+        radii (np.ndarray): The radii at which the neighbors will be counted.
+        single_dist_mat_cutoff_in_mb (float, optional): The memory budget per thread of the cdist method (see get_neighbor_counts_settings()). Defaults to None.
+        total_dist_mat_cutoff_in_mb (float, optional): The total memory budget of the cdist method (see get_neighbor_counts_settings()). Defaults to None.
+        nworkers (int, optional): The number of threads of either method (see get_neighbor_counts_settings()). Defaults to None.
+
+    Returns:
+        str: Either 'cdist avoiding oom' or 'kdtree'.
+    """
+
+    # Import relevant library
+    import psutil
+
+    # Get the problem size
+    num_centers, num_neighbors, num_radii = len(center_coords), len(neighbor_coords), len(radii)
+    if (num_centers == 0) or (num_neighbors == 0):
+        return 'cdist avoiding oom'
+
+    # Use the kdtree method if the cdist chunks processed at once would take up a large fraction of the available memory
+    single_dist_mat_cutoff_in_mb, total_dist_mat_cutoff_in_mb, nworkers = get_neighbor_counts_settings(single_dist_mat_cutoff_in_mb, total_dist_mat_cutoff_in_mb, nworkers)
+    single_chunk_size_in_mb = min(num_centers * num_neighbors * 8 / 1024 ** 2, single_dist_mat_cutoff_in_mb)
+    concurrent_chunks_size_in_mb = min(single_chunk_size_in_mb * nworkers, max(total_dist_mat_cutoff_in_mb, single_chunk_size_in_mb))
+    if concurrent_chunks_size_in_mb > psutil.virtual_memory().available / 1024 ** 2 / 4:
+        return 'kdtree'
+
+    # Estimate the expected number of pairs found by the tree at each radius from the density of the neighbors
+    neighbor_extent = np.ptp(neighbor_coords, axis=0).astype(float)
+    neighbor_area = max(np.prod(neighbor_extent + np.max(radii)), 1e-12)
+    disk_fractions = np.minimum(np.pi * np.asarray(radii, dtype=float) ** 2 / neighbor_area, 1)
+    expected_num_pairs = num_centers * num_neighbors * disk_fractions.sum()
+
+    # Estimate the runtime of each method
+    calibration = get_neighbor_counts_calibration()
+    cdist_time = calibration['cdist_sec_per_element'] * num_centers * num_neighbors * num_radii
+    kdtree_time = calibration['kdtree_sec_per_point'] * num_neighbors + calibration['kdtree_sec_per_query'] * num_centers * num_radii + calibration['kdtree_sec_per_pair'] * expected_num_pairs
+
+    # Return the faster method
+    return ('kdtree' if kdtree_time < cdist_time else 'cdist avoiding oom')
 
-    # Using this matches the cdist method but is not elegant, but using "tol" above gets the same result more efficiently
-    # neighbor_counts = []
-    # for i, neighbors_list in enumerate(indexes):
-    #     count = sum(np.linalg.norm(neighbor_coords[idx] - center_coords[i]) < radius for idx in neighbors_list)
-    #     neighbor_counts.append(count)
-    # return np.array(neighbor_counts)  # (num_centers,)
+
+def calculate_neighbor_counts_for_radii(center_coords, neighbor_coords, radii, neighbor_counts_method='cdist avoiding oom', single_dist_mat_cutoff_in_mb=None, total_dist_mat_cutoff_in_mb=None, nworkers=None):
+    """
+    Count the neighbors around every center in every [radii[k], radii[k + 1]) range in a single pass, using any of the neighbor counting methods of calculate_metrics_from_coords() in time_cell_interaction_lib.py, or the fastest of them for the data at hand if neighbor_counts_method is 'auto'.
+
+    This way the distances between a set of centers and a set of neighbors are calculated only once for all slices rather than once per slice.
+
+    Args:
+        center_coords (np.ndarray): The coordinates of the centers. Shape is (num_centers, 2).
+        neighbor_coords (np.ndarray): The coordinates of the neighbors. Shape is (num_neighbors, 2).
+        radii (np.ndarray): The monotonically increasing radii, e.g., all the slice edges. Shape is (num_ranges + 1,).
+        neighbor_counts_method (str, optional): One of 'pure cdist', 'cdist avoiding oom', 'kdtree', or 'auto' (see choose_neighbor_counts_method()). Defaults to 'cdist avoiding oom'.
+        single_dist_mat_cutoff_in_mb (float, optional): The memory budget per thread of the 'cdist avoiding oom' method (see get_neighbor_counts_settings()). Defaults to None.
+        total_dist_mat_cutoff_in_mb (float, optional): The total memory budget of the 'cdist avoiding oom' method (see get_neighbor_counts_settings()). Defaults to None.
+        nworkers (int, optional): The number of threads of the 'cdist avoiding oom' and 'kdtree' methods (see get_neighbor_counts_settings()). Defaults to None.
+
+    Returns:
+        np.ndarray: The neighbor counts for each center and radius range. Shape is (num_centers, num_ranges).
+    """
+
+    # Choose the method automatically if requested
+    if neighbor_counts_method == 'auto':
+        neighbor_counts_method = choose_neighbor_counts_method(center_coords, neighbor_coords, radii, single_dist_mat_cutoff_in_mb=single_dist_mat_cutoff_in_mb, total_dist_mat_cutoff_in_mb=total_dist_mat_cutoff_in_mb, nworkers=nworkers)
+
+    # Count the neighbors using the requested method
+    if neighbor_counts_method == 'pure cdist':
+        neighbor_counts = calculate_neighbor_counts(center_coords=center_coords, neighbor_coords=neighbor_coords, radii=radii)
+    elif neighbor_counts_method == 'cdist avoiding oom':
+        neighbor_counts = calculate_neighbor_counts_with_possible_chunking(center_coords=center_coords, neighbor_coords=neighbor_coords, radii=radii, verbose=False, single_dist_mat_cutoff_in_mb=single_dist_mat_cutoff_in_mb, total_dist_mat_cutoff_in_mb=total_dist_mat_cutoff_in_mb, nworkers=nworkers)
+    elif neighbor_counts_method == 'kdtree':  # difference the cumulative [0, radius) counts at every radius
+        cumulative_counts = calculate_cumulative_neighbor_counts_with_kdtree(center_coords=center_coords, neighbor_coords=neighbor_coords, radii=radii, workers=get_neighbor_counts_settings(nworkers=nworkers)[2])
+        neighbor_counts = np.diff(cumulative_counts, axis=1)
+    else:
+        raise ValueError(f'Unknown neighbor counts method "{neighbor_counts_method}"')
+
+    # Return the neighbor counts
+    return neighbor_counts  # (num_centers, num_ranges)
 
 
 def dataframe_insert_possibly_existing_column(df, column_position, column_name, srs_column_values):
@@ -1184,89 +1597,141 @@ def fast_neighbors_counts_for_block(df_image, image_name, coord_column_names, ph
     return df_curr_counts
 
 
-def fast_neighbors_counts_for_block2(df_image, image_name, coord_column_names, phenotypes, radii, phenotype_column_name, max_chunk_size_in_mb=200):
-    # A block can be an image, ROI, etc. It's the entity over which it makes sense to calculate the neighbors of centers. Here, we're assuming it's an image, but in the SIT for e.g., we generally want it to refer to a ROI.
+def calculate_annulus_neighbor_counts(center_coords, neighbor_coords, neighbor_labels, num_labels, radii, max_chunk_size_in_mb=200, swap_inequalities=False):
+    """
+    Count the neighbors of every label in every annulus around every center using a single KDTree traversal per chunk of centers.
 
-    # max_chunk_size_in_mb=200, for a 100K-cell dataset, will yield about 250-row chunks, which will yield about 400 chunks i.e. center KDTrees
-    # max_chunk_size_in_mb=500, for a 100K-cell dataset, will yield about 650-row chunks, which will yield about 150 chunks i.e. center KDTrees
-    # max_chunk_size_in_mb=1000, for a 100K-cell dataset, will yield about 1300-row chunks, which will yield about 80 chunks i.e. center KDTrees
-    # max_chunk_size_in_mb=2000, for a 100K-cell dataset, will yield about 2600-row chunks, which will yield about 40 chunks i.e. center KDTrees
-    # max_chunk_size_in_mb=5000, for a 100K-cell dataset, will yield about 6600-row chunks, which will yield about 15 chunks i.e. center KDTrees
+    Rather than querying a tree once per label and per radius and taking the length of every returned Python list, all center-neighbor pairs within the largest radius are obtained at once as numpy arrays, each pair is binned into its annulus using the squared distances, and the (center, label, annulus) bins are tallied using np.bincount. No Python lists are ever built. The centers are chunked so that the pair arrays for a single chunk never take up more than roughly max_chunk_size_in_mb, where the number of pairs per center is obtained exactly (and cheaply) from a count-only query beforehand.
 
-    # Print the image name
-    print(f'Calculating neighbor counts for image {image_name} ({len(df_image)} cells) using the new kdtree method...')
+    Args:
+        center_coords (np.ndarray): The coordinates of the centers. Shape is (num_centers, 2).
+        neighbor_coords (np.ndarray): The coordinates of the neighbors. Shape is (num_neighbors, 2).
+        neighbor_labels (np.ndarray): The integer label (e.g., phenotype index) of every neighbor, in [0, num_labels). Neighbors with a negative label are ignored. Shape is (num_neighbors,).
+        num_labels (int): The number of possible labels.
+        radii (np.ndarray): The monotonically increasing radii defining the annuli. Shape is (num_annuli + 1,).
+        max_chunk_size_in_mb (float, optional): The approximate maximum size in megabytes of the pair arrays for a single chunk of centers. Defaults to 200.
+        swap_inequalities (bool, optional): If False, the annuli are [radii[k], radii[k + 1]) as in calculate_neighbor_counts(); if True, they are (radii[k], radii[k + 1]] as when differencing cumulative query_ball_tree() counts. Defaults to False.
 
-    # Record the start time
-    start_time = time.time()
+    Returns:
+        np.ndarray: The int32 neighbor counts for each center, label, and annulus. Shape is (num_centers, num_labels, num_annuli).
+    """
 
-    # Store some properties of the input dataframe
-    df_image_index = df_image.index
-    num_cells = len(df_image)
+    # Constants
+    bytes_per_pair = 40  # two int64 indices and a float64 distance from the tree query, plus the float64 squared distance and int64 bin we calculate ourselves
+    bytes_per_mb = 1024 ** 2
 
-    # Get the number of rows per chunk based on the maximum chunk size in MB and assuming every cell will be counted as a neighbor around every center (i.e., use upper limits)
-    largest_sublist_size_in_mb = num_cells * 8  / 1024 ** 2  # 8 bytes per int64 --> units = mb / row
-    num_rows_per_chunk = int(max_chunk_size_in_mb / largest_sublist_size_in_mb)
+    # Standardize the inputs
+    center_coords = np.asarray(center_coords, dtype=np.float64)
+    neighbor_coords = np.asarray(neighbor_coords, dtype=np.float64)
+    neighbor_labels = np.asarray(neighbor_labels, dtype=np.int64)
+    radii = np.asarray(radii, dtype=np.float64)
+    num_centers = center_coords.shape[0]
+    num_annuli = len(radii) - 1
 
-    # Get the corresponding integer indices to index things like the input image dataframe
-    start_indices = np.arange(0, num_cells, num_rows_per_chunk)
-    stop_indices = start_indices + num_rows_per_chunk
+    # Initialize the output array
+    neighbor_counts = np.zeros((num_centers, num_labels, num_annuli), dtype=np.int32)
 
-    # Initialize a list to hold the dataframes of neighbor counts for each radius (not each radius range)
-    df_counts_holder = [pd.DataFrame(0, index=phenotypes, columns=df_image_index) for _ in radii]
+    # Drop the neighbors we are not counting
+    neighbors_to_keep = neighbor_labels >= 0
+    neighbor_coords = neighbor_coords[neighbors_to_keep]
+    neighbor_labels = neighbor_labels[neighbors_to_keep]
 
-    # Pre-calculate the neighbor tree for each phenotype
-    neighbor_trees = []
-    for neighbor_phenotype in phenotypes:
+    # Nothing to count
+    if (num_centers == 0) or (len(neighbor_coords) == 0) or (num_annuli < 1):
+        return neighbor_counts
 
-        # Get the boolean series identifying the current neighbor phenotype
-        ser_curr_neighbor_phenotype = df_image[phenotype_column_name] == neighbor_phenotype
+    # Squared radii, against which we compare the squared distances exactly as in calculate_neighbor_counts()
+    radii_sq = radii ** 2
+    side = ('left' if swap_inequalities else 'right')
 
-        # Construct the KDTree for the current phenotype in the entire current image. This represents the neighbors
-        neighbor_trees.append(scipy.spatial.KDTree(df_image.loc[ser_curr_neighbor_phenotype, coord_column_names]))
+    # Construct the neighbor tree once. Pad the query distance slightly so that the tree returns a superset of the pairs we bin below
+    neighbor_tree = scipy.spatial.KDTree(neighbor_coords)
+    max_distance = radii[-1] * (1 + 1e-9) + 1e-12
+
+    # Determine the number of pairs per center without building any lists and from it the chunk boundaries so that each chunk has at most about max_num_pairs_per_chunk pairs
+    max_num_pairs_per_chunk = max(int(max_chunk_size_in_mb * bytes_per_mb / bytes_per_pair), 1)
+    num_pairs_per_center = neighbor_tree.query_ball_point(center_coords, r=max_distance, return_length=True)
+    cumulative_num_pairs = np.cumsum(num_pairs_per_center)
+    chunk_boundaries = [0]
+    while chunk_boundaries[-1] < num_centers:
+        pairs_before_chunk = (cumulative_num_pairs[chunk_boundaries[-1] - 1] if chunk_boundaries[-1] > 0 else 0)
+        next_boundary = int(np.searchsorted(cumulative_num_pairs, pairs_before_chunk + max_num_pairs_per_chunk, side='right'))
+        chunk_boundaries.append(min(max(next_boundary, chunk_boundaries[-1] + 1), num_centers))
 
     # For each chunk of centers...
-    for start_index, stop_index in zip(start_indices, stop_indices):
+    for start_index, stop_index in zip(chunk_boundaries[:-1], chunk_boundaries[1:]):
 
-        # Construct the KDTree for the current chunk. This represents the centers
-        center_tree = scipy.spatial.KDTree(df_image.loc[df_image_index[start_index:stop_index], coord_column_names])
+        # Get all center-neighbor pairs within the largest radius as arrays in a single traversal
+        center_tree = scipy.spatial.KDTree(center_coords[start_index:stop_index])
+        pairs = center_tree.sparse_distance_matrix(neighbor_tree, max_distance, output_type='ndarray')
+        center_indices = pairs['i'].astype(np.int64)
+        neighbor_indices = pairs['j'].astype(np.int64)
+        del pairs
 
-        # For each neighbor tree...
-        for ineighbor_phenotype, curr_neighbor_tree in enumerate(neighbor_trees):
+        # Bin each pair into its annulus using the exact squared distance
+        dist_sq = ((center_coords[start_index + center_indices] - neighbor_coords[neighbor_indices]) ** 2).sum(axis=1)
+        annulus_indices = np.searchsorted(radii_sq, dist_sq, side=side) - 1
+        in_annuli = (annulus_indices >= 0) & (annulus_indices < num_annuli)
 
-            # For each radius, which should be monotonically increasing and start with 0...
-            for iradius, radius in enumerate(radii):
+        # Tally the pairs into (center, label, annulus) bins
+        flat_bins = (center_indices[in_annuli] * num_labels + neighbor_labels[neighbor_indices[in_annuli]]) * num_annuli + annulus_indices[in_annuli]
+        neighbor_counts[start_index:stop_index] = np.bincount(flat_bins, minlength=(stop_index - start_index) * num_labels * num_annuli).reshape((stop_index - start_index, num_labels, num_annuli))
 
-                # Get the list of lists containing the indices of the neighbors for each center
-                neighbors_for_radius = center_tree.query_ball_tree(curr_neighbor_tree, radius)
+    # Return the neighbor counts
+    return neighbor_counts
 
-                # In the correct dataframe (corresponding to the current radius), set the counts of neighbors (of the current phenotype) for each center
-                df_counts_holder[iradius].iloc[ineighbor_phenotype, start_index:stop_index] = [len(neighbors_for_center) for neighbors_for_center in neighbors_for_radius]
 
-    # For each annulus, i.e., each radius range...
-    df_counts_holder_annulus = []
-    for iradius in range(len(radii) - 1):
+def fast_neighbors_counts_array_for_block(df_image, image_name, coord_column_names, phenotypes, radii, phenotype_column_name, max_chunk_size_in_mb=200):
+    """
+    Calculate the neighbor counts of every phenotype in every (radii[k], radii[k + 1]] annulus around every cell in a block using calculate_annulus_neighbor_counts().
 
-        # Get the counts of neighbors in the current annulus
-        df_counts_curr_annulus = df_counts_holder[iradius + 1] - df_counts_holder[iradius]
+    A block can be an image, ROI, etc. It's the entity over which it makes sense to calculate the neighbors of centers.
 
-        # Rename the index to reflect the current radius range
-        radius_range_str = f'({radii[iradius]}, {radii[iradius + 1]}]'
-        df_counts_curr_annulus.index = [f'{phenotype} in {radius_range_str}' for phenotype in phenotypes]
+    Args:
+        df_image (pandas.DataFrame): The cells in the block.
+        image_name (str): The name of the block, used only for printing.
+        coord_column_names (list): The names of the coordinate columns.
+        phenotypes (list): The phenotypes to count.
+        radii (np.ndarray): The radii, which should be monotonically increasing and start with 0.
+        phenotype_column_name (str): The name of the phenotype column.
+        max_chunk_size_in_mb (float, optional): See calculate_annulus_neighbor_counts(). Defaults to 200.
 
-        # Add a transpose of this (so centers are in rows and phenotypes/radii are in columns) to the running list of annulus dataframes
-        df_counts_holder_annulus.append(df_counts_curr_annulus.T)
+    Returns:
+        np.ndarray: The int32 neighbor counts. Shape is (num_cells, num_phenotypes, num_annuli).
+    """
 
-    # Concatenate the annulus dataframes to get the final dataframe of neighbor counts for the current image
-    df_curr_counts = pd.concat(df_counts_holder_annulus, axis='columns')
+    # Print the image name
+    print(f'Calculating neighbor counts for image {image_name} ({len(df_image)} cells) using the single-pass annulus method...')
 
-    # Convert the dataframe to a more efficient dtype (from int64)
-    df_curr_counts = df_curr_counts.astype(np.int32)
+    # Record the start time
+    start_time = time.time()
+
+    # Map each cell's phenotype to its index in the list of phenotypes, or -1 if it's not in the list
+    neighbor_labels = pd.Categorical(df_image[phenotype_column_name], categories=phenotypes).codes
+
+    # Count the neighbors of every phenotype in every annulus around every cell
+    coords = df_image[coord_column_names].to_numpy()
+    neighbor_counts = calculate_annulus_neighbor_counts(coords, coords, neighbor_labels, len(phenotypes), radii, max_chunk_size_in_mb=max_chunk_size_in_mb, swap_inequalities=True)
 
     # Print the time taken to calculate the neighbor counts for the current image
     print(f'  ...finished calculating neighbor counts for image {image_name} ({len(df_image)} cells) in {time.time() - start_time:.2f} seconds')
 
+    # Return the array of neighbor counts for the current image
+    return neighbor_counts
+
+
+def fast_neighbors_counts_for_block2(df_image, image_name, coord_column_names, phenotypes, radii, phenotype_column_name, max_chunk_size_in_mb=200):
+    # A block can be an image, ROI, etc. It's the entity over which it makes sense to calculate the neighbors of centers. Here, we're assuming it's an image, but in the SIT for e.g., we generally want it to refer to a ROI.
+    # This is the dataframe version of fast_neighbors_counts_array_for_block(), with one column per phenotype and radius range, i.e., the same output as fast_neighbors_counts_for_block()
+
+    # Calculate the (num_cells, num_phenotypes, num_annuli) array of neighbor counts in a single pass
+    neighbor_counts = fast_neighbors_counts_array_for_block(df_image, image_name, coord_column_names, phenotypes, radii, phenotype_column_name, max_chunk_size_in_mb=max_chunk_size_in_mb)
+
+    # Get the column names, with the radius ranges varying slowest so the columns are ordered as in fast_neighbors_counts_for_block()
+    column_names = [f'{phenotype} in ({radii[iradius]}, {radii[iradius + 1]}]' for iradius in range(len(radii) - 1) for phenotype in phenotypes]
+
     # Return the final dataframe of neighbor counts for the current image
-    return df_curr_counts
+    return pd.DataFrame(neighbor_counts.transpose((0, 2, 1)).reshape((len(df_image), -1)), index=df_image.index, columns=column_names)
 
 
 def get_categorical_columns_including_numeric(df, max_num_unique_values=1000):